@@ -0,0 +1,451 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import tracemalloc
+import warnings
+from datetime import datetime, timezone
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import xarray as xr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'scripts'))
+sys.path.insert(0, HERE)
+
+import inform_utils as inform
+import inform_grid_utils as igu
+import process_data_products_utils as pdp
+import profiling_utils as prof
+import run_similarity as sim
+import synthetic as syn
+
+# Benchmarks of the hot paths of inform_utils, process_data_products_utils, inform_grid_utils and
+# the run matrix similarity index (scripts/run_similarity.py) on synthetic data (see synthetic.py),
+# at several data sizes.
+#
+# Every case times one function call, after one untimed warm-up call (lazy imports, first file
+# opens); its inputs are rebuilt before each call outside the timed region, so functions that
+# modify their inputs in place (block_flight, collocate_ERA5_dat, cloud_regime, ...) always see the
+# same data. Wall/CPU time and RSS change come from profiling_utils.stage; the peak of Python and
+# NumPy allocations (tracemalloc) is measured in one extra call, so tracing does not slow down the
+# timed repeats.
+#
+#   python benchmarks/run_benchmarks.py --quick            # smallest size of every case
+#   python benchmarks/run_benchmarks.py --only grid_flight
+#   python benchmarks/run_benchmarks.py --save-baseline    # record benchmarks/baselines.json
+#   python benchmarks/run_benchmarks.py --compare          # flag regressions against it
+
+BASELINE_PATH = os.path.join(HERE, 'baselines.json')
+CAMPAIGN = 'SOCRATES'
+REGRESSION_RATIO = 1.5    # slower (or larger peak memory) than baseline by this factor is a regression
+MIN_DELTA_S = 0.05        # ... and by at least this many seconds (timer noise on tiny cases)
+MIN_DELTA_MB = 5.0        # ... or this many MB
+
+# name -> {'module', 'function', 'param', 'sizes', 'setup'}
+BENCHMARKS = {}
+
+
+def benchmark(name, module, param, sizes, function=None):
+    """
+    Register a benchmark case. The decorated setup(size, work) gets the size and a scratch directory
+    and returns (func, make_args): make_args() builds fresh positional arguments for one call of func.
+    """
+    def register(setup):
+        BENCHMARKS[name] = {'module': module.__name__, 'function': function or name, 'param': param,
+                            'sizes': list(sizes), 'setup': setup}
+        return setup
+    return register
+
+
+# Data shared between cases, built once per size
+_CACHE = {}
+
+
+def _cached(key, build):
+    if key not in _CACHE:
+        _CACHE[key] = build()
+    return _CACHE[key]
+
+
+def _flight_dir(work, hours, rate_hz=1):
+    return _cached(('flight_dir', hours, rate_hz), lambda: os.path.dirname(syn.write_flight_dir(
+        os.path.join(work, f"flights_{rate_hz}hz_{hours}h"), 1, int(hours * 3600), rate_hz, CAMPAIGN)[0]))
+
+
+def _flight(work, hours):
+    # 1 Hz flight as the pipeline sees it: read back through load_flight_data
+    return _cached(('flight', hours), lambda: _quiet(inform.load_flight_data, _flight_dir(work, hours)))
+
+
+def _era5_root(work):
+    def build():
+        root = os.path.join(work, 'era5') + os.sep   # the ERA5 readers append e5.oper.an.*/ directly
+        syn.write_era5_tree(root)
+        return root
+    return _cached('era5', build)
+
+
+def _flight_types(work, hours):
+    return _cached(('flight_types', hours), lambda: pdp.assign_flight_type(_flight(work, hours).copy()))
+
+
+def _blocks(work, hours):
+    return _cached(('blocks', hours), lambda: pdp.block_flight(_flight_types(work, hours)['DataFrame']))
+
+
+def _era5_fields(work, hours):
+    return _cached(('era5_fields', hours), lambda: pdp.select_ERA5_4flight(_flight(work, hours), CAMPAIGN,
+                                                                           _era5_root(work)))
+
+
+def _collocated(work, hours):
+    return _cached(('collocated', hours), lambda: pdp.collocate_ERA5_dat(_era5_fields(work, hours),
+                                                                         _copy_blocks(_blocks(work, hours))))
+
+
+def _regimes(work, hours):
+    return _cached(('regimes', hours), lambda: pdp.cloud_regime(_copy_blocks(_collocated(work, hours)), CAMPAIGN))
+
+
+def _sonde_track(work, n_sondes):
+    def build():
+        paths = [syn.write_sonde_cls(os.path.join(work, f"sondes_{n_sondes}", f"D{k:02d}.cls"), n_sondes=4,
+                                     seed=k) for k in range(max(n_sondes // 4, 1))]
+        return pdp.sonde_track(inform.read_sondes(paths))
+    return _cached(('sondes', n_sondes), build)
+
+
+def _cesm(work):
+    # Hourly history for the flight day, read back from disk; grid_flight takes its pressure
+    # levels from a single time step
+    def build():
+        path = syn.write_cesm_history(os.path.join(work, 'cesm'))
+        return xr.open_dataset(path, use_cftime=True).load()
+    return _cached('cesm', build)
+
+
+def _copy_blocks(blocks):
+    return {label: [b.copy() for b in frames] for label, frames in blocks.items()}
+
+
+def _quiet(func, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return func(*args, **kwargs)
+
+
+FLIGHT_HOURS = (1, 4, 8)
+
+
+@benchmark('load_flight_data_1hz', inform, 'hours', FLIGHT_HOURS, function='load_flight_data')
+def _load_1hz(hours, work):
+    path = _flight_dir(work, hours)
+    return inform.load_flight_data, lambda: (path,)
+
+
+@benchmark('load_flight_data_25hz', inform, 'minutes', (5, 20, 60), function='load_flight_data')
+def _load_25hz(minutes, work):
+    path = _flight_dir(work, minutes / 60, rate_hz=25)
+    return inform.load_flight_data, lambda: (path,)
+
+
+@benchmark('read_sondes', inform, 'sondes', (8, 32, 128))
+def _read_sondes(n_sondes, work):
+    _sonde_track(work, n_sondes)
+    d = os.path.join(work, f"sondes_{n_sondes}")
+    paths = inform.find_sondes(d)
+    return inform.read_sondes, lambda: (paths,)
+
+
+@benchmark('assign_flight_type', pdp, 'hours', FLIGHT_HOURS)
+def _assign_flight_type(hours, work):
+    df = _flight(work, hours)
+    return pdp.assign_flight_type, lambda: (df.copy(),)
+
+
+@benchmark('block_flight', pdp, 'hours', FLIGHT_HOURS)
+def _block_flight(hours, work):
+    df = _flight_types(work, hours)['DataFrame']
+    return pdp.block_flight, lambda: (df.copy(),)
+
+
+@benchmark('select_ERA5_4flight', pdp, 'hours', FLIGHT_HOURS)
+def _select_era5(hours, work):
+    df, root = _flight(work, hours), _era5_root(work)
+    return pdp.select_ERA5_4flight, lambda: (df, CAMPAIGN, root)
+
+
+@benchmark('collocate_ERA5_dat', pdp, 'hours', FLIGHT_HOURS)
+def _collocate_era5(hours, work):
+    ds, blocks = _era5_fields(work, hours), _blocks(work, hours)
+    return pdp.collocate_ERA5_dat, lambda: (ds, _copy_blocks(blocks))
+
+
+@benchmark('collocate_ERA5_pointwise', pdp, 'hours', FLIGHT_HOURS)
+def _collocate_pointwise(hours, work):
+    df, root, blocks = _flight(work, hours), _era5_root(work), _blocks(work, hours)
+    return pdp.collocate_ERA5_pointwise, lambda: (pdp.load_ERA5_primitives(df, CAMPAIGN, root), _copy_blocks(blocks))
+
+
+@benchmark('cloud_regime', pdp, 'hours', FLIGHT_HOURS)
+def _cloud_regime(hours, work):
+    blocks = _collocated(work, hours)
+    return pdp.cloud_regime, lambda: (_copy_blocks(blocks), CAMPAIGN)
+
+
+@benchmark('write_RF_nc', pdp, 'hours', FLIGHT_HOURS)
+def _write_rf_nc(hours, work):
+    blocks = _regimes(work, hours)
+    out_dir = os.path.join(work, f"out_{hours}h")
+    os.makedirs(out_dir, exist_ok=True)
+
+    def write(fblks):
+        # write_RF_nc writes to the working directory
+        cwd = os.getcwd()
+        os.chdir(out_dir)
+        try:
+            return pdp.write_RF_nc(fblks, 'RF01', CAMPAIGN)
+        finally:
+            os.chdir(cwd)
+    return write, lambda: (_copy_blocks(blocks),)
+
+
+@benchmark('plot_block_ts', pdp, 'hours', FLIGHT_HOURS)
+def _plot_block_ts(hours, work):
+    flight_types = _flight_types(work, hours)
+
+    def plot(d):
+        plt.close(pdp.plot_block_ts(d, 0, CAMPAIGN, out_dir=work, dpi=100))
+    return plot, lambda: (flight_types,)
+
+
+@benchmark('collocate_sondes_ERA5', pdp, 'sondes', (8, 32, 128))
+def _collocate_sondes_era5(n_sondes, work):
+    track, root = _sonde_track(work, n_sondes), _era5_root(work)
+    return pdp.collocate_sondes_ERA5, lambda: (track.copy(), CAMPAIGN, root)
+
+
+@benchmark('grid_flight', igu, 'hours', FLIGHT_HOURS)
+def _grid_flight(hours, work):
+    df = syn.make_flight(int(hours * 3600))
+    cesm_dat = _cesm(work)
+    cesm = cesm_dat.isel(time=slice(0, 1))
+    return igu.grid_flight, lambda: (cesm, cesm_dat, df.copy())
+
+
+@benchmark('collocate_sondes_CESM', igu, 'sondes', (8, 32, 128))
+def _collocate_sondes_cesm(n_sondes, work):
+    track, cesm = _sonde_track(work, n_sondes), _cesm(work)
+    return igu.collocate_sondes_CESM, lambda: (track.copy(), cesm)
+
+
+@benchmark('decimate_track', igu, 'hours', FLIGHT_HOURS)
+def _decimate_track(hours, work):
+    df = _flight(work, hours)
+    return igu.decimate_track, lambda: (df,)
+
+
+@benchmark('build_similarity', sim, 'runs', (300, 1000, 3000))
+def _build_similarity(n_runs, work):
+    matrix = syn.make_run_matrix(n_runs)
+    return sim.build_similarity, lambda: (matrix,)
+
+
+def _timed_call(name, func, make_args):
+    args = make_args()
+    with prof.stage(name) as rec:
+        result = _quiet(func, *args)
+        rec['rows'] = prof.count_rows(result)
+    return rec
+
+
+def _peak_alloc_mb(func, make_args):
+    args = make_args()
+    tracemalloc.start()
+    try:
+        _quiet(func, *args)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(name, size, work, repeat=3, memory=True, warmup=1):
+    """
+    Time one benchmark case at one size (after `warmup` untimed calls).
+
+    :return: dict with module, function, size, rows, wall_s (median of the repeats), wall_min_s,
+             cpu_s, rss_delta_mb (max over repeats), peak_alloc_mb (tracemalloc; None if memory=False)
+             and repeat.
+    """
+    spec = BENCHMARKS[name]
+    func, make_args = _quiet(spec['setup'], size, work)
+    for _ in range(warmup):
+        _quiet(func, *make_args())
+    was_enabled = prof.is_enabled()
+    prof.enable()
+    try:
+        recs = [_timed_call(name, func, make_args) for _ in range(repeat)]
+    finally:
+        prof.enable(was_enabled)
+    walls = [r['wall_s'] for r in recs]
+    rss = [r['rss_delta_mb'] for r in recs if r['rss_delta_mb'] is not None]
+    return {
+        'module': spec['module'], 'function': spec['function'], spec['param']: size, 'rows': recs[-1]['rows'],
+        'wall_s': float(np.median(walls)), 'wall_min_s': min(walls),
+        'cpu_s': float(np.median([r['cpu_s'] for r in recs])),
+        'rss_delta_mb': max(rss) if rss else None,
+        'peak_alloc_mb': _peak_alloc_mb(func, make_args) if memory else None,
+        'repeat': repeat,
+    }
+
+
+def result_key(name, size):
+    return f"{name}[{BENCHMARKS[name]['param']}={size:g}]"
+
+
+def machine_info():
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pdp.pd.__version__, 'xarray': pdp.xr.__version__}
+
+
+def run_benchmarks(names=None, quick=False, repeat=3, memory=True, work=None, warmup=1):
+    """
+    Run the selected benchmark cases (all by default) at all their sizes (the smallest with quick=True).
+
+    :param names: Case names (keys of BENCHMARKS); unknown names raise KeyError.
+    :param work: Scratch directory for the synthetic files (a temporary directory by default,
+                 removed afterwards).
+
+    :return: dict {"created", "machine", "results": {"<case>[<param>=<size>]": run_case(...)}}
+    """
+    names = list(BENCHMARKS) if not names else names
+    for name in names:
+        if name not in BENCHMARKS:
+            raise KeyError(f"Unknown benchmark '{name}' (available: {', '.join(BENCHMARKS)})")
+    tmp = work is None
+    work = tempfile.mkdtemp(prefix='inform_bench_') if tmp else work
+    os.makedirs(work, exist_ok=True)
+    _CACHE.clear()
+    results = {}
+    try:
+        for name in names:
+            sizes = BENCHMARKS[name]['sizes'][:1] if quick else BENCHMARKS[name]['sizes']
+            for size in sizes:
+                key = result_key(name, size)
+                res = run_case(name, size, work, repeat, memory, warmup)
+                results[key] = res
+                mem = '' if res['peak_alloc_mb'] is None else f"  peak {res['peak_alloc_mb']:8.1f} MB"
+                print(f"{key:<45} {res['wall_s']:8.3f} s (min {res['wall_min_s']:.3f}){mem}  rows={res['rows']}")
+    finally:
+        _CACHE.clear()
+        if tmp:
+            shutil.rmtree(work, ignore_errors=True)
+    return {'created': datetime.now(timezone.utc).isoformat(), 'machine': machine_info(), 'results': results}
+
+
+def load_baseline(path=BASELINE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'results': {}}
+
+
+def save_baseline(run, path=BASELINE_PATH):
+    """Merge the results of `run` into the baseline file (cases that did not run keep their entries)."""
+    baseline = load_baseline(path)
+    results = dict(baseline.get('results', {}))
+    results.update(run['results'])
+    out = {'created': run['created'], 'machine': run['machine'], 'results': dict(sorted(results.items()))}
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(out, f, indent=1)
+        f.write("\n")
+    os.replace(tmp, path)
+    print(f"Wrote {path} ({len(run['results'])} results updated, {len(results)} total)")
+    return out
+
+
+def compare(run, baseline, ratio=REGRESSION_RATIO):
+    """
+    Compare a run with a baseline. A case regresses when its fastest repeat (wall_min_s, the least
+    noisy of the timings) is `ratio` times the baseline's and at least MIN_DELTA_S slower, or its allocation peak is `ratio` times the
+    baseline's and at least MIN_DELTA_MB larger.
+
+    :return: list of dicts (key, wall_min_s, base_wall_min_s, wall_ratio, peak_alloc_mb, base_peak_alloc_mb,
+             mem_ratio, regression) for the cases present in both.
+    """
+    rows = []
+    for key, res in run['results'].items():
+        base = baseline.get('results', {}).get(key)
+        if base is None:
+            continue
+        wall, base_wall = res['wall_min_s'], base['wall_min_s']
+        wall_ratio = wall / base_wall if base_wall else float('nan')
+        slower = wall_ratio > ratio and wall - base_wall > MIN_DELTA_S
+        mem, base_mem = res.get('peak_alloc_mb'), base.get('peak_alloc_mb')
+        mem_ratio = mem / base_mem if mem is not None and base_mem else None
+        larger = mem_ratio is not None and mem_ratio > ratio and mem - base_mem > MIN_DELTA_MB
+        rows.append({'key': key, 'wall_min_s': wall, 'base_wall_min_s': base_wall, 'wall_ratio': wall_ratio,
+                     'peak_alloc_mb': mem, 'base_peak_alloc_mb': base_mem, 'mem_ratio': mem_ratio,
+                     'regression': bool(slower or larger)})
+    return rows
+
+
+def print_comparison(rows, baseline):
+    if baseline.get('machine') and baseline['machine'] != machine_info():
+        print(f"Note: baseline recorded on a different machine ({baseline['machine'].get('platform')}, "
+              f"{baseline['machine'].get('cpus')} CPUs); ratios are only indicative")
+    for r in rows:
+        mem = '' if r['mem_ratio'] is None else f"  mem x{r['mem_ratio']:.2f}"
+        flag = '  REGRESSION' if r['regression'] else ''
+        print(f"{r['key']:<45} {r['wall_min_s']:8.3f} s vs {r['base_wall_min_s']:8.3f} s  x{r['wall_ratio']:.2f}{mem}{flag}")
+    n = sum(r['regression'] for r in rows)
+    print(f"{n} regression(s) in {len(rows)} compared case(s)")
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the INFORM processing functions on synthetic data.")
+    parser.add_argument('--only', nargs='+', metavar='CASE', help=f"cases to run ({', '.join(BENCHMARKS)})")
+    parser.add_argument('--quick', action='store_true', help="only the smallest size of each case")
+    parser.add_argument('--repeat', type=int, default=3, help="timed calls per case and size (median is kept)")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed calls before the timed ones")
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc peak measurement")
+    parser.add_argument('--workdir', help="keep the synthetic input files in this directory")
+    parser.add_argument('--out', help="also write the results to this JSON file")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="merge the results into the baseline file")
+    parser.add_argument('--compare', action='store_true',
+                        help="compare with the baseline and exit with status 1 on regressions")
+    parser.add_argument('--ratio', type=float, default=REGRESSION_RATIO, help="regression threshold (x baseline)")
+    args = parser.parse_args(argv)
+
+    run = run_benchmarks(args.only, args.quick, args.repeat, not args.no_memory, args.workdir,
+                         args.warmup)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(run, f, indent=1)
+        print(f"Wrote {args.out}")
+    if args.compare:
+        baseline = load_baseline(args.baseline)
+        if print_comparison(compare(run, baseline, args.ratio), baseline):
+            return 1
+    if args.save_baseline:
+        save_baseline(run, args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,390 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import cftime
+
+# Synthetic stand-ins for the inputs the pipeline normally reads off /glade: RAF flight NetCDF
+# (1 Hz and 25 Hz), the ERA5 ds633.0 tree, CESM hybrid-grid histories and AVAPS .cls sonde files.
+# Everything is seeded, so the same sizes always give the same data.
+
+FLIGHT_START = pd.Timestamp('2018-01-15 01:00:00')
+FLIGHT_CENTER = (-45.0, 142.0)   # lat, lon; a SOCRATES-like box south of Tasmania
+CLOUD_BASE, CLOUD_TOP = 800.0, 1300.0   # m
+
+# One science cycle of the flight plan: (segment duration s, altitude at segment end m). Altitude
+# changes linearly within a segment, so a repeated end altitude is a level leg.
+FLIGHT_CYCLE = [
+    (420, 150), (900, 150),           # descend to and fly a boundary-layer leg
+    (240, 1050), (600, 1050),         # climb into the cloud layer, in-cloud level leg
+    (180, 1500), (600, 1500),         # above cloud
+    (300, 150), (240, 1500),          # sawtooth profiles through the cloud layer
+    (480, 3000), (900, 3000),         # free-troposphere leg
+]
+
+# Size-distribution probes: name -> (number of bins, FirstBin, upper bin edges); 2DC and 2D-S in um,
+# CDP in um, UHSAS in nm
+SIZEDIST_PROBES = {
+    'C2DCA_RWOI': (64, 1, np.arange(0, 64) * 25.0 + 12.5),
+    'C2DSA_2H': (128, 1, np.arange(0, 128) * 10.0 + 5.0),
+    'CCDP_RWIO': (31, 1, np.r_[0.0, np.linspace(3.0, 50.0, 30)]),
+    'CUHSAS_RWOOU': (100, 1, np.r_[0.0, np.logspace(np.log10(60.0), np.log10(1000.0), 99)]),
+}
+
+LONG_NAMES = {
+    'GGLAT': 'Reference GPS Latitude', 'GGLON': 'Reference GPS Longitude',
+    'GGALT': 'Reference GPS Altitude (MSL)', 'ATX': 'Ambient Temperature, Reference',
+    'DPXC': 'Dew Point Temperature, Reference', 'UIC': 'Wind Vector, East Component, GPS-Corrected',
+    'VIC': 'Wind Vector, North Component, GPS-Corrected', 'WIC': 'Wind Vector, Vertical Gust Component',
+    'PSXC': 'Ambient Static Pressure, Reference', 'EWX': 'Ambient Water Vapor Pressure, Reference',
+    'RHUM': 'Relative Humidity', 'THETA': 'Potential Temperature',
+    'CONCD_RWIO': 'CDP Concentration (all cells)', 'PLWCD_RWIO': 'CDP Liquid Water Content',
+    'CONCN_WCN': 'Condensation Nuclei (CN) Concentration',
+}
+
+
+def flight_altitude(duration_s, rng=None):
+    """
+    GGALT (m) at 1 s steps for a flight of `duration_s` seconds: a climb out, FLIGHT_CYCLE repeated
+    for as long as the flight lasts, and a final descent, with 0.5 m of GPS noise.
+    """
+    rng = np.random.default_rng(0) if rng is None else rng
+    duration_s = int(duration_s)
+    descent = min(600, duration_s // 4)
+    segments, total = [(min(600, duration_s // 4), 3000)], min(600, duration_s // 4)
+    while total < duration_s - descent:
+        for seg, alt in FLIGHT_CYCLE:
+            seg = min(seg, duration_s - descent - total)
+            if seg <= 0:
+                break
+            segments.append((seg, alt))
+            total += seg
+    segments.append((duration_s - total, 0))
+
+    alt, start = [], 0.0
+    for seg, end in segments:
+        alt.append(np.linspace(start, end, seg, endpoint=False) + (end - start) / seg)
+        start = end
+    z = np.concatenate(alt)[:duration_s]
+    return np.maximum(z + rng.normal(0, 0.5, len(z)), 0.0)
+
+
+def make_flight(duration_s=4 * 3600, seed=0, start=FLIGHT_START, center=FLIGHT_CENTER):
+    """
+    Synthetic 1 Hz RAF flight as load_flight_data returns it (before the size-distribution join).
+
+    The aircraft flies a figure eight of about +/-2.5 deg lat and +/-3 deg lon around `center` with
+    the altitude plan of flight_altitude. A patchy cloud layer between CLOUD_BASE and a wavy top near
+    CLOUD_TOP gives in-cloud PLWCD/CONCD on the in-cloud legs and profiles.
+
+    :param duration_s: Flight length in seconds.
+    :param seed: Random seed.
+
+    :return: DataFrame with Time and the RAF state, wind, moisture and cloud variables; long names
+             in df.attrs['long_names'].
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration_s)
+    z = flight_altitude(n, rng)
+    t = pd.date_range(start, periods=n, freq='s')
+
+    phase = 2 * np.pi * np.arange(n) / 7200.0   # one figure eight every two hours
+    lat = center[0] + 2.5 * np.sin(phase)
+    lon = center[1] + 3.0 * np.sin(2 * phase)
+
+    p = 1013.25 * np.exp(-z / 8000.0)
+    T = 8.0 - 6.5 * z / 1000.0 + rng.normal(0, 0.2, n)
+    dp = T - np.where(z < CLOUD_TOP, 0.5, 8.0) - rng.uniform(0, 1, n)
+    ew = 6.112 * np.exp(17.67 * dp / (dp + 243.5))
+    es = 6.112 * np.exp(17.67 * T / (T + 243.5))
+
+    # Cloud layer: wavy top, 80 % horizontal cover from a smoothed random field
+    top = CLOUD_TOP + 100 * np.sin(phase * 7)
+    cover = np.convolve(rng.normal(size=n + 59), np.ones(60) / 60, mode='valid') > -0.1
+    in_cloud = (z > CLOUD_BASE) & (z < top) & cover
+    lwc = np.where(in_cloud, 0.05 + 0.45 * (z - CLOUD_BASE) / (top - CLOUD_BASE) * rng.uniform(0.5, 1, n), 0.0)
+    concd = np.where(in_cloud, rng.uniform(20, 200, n), rng.uniform(0, 2, n))
+
+    df = pd.DataFrame({
+        'Time': t, 'GGLAT': lat, 'GGLON': lon, 'GGALT': z, 'ATX': T, 'DPXC': dp,
+        'UIC': 10 + rng.normal(0, 1.5, n), 'VIC': 3 + rng.normal(0, 1.5, n), 'WIC': rng.normal(0, 0.5, n),
+        'PSXC': p, 'EWX': ew, 'RHUM': np.clip(100 * ew / es, 0, 105),
+        'THETA': (T + 273.15) * (1000.0 / p) ** 0.286,
+        'CONCD_RWIO': concd, 'PLWCD_RWIO': lwc,
+        'CONCN_WCN': rng.lognormal(np.log(300), 0.4, n),
+    })
+    df.attrs['long_names'] = [LONG_NAMES.get(c) for c in df.columns]
+    return df
+
+
+def size_distributions(df, seed=0):
+    """
+    Per-second bin counts for the SIZEDIST_PROBES, consistent with the cloud in `df` (make_flight):
+    CDP and drizzle counts in cloud, a few precipitation-size 2DC/2D-S particles below cloud base,
+    and a lognormal accumulation-mode UHSAS spectrum everywhere.
+
+    :return: dict name -> (counts (n, bins) float32, FirstBin, LastBin, CellSizes)
+    """
+    rng = np.random.default_rng(seed + 1)
+    n = len(df)
+    in_cloud = df['PLWCD_RWIO'].to_numpy() > 0
+    below = df['GGALT'].to_numpy() < CLOUD_BASE
+    out = {}
+    for name, (nbins, first, cells) in SIZEDIST_PROBES.items():
+        centers = cells / (1e3 if name.startswith('CUHSAS') else 1.0)   # um for all shapes below
+        if name.startswith('CCDP'):
+            shape = np.exp(-0.5 * ((centers - 12.0) / 4.0) ** 2)
+            scale = np.where(in_cloud, df['CONCD_RWIO'].to_numpy(), 0.5)
+        elif name.startswith('CUHSAS'):
+            shape = np.exp(-0.5 * (np.log(np.maximum(centers, 1e-3) / 0.15) / 0.5) ** 2)
+            scale = df['CONCN_WCN'].to_numpy() * 0.3
+        else:
+            shape = np.exp(-centers / 250.0)
+            scale = np.where(in_cloud, 0.5, np.where(below, 0.05, 0.001))
+        counts = rng.poisson(scale[:, None] * shape[None, :] / shape.sum() * 10) / 10
+        counts[:, :first] = 0
+        out[name] = (counts.astype('float32'), first, nbins - 1, cells)
+    return out
+
+
+def flight_dataset(duration_s=4 * 3600, rate_hz=1, seed=0, start=FLIGHT_START, sizedists=True):
+    """
+    RAF-style flight Dataset: Time (seconds since midnight) plus the make_flight variables and the
+    size distributions with FirstBin/LastBin/CellSizes attributes and (Time, sps1, Vector<n>) dims.
+
+    With rate_hz=25 the state, wind and cloud variables are written as (Time, sps25) high-rate
+    samples and GGLAT/GGLON/GGALT stay 1-D at 1 Hz, as in the RAF high-rate files.
+    """
+    df = make_flight(duration_s, seed, start)
+    n = len(df)
+    t0 = df['Time'].iloc[0].normalize()
+    ds = xr.Dataset(coords={'Time': ('Time', df['Time'].to_numpy())})
+    rng = np.random.default_rng(seed + 2)
+    for col, long_name in zip(df.columns[1:], df.attrs['long_names'][1:]):
+        values = df[col].to_numpy()
+        if rate_hz > 1 and col not in ('GGLAT', 'GGLON', 'GGALT'):
+            # Linear within the second plus small high-rate noise
+            step = np.diff(values, append=values[-1])
+            frac = np.arange(rate_hz) / rate_hz
+            hr = values[:, None] + step[:, None] * frac[None, :] + \
+                rng.normal(0, 0.01 * (np.nanstd(values) or 1.0), (n, rate_hz))
+            ds[col] = (('Time', f'sps{rate_hz}'), hr.astype('float32'))
+        else:
+            ds[col] = ('Time', values.astype('float64' if col in ('GGLAT', 'GGLON') else 'float32'))
+        ds[col].attrs['long_name'] = long_name
+    if sizedists:
+        for name, (counts, first, last, cells) in size_distributions(df, seed).items():
+            ds[name] = (('Time', 'sps1', f'Vector{counts.shape[1]}'), counts[:, None, :])
+            ds[name].attrs.update(long_name=f'{name} size distribution counts', FirstBin=first,
+                                  LastBin=last, CellSizes=cells.astype('float32'))
+    ds['Time'].encoding.update(units=f"seconds since {t0:%Y-%m-%d %H:%M:%S} +0000", dtype='int32')
+    return ds
+
+
+def write_flight_nc(path, duration_s=4 * 3600, rate_hz=1, seed=0, start=FLIGHT_START, sizedists=True):
+    """Write flight_dataset(...) to `path` and return the path."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    flight_dataset(duration_s, rate_hz, seed, start, sizedists).to_netcdf(path)
+    return path
+
+
+def write_flight_dir(dir_path, n_flights=1, duration_s=4 * 3600, rate_hz=1, campaign='SOCRATES', seed=0):
+    """Write n_flights files named like the RAF products, <campaign>rf<NN>.nc; returns their paths."""
+    suffix = 'h' if rate_hz > 1 else ''
+    return [write_flight_nc(os.path.join(dir_path, f"{campaign}{suffix}rf{i + 1:02d}.nc"), duration_s,
+                            rate_hz, seed + i) for i in range(n_flights)]
+
+
+# ERA5 files written by write_era5_tree: (stream, parameter code, short name, variable, mean, std)
+ERA5_FILES = [
+    ('sfc', '128_034', 'sstk', 'SSTK', 285.0, 2.0),
+    ('sfc', '128_167', '2t', 'VAR_2T', 284.0, 2.0),
+    ('sfc', '128_165', '10u', 'VAR_10U', 5.0, 3.0),
+    ('sfc', '128_166', '10v', 'VAR_10V', 2.0, 3.0),
+    ('pl', '128_135', 'w', 'W', 0.0, 0.3),
+    ('pl', '128_157', 'r', 'R', 50.0, 10.0),
+    ('pl', '128_131', 'u', 'U', 10.0, 3.0),
+    ('pl', '128_132', 'v', 'V', 3.0, 3.0),
+    ('pl', '128_130', 't', 'T', 270.0, 5.0),
+    ('pl', '128_133', 'q', 'Q', 0.003, 0.001),
+]
+ERA5_LEVELS = np.array([300, 400, 500, 600, 700, 750, 800, 850, 900, 925, 950, 975, 1000.])
+
+
+def write_era5_tree(root, day=FLIGHT_START, lat=(-38.0, -52.0), lon=(312.0, 332.0), res=0.25,
+                    levels=ERA5_LEVELS, seed=0):
+    """
+    Fake ERA5 (ds633.0) tree for one day under `root`, laid out and named like the RDA copy:
+    e5.oper.an.{sfc,pl}/YYYYMM/e5.oper.an.{sfc,pl}.<code>_<short>.ll025sc.YYYYMMDD00_YYYYMMDD23.nc,
+    hourly, latitudes north -> south, longitudes 0-360. Surface fields are smooth in space (so
+    the SST gradients in Tadv are finite) with noise on top.
+
+    The default box covers the make_flight track in the longitude convention ERA5_flight_window
+    uses for SOCRATES (GGLON + 180).
+
+    :return: list of written paths.
+    """
+    rng = np.random.default_rng(seed)
+    day = pd.Timestamp(day).normalize()
+    times = pd.date_range(day, periods=24, freq='h')
+    lats = np.arange(lat[0], lat[1] - res / 2, -res)
+    lons = np.arange(lon[0], lon[1] + res / 2, res)
+    stamp = f"{day:%Y%m%d}00_{day:%Y%m%d}23"
+    gradient = (np.linspace(1, -1, len(lats))[:, None] + 0.3 * np.sin(np.radians(lons * 20))[None, :])
+
+    paths = []
+    for stream, code, short, var, mean, std in ERA5_FILES:
+        d = os.path.join(root, f"e5.oper.an.{stream}", f"{day:%Y%m}")
+        os.makedirs(d, exist_ok=True)
+        if stream == 'pl':
+            shape = (len(times), len(levels), len(lats), len(lons))
+            dims, coords = ('time', 'level', 'latitude', 'longitude'), {'level': levels}
+            base = mean + std * gradient[None, None]
+        else:
+            shape = (len(times), len(lats), len(lons))
+            dims, coords = ('time', 'latitude', 'longitude'), {}
+            base = mean + std * gradient[None]
+        data = (base + 0.3 * std * rng.standard_normal(shape)).astype('float32')
+        coords.update(time=times, latitude=lats, longitude=lons)
+        path = os.path.join(d, f"e5.oper.an.{stream}.{code}_{short}.ll025sc.{stamp}.nc")
+        xr.DataArray(data, dims=dims, coords=coords).to_dataset(name=var).to_netcdf(path)
+        paths.append(path)
+    return paths
+
+
+def cesm_hybrid_coefficients(nlev=32, p_top=2.25, p0=1000.0):
+    """
+    Hybrid sigma-pressure coefficients (hyai, hybi, hyam, hybm) for `nlev` layers from p_top to the
+    surface: pure pressure above ~100 hPa, terrain following below, like CAM's L32.
+    """
+    eta = p_top / p0 + (1 - p_top / p0) * np.linspace(0, 1, nlev + 1) ** 1.6
+    hybi = np.clip((eta - 0.1) / 0.9, 0, 1) ** 1.2
+    hyai = eta - hybi
+    return hyai, hybi, (hyai[:-1] + hyai[1:]) / 2, (hybi[:-1] + hybi[1:]) / 2
+
+
+def make_cesm_history(ntime=24, nlev=32, lat=(-60.0, -30.0), lon=(120.0, 170.0), dlat=0.9424, dlon=1.25,
+                      start=FLIGHT_START, freq='h', seed=0):
+    """
+    Regional CESM/CAM history on the hybrid grid: hyam/hybm/hyai/hybi, P0, PS (time, lat, lon),
+    T, Q, U, V, RELHUM, Z3 (time, lev, lat, lon) and TS, TREFHT; noleap cftime times starting at the
+    top of the hour of `start`.
+    """
+    rng = np.random.default_rng(seed)
+    t0 = pd.Timestamp(start).floor(freq)
+    times = [cftime.DatetimeNoLeap(t.year, t.month, t.day, t.hour, t.minute, t.second)
+             for t in pd.date_range(t0, periods=ntime, freq=freq)]
+    lats = np.arange(lat[0], lat[1] + dlat / 2, dlat)
+    lons = np.arange(lon[0], lon[1] + dlon / 2, dlon)
+    hyai, hybi, hyam, hybm = cesm_hybrid_coefficients(nlev)
+    ny, nx = len(lats), len(lons)
+
+    ps = 101325.0 + 800 * rng.standard_normal((ntime, ny, nx))
+    p_mid = (1e5 * hyam[None, :, None, None] + hybm[None, :, None, None] * ps[:, None]) / 100.0
+    z = -7500.0 * np.log(p_mid / 1013.25)
+    T = np.maximum(288.0 - 6.5e-3 * z, 216.0) + rng.normal(0, 1.0, z.shape)
+    fields = {
+        'T': T, 'Q': 0.008 * np.exp(-z / 2500.0), 'U': 10 + z / 1000 + rng.normal(0, 2, z.shape),
+        'V': rng.normal(3, 2, z.shape), 'RELHUM': np.clip(rng.normal(70, 15, z.shape), 0, 100), 'Z3': z,
+    }
+    ds = xr.Dataset(
+        {name: (('time', 'lev', 'lat', 'lon'), values.astype('float32')) for name, values in fields.items()},
+        coords={'time': times, 'lev': 1000.0 * (hyam + hybm), 'ilev': 1000.0 * (hyai + hybi),
+                'lat': lats, 'lon': lons})
+    ds['PS'] = (('time', 'lat', 'lon'), ps.astype('float32'))
+    ds['TS'] = (('time', 'lat', 'lon'), (T[:, -1] + 1.0).astype('float32'))
+    ds['TREFHT'] = (('time', 'lat', 'lon'), T[:, -1].astype('float32'))
+    for name, values in (('hyam', hyam), ('hybm', hybm)):
+        ds[name] = ('lev', values)
+    for name, values in (('hyai', hyai), ('hybi', hybi)):
+        ds[name] = ('ilev', values)
+    ds['P0'] = 1e5
+    return ds
+
+
+def write_cesm_history(dir_path, case='f.e21.FHIST_BGC.f09_f09_mg17.synthetic', tape='h0', **kw):
+    """Write make_cesm_history(**kw) as <case>.cam.<tape>.<date>-<seconds>.nc (h0 free, hs nudged)."""
+    ds = make_cesm_history(**kw)
+    t0 = ds.time.values[0]
+    os.makedirs(dir_path, exist_ok=True)
+    path = os.path.join(dir_path, f"{case}.cam.{tape}.{t0.year:04d}-{t0.month:02d}-{t0.day:02d}-"
+                                  f"{t0.hour * 3600 + t0.minute * 60:05d}.nc")
+    ds.to_netcdf(path)
+    return path
+
+
+_CLS_COLUMNS = ['Time', 'Press', 'Temp', 'Dewpt', 'RH', 'Ucmp', 'Vcmp', 'spd', 'dir', 'Wcmp', 'Lon', 'Lat',
+                'Ele', 'Azi', 'Alt', 'Qp', 'Qt', 'Qrh', 'Qu', 'Qv', 'QdZ']
+_CLS_UNITS = ['sec', 'mb', 'C', 'C', '%', 'm/s', 'm/s', 'm/s', 'deg', 'm/s', 'deg', 'deg', 'deg', 'deg', 'm',
+              'code', 'code', 'code', 'code', 'code', 'code']
+
+
+def write_sonde_cls(path, n_sondes=4, levels=1400, release=FLIGHT_START + pd.Timedelta(hours=1),
+                    center=FLIGHT_CENTER, spacing_min=20, seed=0):
+    """
+    AVAPS-style .cls file with `n_sondes` dropsondes released `spacing_min` minutes apart from
+    ~7 km, each with `levels` half-second records falling at ~10 m/s near `center`. About 3 % of the
+    records have one value set to the 9999.0 missing flag.
+
+    :return: path
+    """
+    rng = np.random.default_rng(seed)
+    lines = []
+    for k in range(n_sondes):
+        t_rel = pd.Timestamp(release) + pd.Timedelta(minutes=spacing_min * k)
+        stamp = f"{t_rel:%Y, %m, %d, %H:%M:%S}"
+        lines += [
+            "Data Type:                         AVAPS SOUNDING DATA, Channel 1/Descending",
+            "Project ID:                        SOCRATES",
+            f"Sonde Id/Sonde Type:               18{seed:03d}{k:04d}/RD94",
+            f"UTC Release Time (y,m,d,h,m,s):    {stamp}",
+            "Release Site Type/Site ID:         NSF/NCAR GV N677F",
+            "/",
+            f"Nominal Release Time (y,m,d,h,m,s):{stamp}",
+            " ".join(f"{c:>6}" for c in _CLS_COLUMNS),
+            " ".join(f"{u:>6}" for u in _CLS_UNITS),
+            " ".join("------" for _ in _CLS_COLUMNS),
+        ]
+        time_s = np.arange(levels) * 0.5
+        alt = np.maximum(7000.0 - 10.0 * time_s, 0.0) + rng.normal(0, 0.5, levels)
+        temp = 8.0 - 6.5 * alt / 1000 + rng.normal(0, 0.2, levels)
+        u, v = 10 + rng.normal(0, 1, levels), 3 + rng.normal(0, 1, levels)
+        data = np.column_stack([
+            time_s, 1013.25 * np.exp(-alt / 8000.0), temp, temp - rng.uniform(0.5, 6, levels),
+            rng.uniform(40, 100, levels), u, v, np.hypot(u, v), np.degrees(np.arctan2(-u, -v)) % 360,
+            rng.normal(-10, 0.5, levels), center[1] + 0.5 * k + time_s * 2e-4,
+            center[0] - 0.3 * k + time_s * 1e-4, rng.uniform(0, 90, levels), rng.uniform(0, 360, levels),
+            alt, *np.zeros((6, levels)),
+        ])
+        missing = rng.random(data.shape) < 0.03 / data.shape[1]
+        missing[:, 0] = False
+        data[missing] = 9999.0
+        lines.extend(" ".join(f"{x:6.1f}" if j != 10 and j != 11 else f"{x:8.3f}" for j, x in enumerate(row))
+                     for row in data)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def make_run_matrix(n_runs=3000, n_keys=150, dup_frac=0.5, seed=0):
+    """
+    Run matrix entries (run_name, namelist) for the similarity index: every run shares one base
+    namelist of `n_keys` keys; a `dup_frac` share of the runs are exact copies of an earlier run
+    (like the _FAKE copies of one case) and the others change 1-3 keys, from a small pool of
+    alternative values, relative to the base.
+
+    :return: list of dicts
+    """
+    rng = np.random.default_rng(seed)
+    base = {f"key_{k:03d}": f"value_{k}" for k in range(n_keys)}
+    entries = []
+    for i in range(n_runs):
+        if entries and rng.random() < dup_frac:
+            namelist = dict(entries[rng.integers(len(entries))]['namelist'])
+        else:
+            namelist = dict(base)
+            for k in rng.choice(n_keys, rng.integers(1, 4), replace=False):
+                namelist[f"key_{k:03d}"] = f"value_{k}_{rng.integers(3)}"
+        entries.append({'run_name': f"synthetic.{i:05d}", 'namelist': namelist})
+    return entries
@@ -0,0 +1,769 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import netCDF4
+import process_data_products_utils as pdp
+import sketch_utils as sk
+
+# Variables on the 'block' dimension of the ragged layout
+BLOCK_VARS = pdp.RAGGED_BLOCK_VARS
+# Columns iter_composites adds from the block index
+INDEX_COLUMNS = ('flight', 'block_label', 'block_index')
+
+_TIME_UNITS = {'days': 'D', 'hours': 'h', 'minutes': 'min', 'seconds': 's',
+               'milliseconds': 'ms', 'microseconds': 'us', 'nanoseconds': 'ns'}
+
+
+def _decode_times(var, values):
+    """Convert CF '<unit> since <reference>' numbers to datetime64 without going through cftime."""
+    unit, ref = var.units.split(' since ')
+    values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    return (pd.Timestamp(ref).tz_localize(None) +
+            pd.to_timedelta(values, unit=_TIME_UNITS[unit.strip()])).to_numpy()
+
+
+def _decode(var, values):
+    """Turn raw netCDF4 values of one variable into the array pandas would get from the writer."""
+    attrs = var.ncattrs()
+    if 'units' in attrs and ' since ' in str(var.units):
+        return _decode_times(var, values)
+    if 'categories' in attrs:
+        codes = np.ma.filled(values, -1).astype(int)
+        return pd.Categorical.from_codes(codes, categories=json.loads(var.categories))
+    if getattr(var, 'dtype', None) is str or values.dtype == object:
+        return np.asarray(values, dtype=object)
+    if 'dtype' in attrs and var.getncattr('dtype') == 'bool':
+        return np.ma.filled(values, 0).astype(bool)
+    if np.ma.is_masked(values):
+        return np.ma.filled(values.astype(float), np.nan)
+    return np.ma.getdata(values)
+
+
+def _layout(nc):
+    return 'ragged' if 'row_size' in nc.variables else 'flat'
+
+
+def _file_index(path):
+    """Block index of one composite file (one row per block, with its row offset and length)."""
+    with netCDF4.Dataset(path) as nc:
+        layout = _layout(nc)
+        if layout == 'ragged':
+            count = np.asarray(nc['row_size'][:], dtype=np.int64)
+            blocks = pd.DataFrame({
+                'campaign': getattr(nc, 'campaign', None),
+                'flight': np.asarray(nc['flight'][:], dtype=object),
+                'block_label': np.asarray(nc['block_label'][:], dtype=object),
+                'block_index': np.asarray(nc['block_index'][:], dtype=np.int64),
+                'start': np.concatenate([[0], np.cumsum(count)[:-1]]).astype(np.int64),
+                'count': count,
+                'start_time': _decode_times(nc['start_time'], nc['start_time'][:]),
+                'end_time': _decode_times(nc['end_time'], nc['end_time'][:]),
+            })
+        else:
+            # Flat files are written block after block: find the runs of (block_label, block_index)
+            labels = np.asarray(nc['block_label'][:], dtype=object)
+            index = np.asarray(nc['block_index'][:], dtype=np.int64)
+            n = len(labels)
+            change = np.flatnonzero((labels[1:] != labels[:-1]) | (index[1:] != index[:-1])) + 1
+            start = np.concatenate([[0], change]).astype(np.int64) if n else np.array([], dtype=np.int64)
+            end = np.concatenate([change, [n]]).astype(np.int64) if n else np.array([], dtype=np.int64)
+            times = _decode_times(nc['Time'], nc['Time'][:])
+            campaign, _, rf = os.path.splitext(os.path.basename(path))[0].rpartition('_')
+            flight = str(nc['flight'][0]) if 'flight' in nc.variables and n else rf
+            blocks = pd.DataFrame({
+                'campaign': campaign or None,
+                'flight': flight,
+                'block_label': labels[start],
+                'block_index': index[start],
+                'start': start,
+                'count': end - start,
+                'start_time': times[start],
+                'end_time': times[end - 1],
+            })
+    blocks.insert(0, 'layout', layout)
+    blocks.insert(0, 'file', path)
+    return blocks
+
+
+def build_block_index(file_paths):
+    """
+    Build the block index of a set of composite files written by write_RF_nc (flat or ragged layout).
+
+    Only the block bookkeeping variables are read, so this is cheap compared with opening the data.
+
+    :param file_paths: Iterable of composite NetCDF paths.
+
+    :return: DataFrame with one row per block: file, layout, campaign, flight, block_label,
+             block_index, start (row offset in the file), count, start_time and end_time.
+    """
+    frames = [_file_index(path) for path in file_paths]
+    if not frames:
+        return pd.DataFrame(columns=['file', 'layout', 'campaign', 'flight', 'block_label', 'block_index',
+                                     'start', 'count', 'start_time', 'end_time'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+
+def parse_where(where):
+    """
+    Parse value predicates such as "ATX > -5" (a string or list of strings) into (column, op, value).
+    """
+    if where is None:
+        return []
+    return [pdp.parse_condition(text) for text in _as_list(where)]
+
+
+def select_blocks(index, campaign=None, flight=None, block_label=None):
+    """Prune a block index by campaign, flight and block label (each a value or list of values)."""
+    keep = np.ones(len(index), dtype=bool)
+    for col, wanted in (('campaign', campaign), ('flight', flight), ('block_label', block_label)):
+        if wanted is not None:
+            keep &= index[col].isin(_as_list(wanted)).to_numpy()
+    return index[keep]
+
+
+def _coalesce(starts, counts):
+    """Merge adjacent [start, start + count) row ranges into as few contiguous reads as possible."""
+    ranges = []
+    for s, c in zip(starts, counts):
+        if ranges and ranges[-1][1] == s:
+            ranges[-1][1] = s + c
+        else:
+            ranges.append([s, s + c])
+    return ranges
+
+
+def _obs_variables(nc):
+    """Per-sample column name -> variable name (ragged columns renamed by pdp.ragged_obs_name map back)."""
+    # Ragged block variables live on 'block' and are excluded by their dimension; in flat files only
+    # the columns iter_composites rebuilds from the block index are skipped (block_id etc. are data)
+    obs_dim = 'obs' if _layout(nc) == 'ragged' else 'index'
+    return {getattr(var, 'column', name): name for name, var in nc.variables.items()
+            if var.dimensions == (obs_dim,) and name not in INDEX_COLUMNS and name != 'index'}
+
+
+def _row_mask(df, conditions, regimes):
+    keep = np.ones(len(df), dtype=bool)
+    for col, op, value in conditions:
+        keep &= pdp.CONDITION_OPS[op](df[col].to_numpy(dtype=float), value)
+    if regimes is not None:
+        keep &= df['cloud_regime'].isin(regimes).to_numpy()
+    return keep
+
+
+def iter_composites(file_paths=None, index=None, campaign=None, flight=None, block_label=None,
+                    cloud_regime=None, where=None, columns=None):
+    """
+    Lazily read composite blocks, one DataFrame per file, with predicate pushdown.
+
+    Block-level predicates (campaign, flight, block_label) are answered from the block index, so
+    files and blocks that do not match are never read. Within the remaining blocks only the
+    requested columns (plus those needed by the row predicates) are read, as contiguous slices.
+
+    :param file_paths: Composite NetCDF paths (ignored if index is given).
+    :param index: Block index from build_block_index, to reuse across queries.
+    :param campaign, flight, block_label: Value or list of values to keep.
+    :param cloud_regime: Value or list of cloud regimes to keep (row-level).
+    :param where: Predicate string or list of strings such as "ATX > -5" (all must hold; NaN fails).
+    :param columns: Sample columns to return; defaults to all. flight, block_label and block_index
+                    are always included.
+
+    :return: Generator of DataFrames (files with no matching rows are skipped).
+    """
+    if index is None:
+        index = build_block_index(file_paths)
+    blocks = select_blocks(index, campaign, flight, block_label)
+    conditions = parse_where(where)
+    regimes = None if cloud_regime is None else _as_list(cloud_regime)
+
+    for path, file_blocks in blocks.groupby('file', sort=False):
+        file_blocks = file_blocks.sort_values('start')
+        ranges = _coalesce(file_blocks['start'].to_numpy(), file_blocks['count'].to_numpy())
+        with netCDF4.Dataset(path) as nc:
+            available = _obs_variables(nc)
+            wanted = list(available) if columns is None else [c for c in _as_list(columns) if c in available]
+            needed = list(dict.fromkeys(wanted + [c for c, _, _ in conditions] +
+                                        (['cloud_regime'] if regimes is not None else [])))
+            missing = [c for c in needed if c not in available]
+            if missing:
+                print(f"Warning: {os.path.basename(path)} has no {missing}; skipping file")
+                continue
+            data = {}
+            for name in needed:
+                var = nc[available[name]]
+                data[name] = _decode(var, np.ma.concatenate([var[s:e] for s, e in ranges])
+                                     if len(ranges) > 1 else var[ranges[0][0]:ranges[0][1]])
+
+        counts = file_blocks['count'].to_numpy()
+        df = pd.DataFrame(data)
+        df.insert(0, 'block_index', np.repeat(file_blocks['block_index'].to_numpy(), counts))
+        df.insert(0, 'block_label', np.repeat(file_blocks['block_label'].to_numpy(), counts))
+        df.insert(0, 'flight', np.repeat(file_blocks['flight'].to_numpy(), counts))
+
+        keep = _row_mask(df, conditions, regimes)
+        df = df.loc[keep, ['flight', 'block_label', 'block_index'] + wanted].reset_index(drop=True)
+        if len(df):
+            yield df
+
+
+def read_composites(file_paths=None, index=None, **query):
+    """
+    Read composite blocks into one DataFrame; see iter_composites for the query arguments.
+
+    This replaces inform.load_nc_cldrgme for analysis: e.g.
+    read_composites(paths, block_label="Level BL", cloud_regime="Stratocumulus", where="ATX > -5").
+    """
+    frames = list(iter_composites(file_paths, index=index, **query))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_store_manifest(store_root):
+    """Manifest of a campaign datastore written by write_RF_store, one row per partition."""
+    return pd.DataFrame(pdp.load_store_manifest(store_root)['partitions'])
+
+
+def _may_match(stats, col, op, value):
+    """Whether a partition with column range stats[col] can hold rows satisfying `col op value`."""
+    if col not in stats:
+        return True
+    lo, hi = stats[col]
+    return {'<': lo < value, '<=': lo <= value, '>': hi > value, '>=': hi >= value,
+            '==': lo <= value <= hi}[op]
+
+
+def prune_partitions(manifest, campaign=None, flight=None, block_label=None, where=None,
+                     time_range=None, bbox=None):
+    """
+    Select the datastore partitions that can contain rows matching a query, from the manifest alone.
+
+    :param manifest: DataFrame from load_store_manifest.
+    :param campaign, flight, block_label: Value or list of values to keep.
+    :param where: Predicate string(s) such as "ATX > -5"; partitions whose min/max rule them out are dropped.
+    :param time_range: (start, end) of the period of interest.
+    :param bbox: (lon_min, lat_min, lon_max, lat_max) of the region of interest.
+
+    :return: The matching rows of the manifest.
+    """
+    if manifest.empty:
+        return manifest
+    parts = select_blocks(manifest, campaign, flight, block_label)
+    keep = np.ones(len(parts), dtype=bool)
+    for k, (_, part) in enumerate(parts.iterrows()):
+        for col, op, value in parse_where(where):
+            keep[k] &= _may_match(part['stats'], col, op, value)
+        if time_range is not None:
+            keep[k] &= (pd.Timestamp(part['time_min']) <= pd.Timestamp(time_range[1]) and
+                        pd.Timestamp(part['time_max']) >= pd.Timestamp(time_range[0]))
+        if bbox is not None and part['bbox'] is not None:
+            x0, y0, x1, y1 = part['bbox']
+            keep[k] &= x0 <= bbox[2] and x1 >= bbox[0] and y0 <= bbox[3] and y1 >= bbox[1]
+    return parts[keep]
+
+
+def iter_store(store_root, campaign=None, flight=None, block_label=None, cloud_regime=None, where=None,
+               columns=None, time_range=None, bbox=None):
+    """
+    Lazily query the campaign datastore, one DataFrame per partition.
+
+    Partitions are pruned with prune_partitions before anything is read; the remaining parquet
+    files are read for the needed columns only and filtered per row like iter_composites.
+    time_range and bbox also filter rows (on Time and GGLON/GGLAT).
+
+    :return: Generator of DataFrames with campaign, flight, block_label and block_index columns.
+    """
+    parts = prune_partitions(load_store_manifest(store_root), campaign, flight, block_label, where,
+                             time_range, bbox)
+    conditions = parse_where(where)
+    regimes = None if cloud_regime is None else _as_list(cloud_regime)
+    if bbox is not None:
+        conditions += [('GGLON', '>=', bbox[0]), ('GGLAT', '>=', bbox[1]),
+                       ('GGLON', '<=', bbox[2]), ('GGLAT', '<=', bbox[3])]
+
+    for _, part in parts.iterrows():
+        read_cols = None
+        if columns is not None:
+            read_cols = list(dict.fromkeys(['block_index'] + _as_list(columns) + [c for c, _, _ in conditions] +
+                                           (['cloud_regime'] if regimes is not None else []) +
+                                           (['Time'] if time_range is not None else [])))
+        df = pd.read_parquet(os.path.join(store_root, part['path']), columns=read_cols)
+        keep = _row_mask(df, conditions, regimes)
+        if time_range is not None:
+            keep &= ((df['Time'] >= pd.Timestamp(time_range[0])) & (df['Time'] <= pd.Timestamp(time_range[1]))).to_numpy()
+        if columns is not None:
+            df = df[['block_index'] + [c for c in _as_list(columns) if c != 'block_index']]
+        df = df.loc[keep].reset_index(drop=True)
+        if len(df):
+            df.insert(0, 'block_label', part['block_label'])
+            df.insert(0, 'flight', part['flight'])
+            df.insert(0, 'campaign', part['campaign'])
+            yield df
+
+
+def query_store(store_root, **query):
+    """Query the campaign datastore into one DataFrame; see iter_store for the query arguments."""
+    frames = list(iter_store(store_root, **query))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def bin_edges(spec):
+    """
+    Bin edges from a bin spec: an array of edges, or ('lin' | 'log', lo, hi, n_bins).
+
+    Log bins are spaced evenly in log10 between lo and hi (both > 0).
+    """
+    if isinstance(spec, tuple) and len(spec) == 4 and isinstance(spec[0], str):
+        scale, lo, hi, n = spec
+        if scale == 'lin':
+            return np.linspace(lo, hi, n + 1)
+        if scale == 'log':
+            return np.logspace(np.log10(lo), np.log10(hi), n + 1)
+        raise ValueError(f"Unknown bin scale '{scale}' (expected 'lin' or 'log')")
+    return np.asarray(spec, dtype=float)
+
+
+def group_keys(df, by):
+    """
+    Categorical group keys for compositing.
+
+    :param df: DataFrame of samples.
+    :param by: List of keys; each is a column name (used as is, e.g. 'block_label', 'cloud_regime',
+               'flight') or (column, edges) to bin a numeric column into right-closed intervals,
+               e.g. ('ATX', [-10, -5, 0, 10]).
+
+    :return: dict of key name -> pandas Categorical with one value per row.
+    """
+    keys = {}
+    for key in by:
+        if isinstance(key, tuple):
+            col, edges = key
+            keys[f"{col}_bin"] = pd.cut(df[col], bin_edges(edges))
+        else:
+            keys[key] = pd.Categorical(df[key])
+    return {name: pd.Categorical(values) for name, values in keys.items()}
+
+
+def _combined_codes(keys, n):
+    """One integer code per row for the combination of all keys (-1 if any key is missing)."""
+    code = np.zeros(n, dtype=np.int64)
+    valid = np.ones(n, dtype=bool)
+    for cat in keys.values():
+        c = np.asarray(cat.codes, dtype=np.int64)
+        valid &= c >= 0
+        code = code * len(cat.categories) + c
+    code[~valid] = -1
+    # Compress to the combinations that occur
+    groups, inverse = np.unique(code[valid], return_inverse=True)
+    out = np.full(n, -1, dtype=np.int64)
+    out[valid] = inverse
+    table = {}
+    for name, cat in reversed(list(keys.items())):
+        k = len(cat.categories)
+        table[name] = np.asarray(cat.categories)[groups % k] if k else np.array([])
+        groups = groups // max(k, 1)
+    table = pd.DataFrame({name: table[name] for name in keys})
+    return out, table
+
+
+def _bin_index(x, edges):
+    # np.histogram convention: bins are [left, right) except the last, which includes its right edge
+    idx = np.searchsorted(edges, x, side='right') - 1
+    idx[x == edges[-1]] = len(edges) - 2
+    idx[~((x >= edges[0]) & (x <= edges[-1]))] = -1
+    return idx
+
+
+def _histogram_frame(table, var, spec, counts):
+    """Tidy (group, bin) rows for a (n_groups, n_bins) count array; see grouped_histograms."""
+    edges = bin_edges(spec)
+    n_groups, nb = counts.shape
+    n = counts.sum(axis=1, keepdims=True)
+    log_bins = isinstance(spec, tuple) and spec[0] == 'log'
+    center = np.sqrt(edges[:-1] * edges[1:]) if log_bins else 0.5 * (edges[:-1] + edges[1:])
+    width = np.diff(edges)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = counts / n
+    res = table.loc[np.repeat(np.arange(n_groups), nb)].reset_index(drop=True)
+    res['variable'] = var
+    res['bin'] = np.tile(np.arange(nb), n_groups)
+    res['left'] = np.tile(edges[:-1], n_groups)
+    res['right'] = np.tile(edges[1:], n_groups)
+    res['center'] = np.tile(center, n_groups)
+    res['width'] = np.tile(width, n_groups)
+    res['count'] = counts.ravel()
+    res['n'] = np.repeat(n.ravel(), nb)
+    res['fraction'] = fraction.ravel()
+    res['density'] = (fraction / width).ravel()
+    return res
+
+
+def grouped_histograms(df, by, bins, weights=None):
+    """
+    Histograms/PDFs of several variables for every group in one pass.
+
+    Rows are assigned one integer group code from the category codes of the keys, and each
+    variable's (group, bin) pairs are counted with a single bincount, instead of re-filtering the
+    frame for each group.
+
+    :param df: DataFrame of samples (e.g. from read_composites or query_store).
+    :param by: Group keys, see group_keys (e.g. ['block_label', 'cloud_regime', ('ATX', [-10, -5, 0])]).
+    :param bins: dict of variable -> bin spec (see bin_edges), e.g. {'WIC': ('lin', -3, 3, 19),
+                 'CONCD_RWIO': ('log', 0.1, 1000, 14)}.
+    :param weights: Optional column name of sample weights.
+
+    :return: Tidy DataFrame with one row per (group, variable, bin): the key columns, variable,
+             bin, left, right, center (geometric for log bins), width, count, n (in-range samples of
+             the group and variable), fraction = count / n and density = fraction / width.
+    """
+    keys = group_keys(df, by)
+    codes, table = _combined_codes(keys, len(df))
+    n_groups = len(table)
+    w = None if weights is None else df[weights].to_numpy(dtype=float)
+
+    out = []
+    for var, spec in bins.items():
+        edges = bin_edges(spec)
+        nb = len(edges) - 1
+        b = _bin_index(df[var].to_numpy(dtype=float), edges)
+        ok = (codes >= 0) & (b >= 0)
+        flat = codes[ok] * nb + b[ok]
+        counts = np.bincount(flat, weights=None if w is None else w[ok],
+                             minlength=n_groups * nb).reshape(n_groups, nb)
+        res = _histogram_frame(table, var, spec, counts)
+        out.append(res)
+    return pd.concat(out, ignore_index=True)
+
+
+def map_density(df, by=('block_label', 'cloud_regime'), res=1.0, extent=None, lon_bins=None, lat_bins=None,
+                lon_col='GGLON', lat_col='GGLAT', weights=None):
+    """
+    Bin samples onto a lat/lon raster for every group in one pass, for campaign-wide maps whose
+    drawing cost does not depend on the number of samples.
+
+    :param df: DataFrame of samples (e.g. from read_composites or query_store).
+    :param by: Group keys, see group_keys; empty for a single all-samples group.
+    :param res: Cell size (degrees) when lon_bins / lat_bins are not given.
+    :param extent: [lon_min, lon_max, lat_min, lat_max] of the raster (as for cartopy set_extent);
+                   defaults to the data range.
+    :param lon_bins, lat_bins: Bin specs (see bin_edges) overriding res / extent.
+    :param weights: Optional column name of sample weights.
+
+    :return: dict with
+             'lon_edges', 'lat_edges': cell edges (pcolormesh X / Y),
+             'groups': DataFrame of the key values of each group,
+             'counts': (n_groups, n_lat, n_lon) sample counts (or weight sums),
+             'total': (n_lat, n_lon) counts over all groups,
+             'fraction': counts / total per cell (NaN in empty cells), e.g. for pie / fraction overlays,
+             'dominant': (n_lat, n_lon) index of the group with the most samples per cell (-1 if empty).
+    """
+    lon = df[lon_col].to_numpy(dtype=float)
+    lat = df[lat_col].to_numpy(dtype=float)
+    if extent is None:
+        extent = [np.nanmin(lon), np.nanmax(lon), np.nanmin(lat), np.nanmax(lat)]
+    if lon_bins is None:
+        lon_bins = np.arange(np.floor(extent[0] / res) * res, extent[1] + res, res)
+    if lat_bins is None:
+        lat_bins = np.arange(np.floor(extent[2] / res) * res, extent[3] + res, res)
+    lon_edges, lat_edges = bin_edges(lon_bins), bin_edges(lat_bins)
+    n_lon, n_lat = len(lon_edges) - 1, len(lat_edges) - 1
+
+    if by:
+        codes, table = _combined_codes(group_keys(df, by), len(df))
+    else:
+        codes, table = np.zeros(len(df), dtype=np.int64), pd.DataFrame(index=[0])
+    n_groups = len(table)
+
+    i = _bin_index(lat, lat_edges)
+    j = _bin_index(lon, lon_edges)
+    ok = (codes >= 0) & (i >= 0) & (j >= 0)
+    flat = (codes[ok] * n_lat + i[ok]) * n_lon + j[ok]
+    w = None if weights is None else df[weights].to_numpy(dtype=float)[ok]
+    counts = np.bincount(flat, weights=w, minlength=n_groups * n_lat * n_lon).reshape(n_groups, n_lat, n_lon)
+
+    total = counts.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = counts / total
+    dominant = np.where(total > 0, np.argmax(counts, axis=0), -1) if n_groups else np.full(total.shape, -1)
+    return {'lon_edges': lon_edges, 'lat_edges': lat_edges, 'groups': table, 'counts': counts,
+            'total': total, 'fraction': fraction, 'dominant': dominant}
+
+
+def _profile_frame(df, variables, by, alt_col, block_label, z_bins, log, block_keys):
+    """Group keys, block keys, per-block z_norm bin and (log10) values of the profile samples."""
+    if block_label is not None:
+        df = df[df['block_label'].isin(_as_list(block_label))]
+    block_keys = [k for k in block_keys if k in df.columns]
+    edges = bin_edges(z_bins)
+
+    alt = df.groupby(block_keys, sort=False, observed=True)[alt_col]
+    lo, hi = alt.transform('min').to_numpy(), alt.transform('max').to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z_norm = (df[alt_col].to_numpy(dtype=float) - lo) / (hi - lo)
+    z_bin = _bin_index(z_norm, edges)
+
+    values = df[list(variables)].astype(float)
+    if log:
+        values = np.log10(values.where(values > 0))
+    keys = group_keys(df, by)
+    frame = pd.DataFrame(keys, index=df.index)
+    frame[[f"_{k}" for k in block_keys]] = df[block_keys]
+    frame['z_bin'] = z_bin
+    frame = pd.concat([frame, values], axis=1)[z_bin >= 0]
+    return frame, list(keys), [f"_{k}" for k in block_keys], edges
+
+
+def composite_profiles(df, variables, by=('cloud_regime',), alt_col='GGALT', block_label='In-Cloud Profiles',
+                       z_bins=('lin', 0, 1, 10), log=True, quantiles=(0.25, 0.5, 0.75),
+                       block_keys=('flight', 'block_label', 'block_index')):
+    """
+    Normalized-height composite profiles of several variables, for all groups at once.
+
+    Each block's altitude is normalized to z_norm = (z - z_min) / (z_max - z_min) using that block's
+    own min/max (one grouped transform), then mean/std/count and quantiles of every variable are
+    computed per (group, z_norm bin) in one grouped reduction.
+
+    :param df: DataFrame of samples, already filtered to valid in-cloud samples (e.g. Nd > 10, LWC > 0.001).
+    :param variables: List of columns to composite, e.g. ['CONCD_RWIO', 'PLWCD_RWIO'].
+    :param by: Group keys, see group_keys (e.g. ['cloud_regime', ('ATX', [0, 10, 20])]).
+    :param alt_col: Altitude column.
+    :param block_label: Block label(s) to use; None keeps all rows.
+    :param z_bins: Bin spec for z_norm (see bin_edges).
+    :param log: Composite log10 of the variables (non-positive values are dropped).
+    :param quantiles: Quantiles to report, as columns q25, q50, ...
+    :param block_keys: Columns identifying a block.
+
+    :return: Tidy DataFrame with the key columns, variable, z_bin, z_center, mean, std, count and
+             the quantile columns (in log10 units if log).
+    """
+    frame, key_cols, _, edges = _profile_frame(df, variables, by, alt_col, block_label, z_bins, log, block_keys)
+    long = frame.melt(id_vars=key_cols + ['z_bin'], value_vars=list(variables), var_name='variable')
+    long = long[long['value'].notna()]
+    grouped = long.groupby(key_cols + ['variable', 'z_bin'], observed=True)['value']
+    stats = grouped.agg(['mean', 'std', 'count'])
+    if quantiles:
+        q = grouped.quantile(list(quantiles)).unstack()
+        q.columns = [f"q{round(100 * p):d}" for p in q.columns]
+        stats = stats.join(q)
+    stats = stats.reset_index()
+    stats.insert(stats.columns.get_loc('z_bin') + 1, 'z_center',
+                 0.5 * (edges[:-1] + edges[1:])[stats['z_bin'].to_numpy()])
+    return stats
+
+
+def load_sketches(sketch_paths):
+    """
+    Read sketch files written by write_RF_sketches.
+
+    :return: List of (campaign, flight, block_label, cloud_regime, count, {variable: digest}).
+    """
+    groups = []
+    for path in sketch_paths:
+        with open(path) as f:
+            doc = json.load(f)
+        for g in doc['groups']:
+            digests = {var: sk.digest_from_dict(d) for var, d in g['digests'].items()}
+            groups.append((doc['campaign'], doc['flight'], g['block_label'], g['cloud_regime'], g['count'], digests))
+    return groups
+
+
+def sketch_quantiles(sketch_paths, variables, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95),
+                     by=('block_label', 'cloud_regime'), campaign=None, flight=None, block_label=None,
+                     cloud_regime=None):
+    """
+    Quantiles per group from merged per-flight sketches, without reading any samples.
+
+    :param sketch_paths: Sketch JSON files (one per flight, from write_RF_nc/write_RF_sketches).
+    :param variables: Variables to report.
+    :param quantiles: Quantiles to report, as columns q5, q25, ...
+    :param by: Any of 'campaign', 'flight', 'block_label', 'cloud_regime' to group by; the sketches
+               of everything else are merged (e.g. by=('cloud_regime',) merges all flights and labels).
+    :param campaign, flight, block_label, cloud_regime: Value or list of values to keep.
+
+    :return: DataFrame with the by columns, variable, count and one column per quantile.
+    """
+    fields = ('campaign', 'flight', 'block_label', 'cloud_regime')
+    wanted = dict(zip(fields, (campaign, flight, block_label, cloud_regime)))
+    merged = {}
+    for group in load_sketches(sketch_paths):
+        keyvals = dict(zip(fields, group[:4]))
+        if any(v is not None and keyvals[f] not in _as_list(v) for f, v in wanted.items()):
+            continue
+        key = tuple(keyvals[f] for f in by)
+        for var in variables:
+            if var in group[5]:
+                merged.setdefault((key, var), []).append(group[5][var])
+
+    rows = []
+    for (key, var), digests in merged.items():
+        digest = sk.merge_digests(digests)
+        row = dict(zip(by, key))
+        row['variable'] = var
+        row['count'] = sk.digest_count(digest)
+        row.update({f"q{round(100 * q):d}": v for q, v in zip(quantiles, sk.digest_quantile(digest, quantiles))})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def _block_units(keys, blocks):
+    """
+    Codes of the (group, block) resampling units, and of the group each unit belongs to.
+
+    :param keys: Group keys (from group_keys).
+    :param blocks: List of per-row columns identifying a block.
+
+    :return: unit code per row, group code per unit, and the group key table.
+    """
+    unit_keys = dict(keys)
+    unit_keys.update({f"_block{i}": pd.Categorical(col) for i, col in enumerate(blocks)})
+    unit_codes, unit_table = _combined_codes(unit_keys, len(unit_keys[next(iter(unit_keys))]))
+    group_codes, table = _combined_codes({k: pd.Categorical(unit_table[k]) for k in keys}, len(unit_table))
+    return unit_codes, group_codes, table
+
+
+def _bootstrap_weights(group_codes, n_groups, n_boot, rng):
+    """
+    Per group, an (n_boot, n_units) matrix of multinomial block counts: each row is one resample of
+    the group's blocks with replacement.
+    """
+    weights = []
+    for g in range(n_groups):
+        units = np.flatnonzero(group_codes == g)
+        B = len(units)
+        weights.append((units, rng.multinomial(B, np.full(B, 1.0 / B), size=n_boot).astype(float)))
+    return weights
+
+
+def bootstrap_histograms(df, by, bins, n_boot=1000, ci=95, block_keys=('flight', 'block_label', 'block_index'),
+                         seed=None):
+    """
+    Block-bootstrap confidence intervals for grouped histograms/PDFs.
+
+    Samples within a block are autocorrelated, so whole blocks are resampled. Each block's
+    histogram is computed once; a replicate is then a multinomially weighted sum of the group's
+    block histograms, so all replicates are one matrix multiply per group and variable.
+
+    :param df: DataFrame of samples with the block_keys columns.
+    :param by, bins: As in grouped_histograms.
+    :param n_boot: Number of bootstrap replicates.
+    :param ci: Confidence level in percent.
+    :param block_keys: Columns identifying a block (the resampling unit).
+    :param seed: Random seed.
+
+    :return: grouped_histograms output plus n_blocks, density_lo, density_hi and density_se.
+    """
+    rng = np.random.default_rng(seed)
+    keys = group_keys(df, by)
+    unit_codes, group_codes, table = _block_units(keys, [df[k] for k in block_keys if k in df.columns])
+    n_units, n_groups = len(group_codes), len(table)
+    weights = _bootstrap_weights(group_codes, n_groups, n_boot, rng)
+    pct = [(100 - ci) / 2, 100 - (100 - ci) / 2]
+
+    out = []
+    for var, spec in bins.items():
+        edges = bin_edges(spec)
+        nb, width = len(edges) - 1, np.diff(edges)
+        b = _bin_index(df[var].to_numpy(dtype=float), edges)
+        ok = (unit_codes >= 0) & (b >= 0)
+        H = np.bincount(unit_codes[ok] * nb + b[ok], minlength=n_units * nb).reshape(n_units, nb).astype(float)
+
+        counts = np.zeros((n_groups, nb))
+        np.add.at(counts, group_codes, H)
+        lo, hi, se = (np.full((n_groups, nb), np.nan) for _ in range(3))
+        for g, (units, W) in enumerate(weights):
+            rep = W @ H[units]                                   # (n_boot, nb)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                dens = rep / rep.sum(axis=1, keepdims=True) / width
+            lo[g], hi[g] = np.nanpercentile(dens, pct, axis=0)
+            se[g] = np.nanstd(dens, axis=0)
+
+        res = _histogram_frame(table, var, spec, counts)
+        res['n_blocks'] = np.repeat(np.bincount(group_codes, minlength=n_groups), nb)
+        res['density_lo'] = lo.ravel()
+        res['density_hi'] = hi.ravel()
+        res['density_se'] = se.ravel()
+        out.append(res)
+    return pd.concat(out, ignore_index=True)
+
+
+def bootstrap_profiles(df, variables, by=('cloud_regime',), n_boot=1000, ci=95, alt_col='GGALT',
+                       block_label='In-Cloud Profiles', z_bins=('lin', 0, 1, 10), log=True,
+                       block_keys=('flight', 'block_label', 'block_index'), seed=None):
+    """
+    Block-bootstrap confidence intervals for composite_profiles means.
+
+    Per-block sums and counts in each z_norm bin are computed once; a replicate mean is
+    (W @ sums) / (W @ counts) with W the multinomial block weights of the group.
+
+    :return: DataFrame with the key columns, variable, z_bin, z_center, mean, n_blocks, mean_lo,
+             mean_hi and mean_se (in log10 units if log).
+    """
+    rng = np.random.default_rng(seed)
+    frame, key_cols, block_cols, edges = _profile_frame(df, variables, by, alt_col, block_label, z_bins,
+                                                        log, block_keys)
+    keys = {k: pd.Categorical(frame[k]) for k in key_cols}
+    unit_codes, group_codes, table = _block_units(keys, [frame[c] for c in block_cols])
+    n_units, n_groups = len(group_codes), len(table)
+    nz = len(edges) - 1
+    weights = _bootstrap_weights(group_codes, n_groups, n_boot, rng)
+    pct = [(100 - ci) / 2, 100 - (100 - ci) / 2]
+    z_bin = frame['z_bin'].to_numpy()
+
+    out = []
+    for var in variables:
+        x = frame[var].to_numpy(dtype=float)
+        ok = (unit_codes >= 0) & np.isfinite(x)
+        flat = unit_codes[ok] * nz + z_bin[ok]
+        S = np.bincount(flat, weights=x[ok], minlength=n_units * nz).reshape(n_units, nz)
+        N = np.bincount(flat, minlength=n_units * nz).reshape(n_units, nz).astype(float)
+
+        mean, lo, hi, se = (np.full((n_groups, nz), np.nan) for _ in range(4))
+        for g, (units, W) in enumerate(weights):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean[g] = S[units].sum(axis=0) / N[units].sum(axis=0)
+                rep = (W @ S[units]) / (W @ N[units])
+            lo[g], hi[g] = np.nanpercentile(rep, pct, axis=0)
+            se[g] = np.nanstd(rep, axis=0)
+
+        res = table.loc[np.repeat(np.arange(n_groups), nz)].reset_index(drop=True)
+        res['variable'] = var
+        res['z_bin'] = np.tile(np.arange(nz), n_groups)
+        res['z_center'] = np.tile(0.5 * (edges[:-1] + edges[1:]), n_groups)
+        res['mean'] = mean.ravel()
+        res['n_blocks'] = np.repeat(np.bincount(group_codes, minlength=n_groups), nz)
+        res['mean_lo'] = lo.ravel()
+        res['mean_hi'] = hi.ravel()
+        res['mean_se'] = se.ravel()
+        out.append(res[np.isfinite(res['mean'])])
+    return pd.concat(out, ignore_index=True)
+
+
+def read_block_summaries(summary_paths, campaign=None, flight=None, block_label=None, cloud_regime=None,
+                         where=None, columns=None):
+    """
+    Read and filter the per-block summary tables written alongside write_RF_nc.
+
+    :param summary_paths: *_blocks.parquet files.
+    :param campaign, flight, block_label, cloud_regime: Value or list of values to keep.
+    :param where: Predicate string(s) on summary columns, e.g. "ATX_mean > -5".
+    :param columns: Summary columns to return (the key columns are always included).
+
+    :return: DataFrame with one row per block.
+    """
+    frames = [pd.read_parquet(path) for path in summary_paths]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    keep = select_blocks(df, campaign, flight, block_label).index
+    df = df.loc[keep]
+    df = df[_row_mask(df, parse_where(where), None if cloud_regime is None else _as_list(cloud_regime))]
+    if columns is not None:
+        key_cols = [c for c in ('campaign', 'flight', 'block_label', 'block_index') if c in df.columns]
+        df = df[key_cols + [c for c in _as_list(columns) if c not in key_cols]]
+    return df.reset_index(drop=True)
@@ -1,4 +1,5 @@
 import pathlib as path
+import os
 import pandas as pd
 import numpy as np
 import xarray as xr
@@ -9,6 +10,70 @@ import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.animation import FuncAnimation  
+import process_data_products_utils as pdp
+
+
+def cesm_pressure(cesm, mid=True):
+    """
+    Pressure of the CESM hybrid levels, p = P0 * hya + hyb * PS, in hPa.
+
+    :param cesm: CESM history Dataset with P0, PS and the hybrid coefficients.
+    :param mid: Use layer midpoints (hyam, hybm) instead of interfaces (hyai, hybi).
+    """
+    hya, hyb = (cesm.hyam, cesm.hybm) if mid else (cesm.hyai, cesm.hybi)
+    return (cesm.P0 * hya + hyb * cesm.PS) * 0.01
+
+
+def cesm_times(cesm):
+    """CESM (cftime) times as pandas Timestamps."""
+    return pd.to_datetime([pd.Timestamp(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+                           for dt in cesm.time.values])
+
+
+# Sonde comparison variables: label -> CESM variable
+CESM_SONDE_VARS = {'T': 'T', 'Q': 'Q', 'U': 'U', 'V': 'V', 'R': 'RELHUM'}
+
+
+def collocate_sondes_CESM(track, cesm, label='CESM', variables=CESM_SONDE_VARS):
+    """
+    Collocate every sonde level with CESM model columns in one vectorized pass.
+
+    Each level gets the nearest model time and grid column; the midpoint hybrid-pressure columns
+    (cesm_pressure) and variable columns are pulled for all levels with one indexing call per
+    variable from the (loaded) time/lat/lon subset spanned by the sondes, and interpolated
+    log-linearly to the sonde pressures.
+
+    :param track: Sonde track (process_data_products_utils.sonde_track), with GGLAT, GGLON, PSXC, Time.
+    :param cesm: CESM history Dataset (Free or Nudged) with T, PS, hyam, hybm, P0.
+    :param label: Column prefix, e.g. 'CESM_Free' or 'CESM_Nudg'.
+    :param variables: dict of output name -> CESM variable (missing variables are skipped).
+
+    :return: `track` with <label>_<var> and d<var>_<label> columns per level, plus per-level
+             <label>_SSTK (TS) and <label>_VAR_2T (TREFHT) when the history file has them.
+    """
+    lat, lon = cesm.lat.values, cesm.lon.values
+    t_ns = cesm_times(cesm).values.astype('datetime64[ns]').view('int64')
+    ti = pdp.nearest_time_indices(t_ns, track['Time'].values.astype('datetime64[ns]').view('int64'))
+    yi = np.abs(lat[None, :] - track['GGLAT'].values[:, None]).argmin(axis=1)
+    lon_diff = (lon[None, :] - (track['GGLON'].values[:, None] % 360) + 180) % 360 - 180
+    xi = np.abs(lon_diff).argmin(axis=1)
+
+    # Load only the box the sondes span
+    box = {'time': slice(ti.min(), ti.max() + 1), 'lat': slice(yi.min(), yi.max() + 1),
+           'lon': slice(xi.min(), xi.max() + 1)}
+    sub = cesm.isel(**box)
+    ti, yi, xi = ti - ti.min(), yi - yi.min(), xi - xi.min()
+
+    p_cols = cesm_pressure(sub).transpose('time', 'lev', 'lat', 'lon').values[ti, :, yi, xi]   # (N, L)
+    p_target = track['PSXC'].values.astype(float)
+    for name, var in variables.items():
+        if var in sub:
+            cols = sub[var].transpose('time', 'lev', 'lat', 'lon').values[ti, :, yi, xi]
+            track[f"{label}_{name}"] = pdp.interp_log_pressure(p_cols, cols, p_target)
+    for name, var in (('SSTK', 'TS'), ('VAR_2T', 'TREFHT')):
+        if var in sub:
+            track[f"{label}_{name}"] = sub[var].transpose('time', 'lat', 'lon').values[ti, yi, xi]
+    return pdp.sonde_differences(track, label)
 
 
 def grid_flight(cesm: xr.open_dataset, cesm_dat: xr.open_dataset, df: pd.DataFrame) -> dict:    
@@ -18,15 +83,8 @@ def grid_flight(cesm: xr.open_dataset, cesm_dat: xr.open_dataset, df: pd.DataFra
     lon_var = next((var for var in df.columns if 'GGLON' in var), None)
     alt_var = next((var for var in df.columns if 'GGALT' in var or 'PSXC' in var), None)
 
-    # Compute pressure altitude (palt) from CESM hybrid coordinates
-    p0 = cesm.P0  # Reference pressure
-    ps = cesm.PS  # Surface pressure [=] Pa
-    hyai = cesm.hyai  # Hybrid A coefficient at layer interface
-    hybi = cesm.hybi  # Hybrid B coefficient at layer interface
-    
-    P_dummy = p0 * hyai
-    midP = (P_dummy + (hybi * ps))  # [=] Pa
-    palt = midP * 0.01  # Convert to hPa
+    # Compute pressure altitude (palt) from CESM hybrid coordinates (layer interfaces)
+    palt = cesm_pressure(cesm, mid=False)  # [=] hPa
     
     df_vars = [col for col in df.columns if col.lower() != 'time']
     
@@ -197,8 +255,57 @@ def grid_flight(cesm: xr.open_dataset, cesm_dat: xr.open_dataset, df: pd.DataFra
     return grid_dict, grid, bounds
 
 
-def plot_3d_track(grid_data,df):
+def decimate_track(df, max_points=5000, cols=('GGLON', 'GGLAT', 'PSXC')):
+    """
+    Shape-preserving decimation of a flight track to a point budget (Douglas-Peucker, refined
+    greedily: the segment whose farthest interior point deviates most from its chord is split first,
+    until max_points are kept). Distances are measured in cols, each scaled by its range.
+
+    :param df: Flight DataFrame in time order.
+    :param max_points: Number of samples to keep (at least 2: the first and last are always kept).
+    :param cols: Coordinates the shape is preserved in.
+
+    :return: df rows to keep (time order). Rows with a missing value in cols are always dropped;
+             if the other rows already fit the budget, all of them are returned.
 
+    :raises ValueError: If max_points < 2.
+    """
+    import heapq
+
+    if max_points < 2:
+        raise ValueError(f"max_points must be at least 2, got {max_points}")
+    valid = df[list(cols)].notna().all(axis=1).to_numpy()
+    if valid.sum() <= max_points:
+        return df[valid]
+    xyz = df.loc[valid, list(cols)].to_numpy(dtype=float)
+    span = np.ptp(xyz, axis=0)
+    xyz = xyz / np.where(span > 0, span, 1)
+
+    def farthest(i, j):
+        # Farthest point of xyz[i+1:j] from the segment xyz[i] -> xyz[j]
+        if j - i < 2:
+            return 0.0, -1
+        p, a, b = xyz[i + 1:j], xyz[i], xyz[j]
+        ab = b - a
+        t = np.clip((p - a) @ ab / max(ab @ ab, 1e-300), 0, 1)
+        d = np.sum((p - a - t[:, None] * ab) ** 2, axis=1)
+        k = int(np.argmax(d))
+        return d[k], i + 1 + k
+
+    n = len(xyz)
+    keep = [0, n - 1]
+    d, k = farthest(0, n - 1)
+    heap = [(-d, 0, n - 1, k)]
+    while heap and len(keep) < max_points:
+        d, i, j, k = heapq.heappop(heap)
+        keep.append(k)
+        for lo, hi in ((i, k), (k, j)):
+            d, m = farthest(lo, hi)
+            if m >= 0:
+                heapq.heappush(heap, (-d, lo, hi, m))
+    return df[valid].iloc[np.sort(keep)]
+
+def _track_figure(grid_data, df):
     # Create a figure
     fig = plt.figure(figsize=(8, 8))
     ax = fig.add_subplot(111, projection='3d')
@@ -216,19 +323,82 @@ def plot_3d_track(grid_data,df):
     ax.legend()
     # # Color bar to show the mapping of color to the fourth dimension
     plt.colorbar(sc, label='Mean Temperature (°C)')
+    return fig, ax
 
+def _track_animation(fig, ax):
     # Animation function to rotate the view
     def rotate(angle):
         ax.view_init(elev=30, azim=angle)
 
-    # Create animation
-    ani = FuncAnimation(fig, rotate, frames=np.arange(-180, 360, 20), interval=100)
+    return FuncAnimation(fig, rotate, frames=np.arange(-180, 360, 20), interval=100)
+
+def save_track_animation(grid_data, df, out_path, fps=10, dpi=100):
+    """
+    Render the rotating 3-D track animation straight to a file with the Agg backend
+    (.gif with Pillow, .mp4 with ffmpeg). Meant to run in a worker process (see plot_3d_track).
+
+    :return: out_path
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import animation
+
+    ext = os.path.splitext(out_path)[1].lower()
+    if ext == '.gif':
+        writer = animation.PillowWriter(fps=fps)
+    elif animation.writers.is_available('ffmpeg'):
+        writer = animation.FFMpegWriter(fps=fps)
+    else:
+        raise ValueError(f"Cannot write {out_path}: ffmpeg is not available (use a .gif path)")
+    fig, ax = _track_figure(grid_data, df)
+    _track_animation(fig, ax).save(out_path, writer=writer, dpi=dpi)
+    plt.close(fig)
+    return out_path
+
+_ANIMATION_POOL = None
+
+def plot_3d_track(grid_data, df, max_points=5000, animate=True, out_path=None, fps=10, dpi=100):
+    """
+    3-D flight track (pressure vs lat/lon, coloured by ATX) with the grid-mean values, optionally
+    as a rotating animation. The track is decimated to max_points (decimate_track) so the
+    rendering cost does not grow with flight length or sample rate.
+
+    :param grid_data: Grid-mean values (GGLON, GGLAT, PSXC, ATX).
+    :param df: Flight data (GGLON, GGLAT, PSXC, ATX).
+    :param max_points: Track point budget (None draws every sample).
+    :param animate: Return the rotating animation as notebook HTML instead of the static figure.
+    :param out_path: Write the animation to this .gif/.mp4 file in a background worker process
+                     instead of drawing it here.
+    :param fps, dpi: Frame rate and resolution of the written animation.
+
+    :return: concurrent.futures.Future resolving to out_path when out_path is given, otherwise the
+             animation HTML (animate=True) or the figure.
+    """
+    global _ANIMATION_POOL
+
+    if max_points is not None:
+        df = decimate_track(df, max_points)
+    if out_path is not None:
+        from concurrent.futures import ProcessPoolExecutor
+
+        if _ANIMATION_POOL is None:
+            import atexit
+            _ANIMATION_POOL = ProcessPoolExecutor(max_workers=1)
+            atexit.register(_ANIMATION_POOL.shutdown)
+        grid = {k: np.asarray(grid_data[k]) for k in ('GGLON', 'GGLAT', 'PSXC', 'ATX')}
+        track = df[['GGLON', 'GGLAT', 'PSXC', 'ATX']].copy()
+        return _ANIMATION_POOL.submit(save_track_animation, grid, track, out_path, fps, dpi)
+
+    fig, ax = _track_figure(grid_data, df)
+    if not animate:
+        return fig
 
     # Show the animation in Jupyter Notebook
     from IPython.display import HTML
-    HTML(ani.to_jshtml())
-
-    plt.show()
+    ani = _track_animation(fig, ax)
+    html = HTML(ani.to_jshtml())
+    plt.close(fig)
+    return html
 
 def write_nc(grid_data, filename="test_grid_data.nc"):
     """
@@ -2,11 +2,15 @@ import netCDF4
 import pathlib as path
 import pandas as pd
 import numpy as np
+import io
 import os
+import re
 from datetime import datetime, timedelta
 from fnmatch import fnmatch
 from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor
 import xarray as xr
+import profiling_utils as prof
 
 def find_flight_fnames(dir_path: str) -> list[str]:
     """
@@ -323,6 +327,7 @@ def calc_concs_from_sd(sizedist_vars, nc):
     # time-align and return
     return pd.concat(cols, axis=1).sort_index()
 
+@prof.profiled()
 def load_flight_data(dir_path: str, idx: int = 0, add_sizedist: bool = True,
                      asof: bool = False, tol: str = "1s") -> pd.DataFrame:
     """
@@ -353,10 +358,10 @@ def load_flight_data(dir_path: str, idx: int = 0, add_sizedist: bool = True,
 
     # 3) join on time
     df2 = df.copy()
-    df2["Time"] = pd.to_datetime(df2["Time"]).dt.tz_localize(None).round("S")
+    df2["Time"] = pd.to_datetime(df2["Time"]).dt.tz_localize(None).dt.round("s")
 
     conc = conc_df.copy()
-    conc.index = pd.to_datetime(conc.index).tz_localize(None).round("S")
+    conc.index = pd.to_datetime(conc.index).tz_localize(None).round("s")
 
     if asof:
         # nearest match within tolerance (useful if clocks are off by <1s)
@@ -389,116 +394,185 @@ def find_sondes(dir_path: str) -> list[str]:
     
     return flight_paths
 
-def read_sonde2df(file_path):
+_CLS_NOMINAL = re.compile(rb"^.*Nominal Release Time.*$", re.M)
+_CLS_HEADER = re.compile(rb"^[ \t]*Time\b.*Press.*$", re.M)
+_CLS_NUMBER = re.compile(rb"[-+]?\.?\d")
+_CLS_SONDE_ID = re.compile(rb"Sonde Id[^:]*:[ \t]*([^/\r\n]*)")
+# Fields reading exactly 9999.0 (missing) are swapped for a sentinel before the float parse
+_CLS_MISSING = re.compile(rb"9999\.0(?<!\S9999\.0)(?!\S)")
+_CLS_SENTINEL = -99999999.0
+
+def parse_cls(file_path):
     """
-    Reads a `.cls` radiosonde file and extracts multiple datasets with their nominal release times.
+    Parse a `.cls` sonde file section by section without splitting lines in Python.
 
-    :param file_path: Path to the `.cls` file containing radiosonde data.
+    The file is read once as bytes; one pass of regular expressions locates every section's
+    "Nominal Release Time" line and its column header, and each section's rows (up to the next
+    "Nominal Release Time" line) are split into fields by the pandas C reader. As in the line-by-line parser, only rows
+    with one field per column are kept, rows with a field reading exactly "9999.0" (missing) are
+    dropped, and the fields are then converted to numbers (non-numeric fields become NaN).
+
+    :param file_path: Path to the `.cls` file.
+
+    :return: List of (metadata dict with 'sonde_id' and 'drop_time', DataFrame) per section.
 
-    :return: A tuple containing:
-        - A list of Pandas DataFrames, each representing an individual radiosonde dataset.
-        - A list of corresponding nominal release times as Pandas Timestamps.
-    
     :raises FileNotFoundError: If the file does not exist.
-    :raises ValueError: If the file is incorrectly formatted or missing essential data.
+    :raises ValueError: If the file has no "Nominal Release Time" entries.
     """
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File '{file_path}' not found.")
+    with open(file_path, "rb") as file:
+        raw = file.read()
 
-    # Read the entire file into memory
-    with open(file_path, "r", encoding="utf-8") as file:
-        lines = file.readlines()
-
-    # Identify all "Nominal Release Time" occurrences
-    start_indices = [i for i, line in enumerate(lines) if "Nominal Release Time" in line]
-    
-    if not start_indices:
+    starts = [m.start() for m in _CLS_NOMINAL.finditer(raw)]
+    if not starts:
         raise ValueError(f"No 'Nominal Release Time' entries found in file: {file_path}")
 
-    datasets = []
-    drop_times = []
-    # Process each radiosonde dataset
-    for idx, start in enumerate(start_indices):
-        # Find the start of the tabular data
-        data_start = None
-        for i in range(start, len(lines) - 2):
-            if lines[i].strip().startswith("Time") and "Press" in lines[i]:  # Detect header row
-                data_start = i + 3  # Data starts 2 lines after the column names
-                break
-
-        if data_start is None:
-            print(f"Warning: No data start found for entry at line {start}")
-            continue  # Skip this dataset
-
-        # Extract and convert nominal release time
+    sections = []
+    prev_end = 0
+    for k, start in enumerate(starts):
+        line_end = raw.find(b"\n", start)
+        line = raw[start:line_end if line_end >= 0 else len(raw)].decode("utf-8", "replace")
+        header = _CLS_HEADER.search(raw, start)
+        next_start = starts[k + 1] if k + 1 < len(starts) else len(raw)
+        if header is None or header.start() > next_start:
+            print(f"Warning: No data start found for entry at byte {start}")
+            continue
         try:
-            date_time_str = lines[start].split("):")[1].strip()
-            drop_time = pd.to_datetime(date_time_str, format='%Y, %m, %d, %H:%M:%S')
+            drop_time = pd.to_datetime(line.split("):")[1].strip(), format='%Y, %m, %d, %H:%M:%S')
         except (IndexError, ValueError) as e:
-            print(f"Warning: Failed to parse drop time at line {start}: {e}")
-            continue  # Skip this dataset
-
-        drop_times.append(drop_time)
+            print(f"Warning: Failed to parse drop time at byte {start}: {e}")
+            continue
+
+        columns = header.group(0).decode().split()
+        # Data starts 2 lines after the column names (units and dashes) and runs to the next
+        # "Nominal Release Time" line (or end of file)
+        data_start = header.end()
+        for _ in range(3):
+            data_start = raw.find(b"\n", data_start) + 1 or len(raw)
+        data_start, data_end = _cls_block_bounds(raw, data_start, next_start, len(columns))
+
+        sonde = _CLS_SONDE_ID.search(raw, prev_end, start)
+        sonde_id = sonde.group(1).decode().strip() if sonde else \
+            f"{os.path.basename(file_path)}#{len(sections)}"
+        prev_end = data_end
+
+        if data_end <= data_start:
+            print(f"Warning: Empty dataset at byte {start}")
+            continue
+        df = _parse_cls_block(raw[data_start:data_end], columns)
+        if df.empty:
+            print(f"Warning: Empty dataset at byte {start}")
+            continue
+        sections.append(({"sonde_id": sonde_id, "drop_time": drop_time}, df))
+    return sections
 
-        # Extract column names
-        columns = lines[data_start - 3].strip().split()
+def _cls_block_bounds(raw, start, end, n_cols):
+    """
+    Trim raw[start:end] to the rows the C reader can take as they are: leading lines with more
+    than `n_cols` fields (the reader would turn the extra fields into an index instead of skipping
+    the row) and trailing lines that are not data rows, i.e. the next section's preamble. Only
+    lines the row rule drops anyway are removed.
+    """
+    while start < end:
+        line_end = raw.find(b"\n", start, end)
+        line_end = end if line_end < 0 else line_end + 1
+        if len(raw[start:line_end].split()) <= n_cols:
+            break
+        start = line_end
+    while end > start:
+        line_start = raw.rfind(b"\n", start, end - 1) + 1 or start
+        fields = raw[line_start:end].split()
+        if (fields and _CLS_NUMBER.match(fields[0])) or len(fields) == n_cols:
+            break
+        end = line_start
+    return start, end
+
+def _parse_cls_block(block, columns):
+    """
+    Parse the numeric block of one `.cls` section like the line-by-line parser: keep rows with one
+    field per column, drop rows with a field reading exactly "9999.0" and convert the fields to
+    floats (non-numeric fields become NaN).
+    """
+    kw = dict(sep=r"\s+", header=None, names=columns, index_col=False, engine="c", on_bad_lines="skip")
+    # Fast path: mark the "9999.0" fields with a sentinel and parse straight to floats. Only taken
+    # when no field came back NaN (short rows, NA-like strings) and the sentinels add up.
+    marked, n_missing = _CLS_MISSING.subn(b"%d" % _CLS_SENTINEL, block)
+    try:
+        values = pd.read_csv(io.BytesIO(marked), dtype=float, **kw).to_numpy()
+    except ValueError:
+        values = None
+    if (values is not None and not np.isnan(values).any()
+            and (values == _CLS_SENTINEL).sum() == n_missing):
+        values = values[(values != _CLS_SENTINEL).all(axis=1)]
+    else:
+        fields = pd.read_csv(io.BytesIO(block), dtype=str, na_filter=False, **kw).to_numpy(dtype=object)
+        # Short rows come back padded with empty fields
+        fields = fields[(fields[:, -1] != "") & (fields != "9999.0").all(axis=1)]
+        values = pd.DataFrame(fields).apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    return pd.DataFrame(values, columns=columns)
 
-        # Determine dataset end (next "Nominal Release Time" or end of file)
-        end = start_indices[idx + 1] if idx + 1 < len(start_indices) else len(lines)
+def read_sonde2df(file_path):
+    """
+    Reads a `.cls` radiosonde file and extracts multiple datasets with their nominal release times.
 
-        # Extract and clean data
-        data_lines = [line.strip().split() for line in lines[data_start:end]]
-        data = [row for row in data_lines if len(row) == len(columns)]
+    :param file_path: Path to the `.cls` file containing radiosonde data.
 
-        # Convert to DataFrame
-        df = pd.DataFrame(data, columns=columns)
+    :return: A list of Pandas DataFrames, each representing an individual radiosonde dataset,
+        with the nominal release time in df.attrs["drop_time"] and the sonde id in df.attrs["sonde_id"].
 
-        if df.empty:
-            print(f"Warning: Empty dataset at line {start}")
-            continue  # Skip empty datasets
-
-        # Remove rows containing 9999.0 in any column
-        df = df[(df != "9999.0").all(axis=1)]
-        # Convert numeric columns where possible
-        df = df.apply(pd.to_numeric, errors='coerce')
-        # Store drop time in DataFrame metadata
-        df.attrs["drop_time"] = drop_time
-        # Append dataset
+    :raises FileNotFoundError: If the file does not exist.
+    :raises ValueError: If the file is incorrectly formatted or missing essential data.
+    """
+    datasets = []
+    for meta, df in parse_cls(file_path):
+        df.attrs.update(meta)
         datasets.append(df)
-
     return datasets
 
+def read_sondes(file_paths, max_workers=None):
+    """
+    Parse many `.cls` files concurrently into one long table.
+
+    :param file_paths: Iterable of `.cls` paths (e.g. from find_sondes).
+    :param max_workers: Number of parser threads (default: ThreadPoolExecutor's default).
+
+    :return: DataFrame with sonde_id, release_time and file columns followed by the sonde columns,
+        one row per sonde level.
+    """
+    file_paths = list(file_paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        parsed = list(pool.map(parse_cls, file_paths))
+
+    frames = []
+    for path, sections in zip(file_paths, parsed):
+        for meta, df in sections:
+            df.insert(0, "file", os.path.basename(path))
+            df.insert(0, "release_time", meta["drop_time"])
+            df.insert(0, "sonde_id", meta["sonde_id"])
+            frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=["sonde_id", "release_time", "file"])
+    return pd.concat(frames, ignore_index=True)
+
 def load_nc_cldrgme(file_paths):
+    """
+    Load flat composite files written by write_RF_nc into one DataFrame, block after block.
+
+    For filtered or column-subset reads use composite_utils.read_composites, which only reads the
+    matching blocks and columns.
+
+    :param file_paths: List of composite NetCDF paths.
 
-    combined_blocks = []   
+    :return: DataFrame of all samples with block_label and block_index columns.
+    """
+    frames = []
     for path in file_paths:
-        rf = path.split("/")[-1].split(".")[0]  # e.g., "RF01"
-        ds = xr.open_dataset(path)
-        
-        # Get unique combinations
-        labels = ds["block_label"].values
-        indices = ds["block_index"].values
-        
-        # Convert to DataFrame for convenient filtering
-        df = ds.to_dataframe().reset_index().drop(columns="index")  # remove redundant index
-        
-        # Get all unique (label, index) pairs
-        unique_blocks = df[["block_label", "block_index"]].drop_duplicates()
-        
-        # Loop through each unique block
-        for _, row in unique_blocks.iterrows():
-            label = row["block_label"]
-            idx = row["block_index"]
-        
-            # Filter DataFrame
-            df_block = df[(df["block_label"] == label) & (df["block_index"] == idx)].copy()
-        
-            # (Optional) add flight ID if you have it
-            df_block["block_label"] = label
-            df_block["block_index"] = idx
-        
-            combined_blocks.append(df_block)
-        all_blocks = pd.concat(combined_blocks, ignore_index=True)
-    return all_blocks
+        with xr.open_dataset(path) as ds:
+            df = ds.to_dataframe().reset_index(drop=True)  # remove redundant index
+        # Keep the blocks grouped in order of first appearance
+        key = pd.factorize(pd.MultiIndex.from_frame(df[["block_label", "block_index"]]))[0]
+        frames.append(df.iloc[np.argsort(key, kind="stable")])
+    return pd.concat(frames, ignore_index=True)
 # if __name__ == "__main__":
 #     inform_utils.()
@@ -1,14 +1,28 @@
 import pandas as pd
 import numpy as np
 import inform_utils as inform
+import sketch_utils as sk
+import profiling_utils as prof
 import glob
+import itertools
+import json
+import os
+import re
+import shutil
+import time as _time
+import urllib.parse
+import yaml
 import xarray as xr
+import netCDF4
 import datetime
 from scipy.spatial import cKDTree
 from datetime import time
 from tqdm.notebook import tqdm, trange
 
-def assign_flight_type(df):
+@prof.profiled()
+def assign_flight_type(df, window=10, std_thresh=3, min_level_s=150, gap_merge_s=120,
+                       min_cloud_depth=30, alt_merge_gap=200, lwc_thresh=0.001, concd_thresh=10,
+                       cache=None):
     """
     Assigns flight type ('level' or 'profile') to each row of the input DataFrame based on stable altitude blocks 
     and gaps between these blocks. The function uses rolling standard deviation of altitude to identify level legs
@@ -21,6 +35,17 @@ def assign_flight_type(df):
         The input DataFrame with at least the following columns:
         - 'Time' (timestamp)
         - 'GGALT' (altitude in meters)
+    window, std_thresh : int, float
+        Rolling window (samples) and maximum rolling std of GGALT (m) for stable altitude.
+    min_level_s, gap_merge_s : float
+        Minimum duration (s) of a level leg, and maximum gap (s) over which level legs are merged.
+    min_cloud_depth, alt_merge_gap : float
+        Minimum vertical extent (m) of a cloud block, and altitude gap (m) within which cloud blocks merge.
+    lwc_thresh, concd_thresh : float
+        In-cloud thresholds on PLWC (g/m3) and CONCD (#/cm3).
+    cache : dict, optional
+        Reused across calls on the same `df` to skip recomputing the rolling std, the stability runs
+        and the cloud-mask runs (see VAP_sweep_flight_data).
 
     Returns:
     --------
@@ -39,36 +64,44 @@ def assign_flight_type(df):
     #----- Find profiles and level legs ------
     #-----------------------------------------
     
+    if cache is None:
+        cache = {}
+
     # Define a time gap threshold to combine blocks (e.g., 120 seconds)
-    time_gap_threshold = pd.Timedelta(seconds=120)
+    time_gap_threshold = pd.Timedelta(seconds=gap_merge_s)
     
     # Compute rolling standard deviation of altitude to smooth noise
-    df['rolling_std'] = df['GGALT'].rolling(window=10, center=True).std()
-    
-    # Identify where altitude remains stable within the threshold
-    df['stable'] = df['rolling_std'] < 3  # You can adjust the threshold (meters)
-    
-    # Assign unique block IDs when stability changes
-    df['block_id'] = (df['stable'] != df['stable'].shift()).cumsum()
-    
-    # Group by block_id and filter for long-duration stable blocks
-    block_info = df[df['stable']].groupby('block_id').agg(
-        start_time=('Time', 'first'),
-        end_time=('Time', 'last'),
-        lower_bound=('GGALT', 'min'),  # Minimum altitude (lower bound)
-        upper_bound=('GGALT', 'max'),  # Maximum altitude (upper bound)
-        duration=('Time', lambda x: x.max() - x.min())
-    )
+    if ('rolling_std', window) not in cache:
+        cache[('rolling_std', window)] = df['GGALT'].rolling(window=window, center=True).std()
+    df['rolling_std'] = cache[('rolling_std', window)]
+    
+    key = ('stable_runs', window, std_thresh)
+    if key not in cache:
+        # Identify where altitude remains stable within the threshold
+        stable = df['rolling_std'] < std_thresh  # You can adjust the threshold (meters)
+        
+        # Assign unique block IDs when stability changes
+        block_id = (stable != stable.shift()).cumsum()
+        
+        # Group by block_id and filter for long-duration stable blocks
+        block_info = df[stable].assign(block_id=block_id[stable]).groupby('block_id').agg(
+            start_time=('Time', 'first'),
+            end_time=('Time', 'last'),
+            lower_bound=('GGALT', 'min'),  # Minimum altitude (lower bound)
+            upper_bound=('GGALT', 'max'),  # Maximum altitude (upper bound)
+            duration=('Time', lambda x: x.max() - x.min())
+        )
+        cache[key] = (stable, block_id, block_info)
+    stable, block_id, block_info = cache[key]
+    df['stable'] = stable
+    df['block_id'] = block_id
     
     # Filter out short-duration blocks
-    valid_blocks = block_info[block_info['duration'] > pd.Timedelta(seconds=150)] ## EDIT?
+    valid_blocks = block_info[block_info['duration'] > pd.Timedelta(seconds=min_level_s)] ## EDIT?
     
     # Sort the blocks by start time
     valid_blocks = valid_blocks.sort_values(by='start_time')
     
-    # Define a time gap threshold to combine blocks (e.g., 120 seconds)
-    time_gap_threshold = pd.Timedelta(seconds=120)
-    
     # Combine consecutive blocks that are less than the threshold apart
     combined_blocks = []
     previous_block = valid_blocks.iloc[0]
@@ -181,30 +214,37 @@ def assign_flight_type(df):
         df['cloud_status'] = 'Out-of-cloud'
         df['Location'] = 'Free'
     else:
-        df['blocked'] = (df[plwc_col] > 0.001) & (df[concd_col] > 10)
+        key = ('cloud_runs', lwc_thresh, concd_thresh)
+        if key not in cache:
+            blocked = (df[plwc_col] > lwc_thresh) & (df[concd_col] > concd_thresh)
+            cloud_id = (blocked != blocked.shift()).cumsum()
+            cloud_info = df[blocked].assign(block_id=cloud_id[blocked]).groupby('block_id').agg(
+                start_time=('Time', 'first'),
+                end_time=('Time', 'last'),
+                lower_bound=('GGALT', 'min'),
+                upper_bound=('GGALT', 'max'),
+            )
+            cache[key] = (blocked, cloud_id, cloud_info)
+        blocked, cloud_id, cloud_info = cache[key]
+        df['blocked'] = blocked
         if not df['blocked'].any():
             print("No valid cloud blocks found. Skipping cloud layer logic.")
             final_cloud_blocks = pd.DataFrame(columns=['start_time', 'end_time', 'lower_bound', 'upper_bound', 'duration', 'Location'])
             df['cloud_status'] = 'Out-of-cloud'
             df['Location'] = 'Free'
         else:
-            df['block_id'] = (df['blocked'] != df['blocked'].shift()).cumsum()
-            block_info = df[df['blocked']].groupby('block_id').agg(
-                start_time=('Time', 'first'),
-                end_time=('Time', 'last'),
-                lower_bound=('GGALT', 'min'),
-                upper_bound=('GGALT', 'max'),
-            )
+            df['block_id'] = cloud_id
+            block_info = cloud_info.copy()
 
             # Calculate duration directly by subtracting start_time from end_time
             block_info['duration'] = block_info['end_time'] - block_info['start_time']
             
             # Filter out short-duration blocks
-            min_vertical = 30  # Adjust as needed (100 meters in your case)
+            min_vertical = min_cloud_depth  # Adjust as needed (100 meters in your case)
             valid_blocks = block_info[(block_info['upper_bound'] - block_info['lower_bound']) > min_vertical].reset_index(drop=True)
             
             # Define the altitude difference and time gap thresholds
-            altitude_gap_threshold = 200  # Increased altitude gap threshold
+            altitude_gap_threshold = alt_merge_gap  # Increased altitude gap threshold
             # time_gap_threshold = pd.Timedelta(minutes=20)  # Time gap threshold for merging
             
             # Sort the valid blocks by their start time to process them in sequence
@@ -332,6 +372,7 @@ def assign_flight_type(df):
     
     return Final_ds
 
+@prof.profiled()
 def block_flight(df):
     """
     Segments a flight dataset into different flight block categories based on cloud status, location, and flight type.
@@ -465,7 +506,7 @@ def assign_cloud_type_HCR(flight_blocks, dir, idx: int = 0):
 
 
 # High-Level function
-def VAP_process_flight_data(df,i):
+def VAP_process_flight_data(df,i, **seg_params):
     """
     High-Level Function for Processing Flight Data in Value Added Products.
 
@@ -483,6 +524,8 @@ def VAP_process_flight_data(df,i):
         - 'GGALT' (float): Altitude of the aircraft.
         - 'PLWCD_' (float): Cloud Droplet Probe LWC.
         - 'CONCD_' (float): Cloud Droplet Probe Number Concentration.
+    **seg_params :
+        Segmentation thresholds passed to `assign_flight_type` (window, std_thresh, min_level_s, ...).
 
     Returns:
     --------
@@ -499,7 +542,7 @@ def VAP_process_flight_data(df,i):
     - The function ensures proper labeling of different flight segments for further analysis, including cloud status and location (e.g., boundary layer or free airspace).
     """
     # Function to assign flight type "Level" and "Profile" when in/out of cloud
-    dict_flight_type = assign_flight_type(df)
+    dict_flight_type = assign_flight_type(df, **seg_params)
 
     # Extract dataframe that has been modified from the assign_flight_type function
     df_mod = dict_flight_type['DataFrame']
@@ -515,26 +558,114 @@ def VAP_process_flight_data(df,i):
     # plot_hcr_cloud_type(df_mod,flight_block_comp,i)
     return flight_blocks
 
-def select_ERA5_4flight(df,campaign):
-    # Define function to filter ERA5 files based on time
-    def get_matching_files(pattern, start_dt, end_dt):
-        file_list = glob.glob(pattern)
-        selected = []
-        for file in file_list:
-            time_strs = file.split('.')[-2].split('_')
-            file_start = datetime.datetime.strptime(time_strs[0], "%Y%m%d%H")
-            file_end = datetime.datetime.strptime(time_strs[1], "%Y%m%d%H")
-            if file_start <= end_dt and file_end >= start_dt:
-                selected.append(file)
-        return selected
-    
-    filepath_sfc = "/glade/campaign/collections/rda/data/d633000/e5.oper.an.sfc/"
-    filepath_pl = "/glade/campaign/collections/rda/data/d633000/e5.oper.an.pl/"
+# Default segmentation thresholds of assign_flight_type
+VAP_SEGMENTATION_DEFAULTS = {
+    'window': 10,            # rolling window for GGALT std (samples)
+    'std_thresh': 3,         # stable if rolling std < this (m)
+    'min_level_s': 150,      # minimum level-leg duration (s)
+    'gap_merge_s': 120,      # merge level legs closer than this (s)
+    'min_cloud_depth': 30,   # minimum cloud-block depth (m)
+    'alt_merge_gap': 200,    # merge cloud blocks within this altitude gap (m)
+    'lwc_thresh': 0.001,     # in cloud if PLWC > this (g/m3) ...
+    'concd_thresh': 10,      # ... and CONCD > this (#/cm3)
+}
+
+def VAP_sweep_flight_data(df, param_grid, campaign=None, rules=None):
+    """
+    Threshold sensitivity sweep of the VAP segmentation for one flight.
+
+    Every combination in `param_grid` is run through `assign_flight_type` and `block_flight`, sharing
+    one cache so the rolling std, the stability runs and the cloud-mask runs are computed once per
+    distinct (window), (window, std_thresh) and (lwc_thresh, concd_thresh); each setting then only
+    re-derives the blocks from those intermediates.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Flight data as passed to `VAP_process_flight_data`. To report regime fractions, df must also
+        hold the ERA5 factor columns (e.g. collocate_ERA5_dat({'all': [df]}) ...['all'][0]).
+    param_grid : dict
+        Parameter name -> list of values; parameters not given stay at VAP_SEGMENTATION_DEFAULTS.
+    campaign : str, optional
+        If given, regimes are assigned once per sample with `assign_cloud_regime` and their
+        fractions are reported per block label.
+    rules : dict, optional
+        Regime rules passed to `assign_cloud_regime`.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per (setting, block label) with the parameter values, n_blocks, n_samples,
+        total_duration_s, median_duration_s and, with `campaign`, one frac_<regime> column per regime.
+        A setting the segmentation fails on gives one row with its parameter values and the
+        message in an 'error' column.
+    """
+    unknown = set(param_grid) - set(VAP_SEGMENTATION_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown segmentation parameter(s): {sorted(unknown)}")
+
+    df = df.copy()
+    if campaign is not None:
+        # Regimes depend only on the per-sample ERA5 factors, not on the segmentation
+        df['cloud_regime'] = assign_cloud_regime(df, campaign, rules)
+
+    names = list(param_grid)
+    cache = {}
+    rows = []
+    for values in itertools.product(*[param_grid[n] for n in names]):
+        params = {**VAP_SEGMENTATION_DEFAULTS, **dict(zip(names, values))}
+        try:
+            df_mod = assign_flight_type(df, cache=cache, **params)['DataFrame']
+            flight_blocks = block_flight(df_mod)
+        # Degenerate settings (e.g. no stable or in-cloud samples) fail on empty selections
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            print(f"Skipping setting {dict(zip(names, values))}: {e!r}")
+            rows.append({**params, 'error': repr(e)})
+            continue
+
+        for label, block_list in flight_blocks.items():
+            durations = np.array([(b['Time'].iloc[-1] - b['Time'].iloc[0]).total_seconds() for b in block_list])
+            row = {**params,
+                   'block_label': label,
+                   'n_blocks': len(block_list),
+                   'n_samples': int(sum(len(b) for b in block_list)),
+                   'total_duration_s': durations.sum(),
+                   'median_duration_s': np.median(durations) if len(durations) else np.nan}
+            if campaign is not None and block_list:
+                fractions = pd.concat([b['cloud_regime'] for b in block_list]).value_counts(normalize=True)
+                row.update({f"frac_{regime}": frac for regime, frac in fractions.items()})
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+# Root of the ERA5 (ds633.0) tree on /glade
+ERA5_ROOT = "/glade/campaign/collections/rda/data/d633000/"
+
+def get_matching_files(pattern, start_dt, end_dt):
+    """
+    Filter ERA5 files matching a glob pattern to those overlapping [start_dt, end_dt].
+    The time range is read from the 'YYYYMMDDHH_YYYYMMDDHH' stamp in each file name.
+    """
+    file_list = glob.glob(pattern)
+    selected = []
+    for file in file_list:
+        time_strs = file.split('.')[-2].split('_')
+        file_start = datetime.datetime.strptime(time_strs[0], "%Y%m%d%H")
+        file_end = datetime.datetime.strptime(time_strs[1], "%Y%m%d%H")
+        if file_start <= end_dt and file_end >= start_dt:
+            selected.append(file)
+    return selected
+
+def ERA5_flight_window(df, campaign):
+    """
+    Lat/lon box (in ERA5 longitudes), time window and year-month directory used to subset ERA5
+    for one research flight.
+    """
     # Extract the times of the research flight
     month, year = df.Time[0].month, df.Time[0].year
     day_start,day_end = df.Time[0].day, df.Time.iloc[-1].day
     start_hour, end_hour = df.Time[0].hour, df.Time.iloc[-1].hour
-    
+
     # Select the latitude/longitude box to reduce size of era5 data
     lat_max, lat_min = np.floor(df.GGLAT.min()), np.ceil(df.GGLAT.max())
     if campaign == 'SOCRATES':
@@ -542,173 +673,245 @@ def select_ERA5_4flight(df,campaign):
     elif campaign  == 'CSET':
         lon_adj = 360
     lon_min, lon_max = np.floor(df.GGLON.min())+lon_adj, np.ceil(df.GGLON.max())+lon_adj
-    
+
     # Flight start and end times
-    start_dt = datetime.datetime(year, month, day_start, start_hour) 
+    start_dt = datetime.datetime(year, month, day_start, start_hour)
     end_dt = datetime.datetime(year, month, day_end, end_hour)+datetime.timedelta(hours=1)
-    
-    # Make the yearmonth string for file selection
-    dir_date = f"{year}{month:02d}"
-    
-    # Load SST data
-    filepath="/glade/campaign/collections/rda/data/ds633.0/e5.oper.an.sfc/"
-    # # Construct the search pattern (SST)
-    ds_sst = xr.open_mfdataset(get_matching_files(f"{filepath_sfc}{dir_date}/*_sstk.*.nc", start_dt, end_dt), combine='by_coords')
-    ds_sst = ds_sst.sel(
-    latitude=slice(lat_min, lat_max),  # Select latitudes within range
-    longitude=slice(lon_min, lon_max),  # Select longitudes within range
-    time=slice(start_dt, end_dt),
-    )
-    
-    # Load 2m tempeature
-    ds_t2m = xr.open_mfdataset(get_matching_files(f"{filepath_sfc}{dir_date}/*_2t.*.nc", start_dt, end_dt), combine='by_coords')
-    ds_t2m = ds_t2m.sel(
-    latitude=slice(lat_min, lat_max),  # Select latitudes within range
-    longitude=slice(lon_min, lon_max),  # Select longitudes within range
-    time=slice(start_dt, end_dt),
-    )
-    
-    # Load 10m wind speed (u and v components)
-    ds_u10 = xr.open_mfdataset(get_matching_files(f"{filepath_sfc}{dir_date}/*_10u.*.nc", start_dt, end_dt), combine='by_coords')[['VAR_10U']]
-    ds_u10 = ds_u10.sel(
-    latitude=slice(lat_min, lat_max),  # Select latitudes within range
-    longitude=slice(lon_min, lon_max),  # Select longitudes within range
-    time=slice(start_dt, end_dt),
-    )
-    ds_v10 = xr.open_mfdataset(get_matching_files(f"{filepath_sfc}{dir_date}/*_10v.*.nc", start_dt, end_dt), combine='by_coords')[['VAR_10V']]
-    ds_v10 = ds_v10.sel(
-    latitude=slice(lat_min, lat_max),  # Select latitudes within range
-    longitude=slice(lon_min, lon_max),  # Select longitudes within range
-    time=slice(start_dt, end_dt),
-    )
-    
-    ws = np.sqrt(ds_u10.VAR_10U**2 + ds_v10.VAR_10V**2)
-    wind_dir = (270 - np.degrees(np.arctan2(ds_v10.VAR_10V, ds_u10.VAR_10U))) % 360
-    
-    # Load w data for all pressure levels
-    # # Construct the search pattern (SST)
-    ds_w = xr.open_mfdataset(get_matching_files(f"{filepath_pl}{dir_date}/*_w.*.nc", start_dt, end_dt), combine='nested', concat_dim='time')
-    w_700 = ds_w['W'].sel(level=700).squeeze()
-    
-    # Select w at 500 hPa
-    w_700 = w_700.sortby('time').sel(
-        latitude=slice(lat_min, lat_max),
-        longitude=slice(lon_min, lon_max),
-        time=slice(start_dt, end_dt)
-    )
-    
-    ds_rh700 = xr.open_mfdataset(get_matching_files(f"{filepath_pl}{dir_date}/*_r.*.nc", start_dt, end_dt), combine='nested', concat_dim='time')[['R']].sel(level=700).drop_vars('level', errors='ignore')
-    rh = ds_rh700['R'].rename("RH") if 'R' in ds_rh700 else None
-    rh = rh.sortby('time').sel(
-        latitude=slice(lat_min, lat_max),
-        longitude=slice(lon_min, lon_max),
-        time=slice(start_dt, end_dt)
-    )
-    
-    # Load pressure level wind speed (u and v components)
-    ds_u700 = xr.open_mfdataset(get_matching_files(f"{filepath_pl}{dir_date}/*_u.*.nc", start_dt, end_dt), combine='nested', concat_dim='time')[['U']].sel(level=700).drop_vars('level', errors='ignore')
-    ds_u700 = ds_u700.sortby('time').sel(
-    latitude=slice(lat_min, lat_max),  # Select latitudes within range
-    longitude=slice(lon_min, lon_max),  # Select longitudes within range
-    time=slice(start_dt, end_dt)
-    )
-    ds_v700 = xr.open_mfdataset(get_matching_files(f"{filepath_pl}{dir_date}/*_v.*.nc", start_dt, end_dt), combine='nested', concat_dim='time')[['V']].sel(level=700).drop_vars('level', errors='ignore')
-    ds_v700 = ds_v700.sortby('time').sel(
-        latitude=slice(lat_min, lat_max),
-        longitude=slice(lon_min, lon_max),
-        time=slice(start_dt, end_dt)
-    )
-    
-    # Calcualte wind shear (SFC - 700mb)
-    ws700 = np.sqrt(ds_u700.U**2 + ds_v700.V**2)  
-    wind_shear = ws700-ws
-    
-    # Load upper temperature data with select pressure levels
-    ds_t = xr.open_mfdataset(get_matching_files(f"{filepath_pl}{dir_date}/*_t.*.nc", start_dt, end_dt), combine='nested', concat_dim='time')[['T']].sel(level=800).drop_vars('level', errors='ignore')
-    ds_t = ds_t.sortby('time').sel(
-        latitude=slice(lat_min, lat_max),
-        longitude=slice(lon_min, lon_max),
-        time=slice(start_dt, end_dt)
-    )
-    # Load upper temperature data with select pressure levels
-    ds_t700 = xr.open_mfdataset(get_matching_files(f"{filepath_pl}{dir_date}/*_t.*.nc", start_dt, end_dt), combine='nested', concat_dim='time')[['T']].sel(level=700).drop_vars('level', errors='ignore')
-    ds_t700 = ds_t700.sortby('time').sel(
-        latitude=slice(lat_min, lat_max),
-        longitude=slice(lon_min, lon_max),
-        time=slice(start_dt, end_dt)
-    )
-    
-    # Calculate M-value
-    Rd = 287
-    Cp = 1005     
-    theta_sfc = ds_sst.SSTK*(1)**(Rd/Cp)
-    theta_800 = ds_t*(1013.25/800)**(Rd/Cp)
-    
-    M = theta_sfc.T - theta_800.T
-    M = M.transpose("time", "latitude", "longitude")
-    
-    dt = ds_t2m.VAR_2T - ds_sst.SSTK
-    # Constants
-    Re = 6.371e6  # Earth radius in meters
-    deg2rad = np.pi / 180
-    phi = np.deg2rad(ds_sst.SSTK['latitude'])
-    # meters per 1° at this latitude
-    m_per_deg_lon = Re * np.cos(phi) * deg2rad
-    m_per_deg_lat = Re * deg2rad
-    # gradients in K/m  (NOTE the division by meters-per-degree)
-    dT_dx = ds_sst.SSTK.differentiate("longitude") / m_per_deg_lon   # K/m
-    dT_dy = ds_sst.SSTK.differentiate('latitude') / m_per_deg_lat   # K/m
+
+    return {
+        'latitude': slice(lat_min, lat_max),    # ERA5 latitudes are stored north -> south
+        'longitude': slice(lon_min, lon_max),
+        'time': slice(start_dt, end_dt),
+        'start_dt': start_dt,
+        'end_dt': end_dt,
+        'dir_date': f"{year}{month:02d}",       # yearmonth string for file selection
+    }
+
+def load_ERA5_primitives(df, campaign, era5_root=ERA5_ROOT):
+    """
+    Lazily open the ERA5 fields that all derived cloud-controlling factors are built from,
+    subset to the flight's lat/lon box and time window.
+
+    Nothing is read from disk here; the returned DataArrays are dask-backed, so callers can
+    either compute on the full box (select_ERA5_4flight) or pull only the gridpoints they
+    need (collocate_ERA5_pointwise).
+
+    :param df: Flight DataFrame with Time, GGLAT and GGLON.
+    :param campaign: 'SOCRATES' or 'CSET' (sets the longitude convention).
+    :param era5_root: Root of the ERA5 tree containing e5.oper.an.sfc/ and e5.oper.an.pl/.
+
+    :return: dict of DataArrays with dims (time, latitude, longitude), keyed by the primitive
+             names used in ERA5_DERIVED (SSTK, VAR_2T, VAR_10U, VAR_10V, T800, T700, U700,
+             V700, W700, R700).
+    """
+    win = ERA5_flight_window(df, campaign)
+    start_dt, end_dt, dir_date = win['start_dt'], win['end_dt'], win['dir_date']
+    box = {'latitude': win['latitude'], 'longitude': win['longitude'], 'time': win['time']}
+    filepath_sfc = f"{era5_root}e5.oper.an.sfc/"
+    filepath_pl = f"{era5_root}e5.oper.an.pl/"
+
+    def sfc(short_name, var):
+        files = get_matching_files(f"{filepath_sfc}{dir_date}/*_{short_name}.*.nc", start_dt, end_dt)
+        return xr.open_mfdataset(files, combine='by_coords')[var].sel(**box)
+
+    def pl(short_name, var, level):
+        files = get_matching_files(f"{filepath_pl}{dir_date}/*_{short_name}.*.nc", start_dt, end_dt)
+        da = xr.open_mfdataset(files, combine='nested', concat_dim='time')[var].sel(level=level)
+        return da.drop_vars('level', errors='ignore').sortby('time').sel(**box)
+
+    prims = {
+        'SSTK': sfc('sstk', 'SSTK'),
+        'VAR_2T': sfc('2t', 'VAR_2T'),
+        'VAR_10U': sfc('10u', 'VAR_10U'),
+        'VAR_10V': sfc('10v', 'VAR_10V'),
+        'W700': pl('w', 'W', 700),
+        'R700': pl('r', 'R', 700).rename("RH"),
+        'U700': pl('u', 'U', 700),
+        'V700': pl('v', 'V', 700),
+        'T800': pl('t', 'T', 800),
+        'T700': pl('t', 'T', 700),
+    }
+    return {name: da.transpose('time', 'latitude', 'longitude') for name, da in prims.items()}
+
+#---------------------------------------------------------
+#----- Derived ERA5 fields (declared dependency graph) ---
+#---------------------------------------------------------
+# Each entry is name -> (dependency names, formula). Formulas are purely elementwise, so the same
+# graph evaluates on gridded DataArrays (select_ERA5_4flight) and on 1-D arrays of collocated
+# samples (collocate_ERA5_pointwise). Leaves that are not in the graph are primitives: the fields
+# from load_ERA5_primitives, 'latitude', and the stencil derivatives in ERA5_STENCIL.
+ERA5_DERIVED = {}
+
+# Stencil leaves: name -> (field, dimension) for a centred difference (one-sided at the box edge),
+# in field units per degree, matching xarray's differentiate().
+ERA5_STENCIL = {
+    'dSST_dlon': ('SSTK', 'longitude'),
+    'dSST_dlat': ('SSTK', 'latitude'),
+}
+
+def _era5_derived(name, *deps):
+    def register(func):
+        ERA5_DERIVED[name] = (deps, func)
+        return func
+    return register
+
+# Constants (kept as in the original M, LTS and EIS calculations)
+Rd = 287          # gas constant for dry air (J / kg / K)
+Cp_M = 1005       # cp used for the M-value potential temperatures
+cp = 1004.        # specific heat at constant pressure for dry air (J / kg / K)
+kappa = Rd / cp
+Lhvap = 2.5e6     # Latent heat of vaporization (J / kg)
+Rv = 461          # J/K/kg
+g = 9.81          # m/s^2
+Re = 6.371e6      # Earth radius in meters
+
+def get_qsat(T,p):
+    Tcel = T-273.15
+    es=6.11*10**(7.5*Tcel/(Tcel+273.15))
+    return 0.622*es/p
+
+@_era5_derived('theta_sfc', 'SSTK')
+def _theta_sfc(SSTK):
+    return SSTK*(1)**(Rd/Cp_M)
+
+@_era5_derived('theta_800', 'T800')
+def _theta_800(T800):
+    return T800*(1013.25/800)**(Rd/Cp_M)
+
+@_era5_derived('M', 'theta_sfc', 'theta_800')
+def _M(theta_sfc, theta_800):
+    return theta_sfc - theta_800
+
+@_era5_derived('deltaT', 'VAR_2T', 'SSTK')
+def _deltaT(VAR_2T, SSTK):
+    return VAR_2T - SSTK
+
+@_era5_derived('WS', 'VAR_10U', 'VAR_10V')
+def _WS(VAR_10U, VAR_10V):
+    return np.sqrt(VAR_10U**2 + VAR_10V**2)
+
+@_era5_derived('WS700', 'U700', 'V700')
+def _WS700(U700, V700):
+    return np.sqrt(U700**2 + V700**2)
+
+@_era5_derived('Wind_shear', 'WS700', 'WS')
+def _wind_shear(WS700, WS):
+    # Wind shear (700mb - SFC)
+    return WS700 - WS
+
+@_era5_derived('dSST_dx', 'dSST_dlon', 'latitude')
+def _dsst_dx(dSST_dlon, latitude):
+    # meters per 1° of longitude at this latitude -> K/m
+    return dSST_dlon / (Re * np.cos(np.deg2rad(latitude)) * np.pi / 180)
+
+@_era5_derived('dSST_dy', 'dSST_dlat')
+def _dsst_dy(dSST_dlat):
+    return dSST_dlat / (Re * np.pi / 180)
+
+@_era5_derived('Tadv', 'VAR_10U', 'VAR_10V', 'dSST_dx', 'dSST_dy')
+def _tadv(VAR_10U, VAR_10V, dSST_dx, dSST_dy):
     # advection: K/s -> K/day
-    Tadv = -(ds_u10['VAR_10U'] * dT_dx + ds_v10['VAR_10V'] * dT_dy) * 86400.0
-    # Convert to K/day
-    Tadv = Tadv.rename("Tadv")
-
-    # Calculate EIS following Wood and Bretherton (2006, J. Climate)
-
-    cp = 1004.     # specific heat at constant pressure for dry air (J / kg / K)
-    Rd = 287.         # gas constant for dry air (J / kg / K)
-    kappa = Rd / cp
-    Lhvap = 2.5e6    # Latent heat of vaporization (J / kg)
-    g = 9.81 # m/s^2
-    cp = 1004 # J/K/kg
-    Lv = 2.5e6 # J/kg
-    
-    Rv = 461 # J/K/kg;
-    Ra = 287 # J/K/kg
-    
-    def get_qsat(T,p):
-        Tcel = T-273.15
-        es=6.11*10**(7.5*Tcel/(Tcel+273.15))
-        return 0.622*es/p
-    
-    # Calculate lower tropospheric stability (LTS)
-    theta_700 = ds_t700.T*(1013.25/700)**kappa
-    LTS = theta_700 - theta_sfc
-    
-    T850 = (ds_t2m.VAR_2T+ds_t700.T)/2
-    
-    Gammam = (g/cp*(1.0 - (1.0 + Lhvap*get_qsat(T850,850) / Rd / T850) /
-                 (1.0 + Lhvap**2 * get_qsat(T850,850)/ cp/Rv/T850**2)))
-    
+    return -(VAR_10U * dSST_dx + VAR_10V * dSST_dy) * 86400.0
+
+@_era5_derived('LTS', 'T700', 'theta_sfc')
+def _LTS(T700, theta_sfc):
+    # Lower tropospheric stability
+    return T700*(1013.25/700)**kappa - theta_sfc
+
+@_era5_derived('Gammam', 'VAR_2T', 'T700')
+def _gammam(VAR_2T, T700):
+    # Moist adiabatic lapse rate at 850 hPa
+    T850 = (VAR_2T+T700)/2
+    qsat = get_qsat(T850,850)
+    return (g/cp*(1.0 - (1.0 + Lhvap*qsat / Rd / T850) /
+                 (1.0 + Lhvap**2 * qsat/ cp/Rv/T850**2)))
+
+@_era5_derived('z700', 'VAR_2T')
+def _z700(VAR_2T):
     # Assume exponential decrease of pressure with scale height given by surface temperature
-    z700 = (Rd * ds_t2m.VAR_2T / g) * np.log(1000 / 700)
+    return (Rd * VAR_2T / g) * np.log(1000 / 700)
+
+@_era5_derived('LCL', 'VAR_2T')
+def _LCL(VAR_2T):
     # Assume 80% relative humidity to compute LCL, appropriate for marine boundary layer
-    Tadj = Tadj = ds_t2m.VAR_2T-55.  # in Kelvin
-    LCL = cp/g*(Tadj - (1/Tadj - np.log(0.8)/2840.)**(-1))
-    
-    EIS = LTS - Gammam*(z700 - LCL)
-    
+    Tadj = VAR_2T-55.  # in Kelvin
+    return cp/g*(Tadj - (1/Tadj - np.log(0.8)/2840.)**(-1))
+
+@_era5_derived('EIS', 'LTS', 'Gammam', 'z700', 'LCL')
+def _EIS(LTS, Gammam, z700, LCL):
+    # EIS following Wood and Bretherton (2006, J. Climate)
+    return LTS - Gammam*(z700 - LCL)
+
+def ERA5_required_inputs(targets):
+    """
+    Walk ERA5_DERIVED from `targets` down to its leaves.
+
+    :return: (primitives, stencils) -- sets of the primitive field names and the ERA5_STENCIL
+             names needed to evaluate `targets`. 'latitude' is reported as a primitive.
+    """
+    prims, stencils, seen = set(), set(), set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        if name in ERA5_DERIVED:
+            todo.extend(ERA5_DERIVED[name][0])
+        elif name in ERA5_STENCIL:
+            stencils.add(name)
+        else:
+            prims.add(name)
+    return prims, stencils
+
+def eval_ERA5_derived(targets, inputs):
+    """
+    Evaluate derived ERA5 fields from the dependency graph in ERA5_DERIVED.
+
+    Every intermediate (theta_sfc, WS, Gammam, ...) is computed once and shared by all targets
+    that depend on it.
+
+    :param targets: Names of the fields to return, e.g. ['M', 'EIS', 'Tadv'].
+    :param inputs: dict of primitive and stencil values (DataArrays or NumPy arrays).
+
+    :return: dict mapping each target name to its value.
+    """
+    cache = dict(inputs)
+
+    def resolve(name):
+        if name not in cache:
+            if name not in ERA5_DERIVED:
+                raise KeyError(f"'{name}' is neither a provided input nor a derived ERA5 field")
+            deps, func = ERA5_DERIVED[name]
+            cache[name] = func(*[resolve(dep) for dep in deps])
+        return cache[name]
+
+    return {name: resolve(name) for name in targets}
+
+@prof.profiled()
+def select_ERA5_4flight(df,campaign, era5_root=ERA5_ROOT):
+    prims = load_ERA5_primitives(df, campaign, era5_root)
+
+    # Stencil leaves on the full grid: gradients in K/deg (NOTE the division by meters-per-degree
+    # happens in the graph)
+    inputs = dict(prims)
+    inputs['latitude'] = prims['SSTK']['latitude']
+    for name, (field, dim) in ERA5_STENCIL.items():
+        inputs[name] = prims[field].differentiate(dim)
+
+    derived = eval_ERA5_derived(['deltaT', 'Tadv', 'M', 'WS', 'Wind_shear', 'EIS'], inputs)
+
     # Merge the dataset variables used later
     ds = {
-    'deltaT': dt,
-    'Tadv': Tadv,
-    'M': M,
-    'w_700': w_700,
-    'SST': ds_sst.SSTK,
-    'WS': ws,
-    'Wind_shear': wind_shear,
-    'RH700': rh,
-    'EIS': EIS
+    'deltaT': derived['deltaT'],
+    'Tadv': derived['Tadv'].rename("Tadv"),
+    'M': derived['M'].transpose("time", "latitude", "longitude"),
+    'w_700': prims['W700'],
+    'SST': prims['SSTK'],
+    'WS': derived['WS'],
+    'Wind_shear': derived['Wind_shear'],
+    'RH700': prims['R700'],
+    'EIS': derived['EIS']
      }
 
     return ds
@@ -727,26 +930,101 @@ def nearest_time_indices(era5_times_ns, flight_times_ns):
     choose_right = np.abs(era5_times_ns[idx_right] - flight_times_ns) < np.abs(era5_times_ns[idx_left] - flight_times_ns)
     return np.where(choose_right, idx_right, idx_left)
 
-def collocate_ERA5_dat(ds, blocks):
+def ERA5_grid_locator(ds):
     """
-    Vectorized collocation of ERA5 fields onto flight blocks.
-    Expects ds variables with dims ('time','latitude','longitude').
-    Returns updated `blocks` in-place with columns:
-    ERA5_SST, M, w700, deltaT, Wind_sp, Wind_shear, Tadv, RH700, EIS.
+    Build a nearest-neighbour locator for an ERA5 (time, latitude, longitude) grid.
+
+    :param ds: xarray Dataset/DataArray with 'time', 'latitude' and 'longitude' coordinates.
+
+    :return: function locate(lat, lon, times) -> (ti, yi, xi) index arrays into the grid.
     """
     # --- Pull coords as numpy (keep ordering exactly as in ds)
-    ds = xr.Dataset(ds)  # now ds has proper coords
     lat_vals = ds['latitude'].values
     lon_vals_ds = ds['longitude'].values
     lon_vals_wrapped = wrap180(lon_vals_ds)  # build KDTree in [-180,180)
+    ny, nx = len(lat_vals), len(lon_vals_ds)
 
     # --- KDTree on (lat, lon_wrapped)
     lon_grid, lat_grid = np.meshgrid(lon_vals_wrapped, lat_vals)
     tree = cKDTree(np.c_[lat_grid.ravel(), lon_grid.ravel()])
 
     # --- Era5 time (sorted)
-    t_era = ds['time'].values.astype('datetime64[ns]')
-    t_era_ns = t_era.view('int64')
+    t_era_ns = ds['time'].values.astype('datetime64[ns]').view('int64')
+
+    def locate(lat, lon, times):
+        flt_lat = np.asarray(lat, dtype=float)
+        flt_lon = wrap180(np.asarray(lon, dtype=float))  # match KDTree frame
+        flt_t_ns = np.asarray(times).astype('datetime64[ns]').view('int64')
+
+        # Nearest time indices (vectorized, no giant argmin)
+        ti = nearest_time_indices(t_era_ns, flt_t_ns)  # (N,)
+
+        # Nearest gridpoint via KDTree (vectorized)
+        _, flat_idx = tree.query(np.c_[flt_lat, flt_lon])     # (N,)
+        yi, xi = np.unravel_index(flat_idx, (ny, nx))         # (N,), (N,)
+        return ti, yi, xi
+
+    return locate
+
+def summed_area_tables(A):
+    """
+    Per-timestep summed-area tables of a (T, Y, X) field for NaN-aware box statistics.
+
+    :return: dict with zero-padded (T, Y+1, X+1) tables of the valid-point count ('n'), the sum
+             ('s') and the sum of squares ('ss') of the field minus its overall mean ('offset').
+    """
+    A = np.asarray(A, dtype=float)
+    valid = np.isfinite(A)
+    offset = np.nanmean(A) if valid.any() else 0.0
+    A0 = np.where(valid, A - offset, 0.0)   # shifting by the mean keeps the sums well conditioned
+
+    def sat(x):
+        S = np.zeros((x.shape[0], x.shape[1] + 1, x.shape[2] + 1))
+        S[:, 1:, 1:] = x.cumsum(axis=1).cumsum(axis=2)
+        return S
+
+    return {'n': sat(valid.astype(float)), 's': sat(A0), 'ss': sat(A0**2), 'offset': offset}
+
+def box_stats(sats, ti, yi, xi, half):
+    """
+    Mean and variance over the (2*half+1) x (2*half+1) box of gridpoints centred on each sample,
+    clipped at the edge of the domain. Costs four table lookups per sample for any box size.
+
+    :param sats: dict from summed_area_tables.
+    :param ti, yi, xi: Time and gridpoint indices of the samples.
+    :param half: Half-width of the box in grid cells.
+
+    :return: (mean, var) arrays; NaN where the box holds no valid gridpoints.
+    """
+    ny, nx = sats['n'].shape[1] - 1, sats['n'].shape[2] - 1
+    y0, y1 = np.clip(yi - half, 0, ny), np.clip(yi + half + 1, 0, ny)
+    x0, x1 = np.clip(xi - half, 0, nx), np.clip(xi + half + 1, 0, nx)
+
+    def box(S):
+        return S[ti, y1, x1] - S[ti, y0, x1] - S[ti, y1, x0] + S[ti, y0, x0]
+
+    n = box(sats['n'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean0 = np.where(n > 0, box(sats['s']) / n, np.nan)
+        var = np.maximum(box(sats['ss']) / n - mean0**2, 0.0)
+    return mean0 + sats['offset'], var
+
+@prof.profiled()
+def collocate_ERA5_dat(ds, blocks, plev=None, neighborhood=None,
+                       nb_fields=('M', 'EIS', 'Wind_shear', 'RH700', 'ERA5_SST')):
+    """
+    Vectorized collocation of ERA5 fields onto flight blocks.
+    Expects ds variables with dims ('time','latitude','longitude').
+    Returns updated `blocks` in-place with columns:
+    ERA5_SST, M, w700, deltaT, Wind_sp, Wind_shear, Tadv, RH700, EIS.
+    If `plev` (from load_ERA5_plev_band) is given, ERA5 at the aircraft's own pressure level
+    is attached as well (see collocate_ERA5_plev).
+    If `neighborhood` is given (a half-width in grid cells, or a list of them), the mean and
+    variance of each of `nb_fields` over the surrounding box are added as <field>_mean<n>x<n> and
+    <field>_var<n>x<n>, e.g. M_mean3x3 for neighborhood=1 (2 -> 5x5, about 1°x1° at 0.25°).
+    """
+    ds = xr.Dataset(ds)  # now ds has proper coords
+    locate = ERA5_grid_locator(ds)
 
     # --- Preload arrays once (-> NumPy) for super-fast indexing
     def arr3(name):
@@ -763,7 +1041,12 @@ def collocate_ERA5_dat(ds, blocks):
         'EIS':      arr3('EIS'),
     }
 
-    ny, nx = len(lat_vals), len(lon_vals_ds)
+    # --- Summed-area tables for the neighborhood statistics, built once per flight
+    if neighborhood is None:
+        halves = []
+    else:
+        halves = [int(h) for h in np.atleast_1d(neighborhood)]
+    sats = {name: summed_area_tables(arr[name]) for name in nb_fields} if halves else {}
 
     # --- Iterate blocks, but do all lookups in one vectorized shot per block
     for val in blocks:
@@ -775,114 +1058,556 @@ def collocate_ERA5_dat(ds, blocks):
                 block_list[i] = block
                 continue
 
-            # Flight coords/time
-            flt_lat = block['GGLAT'].values.astype(float)
-            flt_lon = wrap180(block['GGLON'].values.astype(float))  # match KDTree frame
-            flt_t   = block['Time'].astype('datetime64[ns]').values
-            flt_t_ns = flt_t.view('int64')
-
-            # Nearest time indices (vectorized, no giant argmin)
-            ti = nearest_time_indices(t_era_ns, flt_t_ns)  # (N,)
-
-            # Nearest gridpoint via KDTree (vectorized)
-            _, flat_idx = tree.query(np.c_[flt_lat, flt_lon])     # (N,)
-            yi, xi = np.unravel_index(flat_idx, (ny, nx))         # (N,), (N,)
+            # Nearest time and gridpoint indices (vectorized)
+            ti, yi, xi = locate(block['GGLAT'].values, block['GGLON'].values, block['Time'].values)
 
             # Gather all variables in one pass
             for out_name, A in arr.items():
                 block[out_name] = A[ti, yi, xi]
+            for half in halves:
+                size = 2 * half + 1
+                for name, tables in sats.items():
+                    mean, var = box_stats(tables, ti, yi, xi, half)
+                    block[f"{name}_mean{size}x{size}"] = mean
+                    block[f"{name}_var{size}x{size}"] = var
 
             # Put back
             block_list[i] = block
         blocks[val] = block_list
 
+    if plev is not None:
+        blocks = collocate_ERA5_plev(plev, blocks)
+
     return blocks
 
-def cloud_regime_old(fblks):
-    # Iterate through blocks
-    for val in fblks:
-        block_type = fblks[val]
-        for i in range(len(block_type)):
-            block = block_type[i].copy()
-            block['cloud_regime'] = pd.Series('Undetermined', index=block.index, dtype='object')
-            condition_cum = ((block['M'] > -7) & (block['Wind_shear'] < 6)) | ((block['M'] > -7) & (block['Wind_sp'] > 10))
-            condition_strcu = ((block['M'] <= -10) & (block['Wind_sp'] < 10)) | ((block['M'] <= -10) | (block['Wind_shear'] > 6))
-            # Assign values based on conditions
-            block.loc[condition_cum, 'cloud_regime'] = 'Open-Cell Cu'
-            block.loc[condition_strcu, 'cloud_regime'] = 'Stratiform'
-    
-            block_type[i] = block
-    
-        fblks[val] = block_type
+# ERA5 pressure-level variable -> short name in the e5.oper.an.pl file names
+ERA5_PLEV_VARS = {'T': 't', 'Q': 'q', 'W': 'w', 'U': 'u', 'V': 'v'}
 
-    return fblks
+def load_ERA5_plev_band(df, campaign, variables=ERA5_PLEV_VARS, era5_root=ERA5_ROOT, pres_col='PSXC'):
+    """
+    Load, once per flight, the band of ERA5 pressure levels that brackets the aircraft's
+    pressure range, for the flight's lat/lon box and time window.
+
+    :param df: Flight DataFrame with Time, GGLAT, GGLON and the pressure column.
+    :param campaign: 'SOCRATES' or 'CSET' (sets the longitude convention).
+    :param variables: dict of ERA5 variable name -> file short name (default T, Q, W, U, V).
+    :param era5_root: Root of the ERA5 tree containing e5.oper.an.pl/.
+    :param pres_col: Aircraft static pressure column in hPa.
 
-def cloud_regime(fblks, campaign):
+    :return: xr.Dataset in memory with dims (time, level, latitude, longitude), levels ascending.
+    """
+    win = ERA5_flight_window(df, campaign)
+    p_min, p_max = np.nanmin(df[pres_col]), np.nanmax(df[pres_col])
+
+    band = {}
+    for var, short_name in variables.items():
+        files = get_matching_files(f"{era5_root}e5.oper.an.pl/{win['dir_date']}/*_{short_name}.*.nc",
+                                   win['start_dt'], win['end_dt'])
+        da = xr.open_mfdataset(files, combine='nested', concat_dim='time')[var].sortby('level')
+        levels = da['level'].values
+        # One level above the highest and one below the lowest aircraft pressure
+        lo = max(int(np.searchsorted(levels, p_min, side='right')) - 1, 0)
+        hi = min(int(np.searchsorted(levels, p_max, side='left')), len(levels) - 1)
+        da = da.isel(level=slice(lo, hi + 1)).sortby('time').sel(
+            latitude=win['latitude'], longitude=win['longitude'], time=win['time'])
+        band[var] = da.transpose('time', 'level', 'latitude', 'longitude')
+
+    return xr.Dataset(band).load()
+
+def interp_log_pressure(p_levels, values, p_target):
+    """
+    Log-linear interpolation in pressure for many samples at once.
+
+    :param p_levels: Pressure levels, ascending, shape (L,) or one column per sample (N, L).
+    :param values: Values on those levels, shape (N, L).
+    :param p_target: Pressure of each sample, shape (N,), same units as p_levels.
+
+    :return: (N,) interpolated values; NaN where p_target lies outside the column.
+    """
+    values = np.asarray(values, dtype=float)
+    logp = np.log(np.broadcast_to(np.asarray(p_levels, dtype=float), values.shape))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_t = np.log(np.asarray(p_target, dtype=float))
+    n, nlev = values.shape
+    if nlev < 2:
+        return np.full(n, np.nan)
+
+    # Level just above (lower pressure than) each sample
+    k = np.clip((logp <= log_t[:, None]).sum(axis=1) - 1, 0, nlev - 2)
+    rows = np.arange(n)
+    x0, x1 = logp[rows, k], logp[rows, k + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = (log_t - x0) / (x1 - x0)
+    out = values[rows, k] * (1 - w) + values[rows, k + 1] * w
+
+    outside = ~np.isfinite(log_t) | (log_t < logp[:, 0]) | (log_t > logp[:, -1])
+    out[outside] = np.nan
+    return out
+
+@prof.profiled()
+def collocate_ERA5_plev(plev, blocks, pres_col='PSXC'):
     """
-    Assign cloud_regime per block:
+    Attach ERA5 at the aircraft's own pressure level to every block.
+
+    All samples of all blocks are located on the ERA5 grid together, their level columns are
+    pulled from the in-memory band with one fancy-indexing call per variable, and the columns are
+    interpolated log-linearly in pressure to `pres_col` in one vectorized step.
+
+    :param plev: Dataset from load_ERA5_plev_band.
+    :param blocks: dict of lists of block DataFrames (output of block_flight).
+    :param pres_col: Aircraft static pressure column in hPa.
+
+    :return: `blocks`, updated in place with columns ERA5_<var>_ac (e.g. ERA5_T_ac, ERA5_W_ac).
+    """
+    locate = ERA5_grid_locator(plev)
+    p_levels = plev['level'].values.astype(float)
+
+    entries, offsets = stack_blocks(blocks)
+    out = {}
+    if offsets[-1] > 0:
+        stacked = pd.concat([block[['GGLAT','GGLON','Time',pres_col]] for _, _, block in entries])
+        ti, yi, xi = locate(stacked['GGLAT'].values, stacked['GGLON'].values, stacked['Time'].values)
+        p_target = stacked[pres_col].values.astype(float)
+        for var in plev.data_vars:
+            cols = plev[var].values[ti, :, yi, xi]       # (N, L)
+            out[f"ERA5_{var}_ac"] = interp_log_pressure(p_levels, cols, p_target)
+
+    for k, (val, i, block) in enumerate(entries):
+        sl = slice(offsets[k], offsets[k + 1])
+        for name, values in out.items():
+            block[name] = values[sl]
+        blocks[val][i] = block
+
+    return blocks
+
+# Output column -> ERA5 field, as written by collocate_ERA5_dat
+ERA5_COLLOCATED = {
+    'ERA5_SST': 'SSTK',
+    'M': 'M',
+    'w700': 'W700',
+    'deltaT': 'deltaT',
+    'Wind_sp': 'WS',
+    'Wind_shear': 'Wind_shear',
+    'Tadv': 'Tadv',
+    'RH700': 'R700',
+    'EIS': 'EIS',
+}
+
+def stack_blocks(blocks):
+    """
+    Drop samples without a position from every block and stack the blocks end to end.
+
+    :param blocks: dict of lists of block DataFrames (output of block_flight).
+
+    :return: (entries, offsets) where entries is a list of (label, i, block) with cleaned copies
+             of the blocks and offsets (len(entries) + 1,) gives each block's row range in the
+             stacked arrays.
+    """
+    entries = []
+    for val in blocks:
+        for i, block in enumerate(blocks[val]):
+            entries.append((val, i, block.copy().dropna(subset=['GGLAT','GGLON'])))
+    offsets = np.concatenate([[0], np.cumsum([len(block) for _, _, block in entries])]).astype(int)
+    return entries, offsets
+
+def gather_points(da, ti, yi, xi):
+    """
+    Read da[ti, yi, xi] for 1-D index arrays, touching each distinct gridpoint only once.
+    With dask-backed `da` only the chunks containing those points are loaded.
+    """
+    shape = da.shape
+    flat = np.ravel_multi_index((ti, yi, xi), shape)
+    uniq, inv = np.unique(flat, return_inverse=True)
+    ut, uy, ux = np.unravel_index(uniq, shape)
+    dims = da.dims
+    vals = da.isel({dims[0]: xr.DataArray(ut, dims='points'),
+                    dims[1]: xr.DataArray(uy, dims='points'),
+                    dims[2]: xr.DataArray(ux, dims='points')}).values
+    return vals[inv.ravel()]
+
+@prof.profiled()
+def collocate_ERA5_pointwise(prims, blocks, fields=ERA5_COLLOCATED):
+    """
+    Collocate ERA5 cloud-controlling factors by evaluating ERA5_DERIVED at the aircraft samples only.
+
+    Instead of computing M, EIS, Tadv, ... on the whole lat/lon box (select_ERA5_4flight), only the
+    primitive inputs at the nearest (time, gridpoint) of each sample are gathered -- plus the four
+    neighbours the SST gradient in Tadv needs -- and the formulas are evaluated on those 1-D arrays.
+    Results match collocate_ERA5_dat(select_ERA5_4flight(...), blocks).
+
+    :param prims: dict of lazy DataArrays from load_ERA5_primitives.
+    :param blocks: dict of lists of block DataFrames (output of block_flight).
+    :param fields: dict of output column -> ERA5 field name (primitive or ERA5_DERIVED).
+
+    :return: `blocks`, updated in place with one column per entry in `fields`.
+    """
+    targets = list(dict.fromkeys(fields.values()))
+    prim_names, stencils = ERA5_required_inputs(targets)
+    grid_names = sorted((prim_names - {'latitude'}) | {ERA5_STENCIL[s][0] for s in stencils})
+    ds = xr.Dataset({name: prims[name] for name in grid_names})
+    locate = ERA5_grid_locator(ds)
+
+    entries, offsets = stack_blocks(blocks)
+    if offsets[-1] > 0:
+        stacked = pd.concat([block[['GGLAT','GGLON','Time']] for _, _, block in entries])
+        ti, yi, xi = locate(stacked['GGLAT'].values, stacked['GGLON'].values, stacked['Time'].values)
+
+        lat_vals = ds['latitude'].values
+        inputs = {'latitude': lat_vals[yi]}
+        for name in grid_names:
+            if name in prim_names:
+                inputs[name] = gather_points(ds[name].transpose('time','latitude','longitude'), ti, yi, xi)
+
+        # Centred differences from the neighbouring gridpoints (one-sided at the box edge)
+        for name in stencils:
+            field, dim = ERA5_STENCIL[name]
+            da = ds[field].transpose('time','latitude','longitude')
+            coord = ds[dim].values
+            idx = yi if dim == 'latitude' else xi
+            lo = np.clip(idx - 1, 0, len(coord) - 1)
+            hi = np.clip(idx + 1, 0, len(coord) - 1)
+            if dim == 'latitude':
+                both = gather_points(da, np.r_[ti, ti], np.r_[lo, hi], np.r_[xi, xi])
+            else:
+                both = gather_points(da, np.r_[ti, ti], np.r_[yi, yi], np.r_[lo, hi])
+            n = len(idx)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                inputs[name] = (both[n:] - both[:n]) / (coord[hi] - coord[lo])
+
+        derived = eval_ERA5_derived(targets, inputs)
+
+    for k, (val, i, block) in enumerate(entries):
+        sl = slice(offsets[k], offsets[k + 1])
+        if len(block) > 0:
+            for out_name, field in fields.items():
+                block[out_name] = np.asarray(derived[field])[sl]
+        blocks[val][i] = block
+
+    return blocks
+
+#---------------------------------------------------------
+#----- Dropsonde collocation with ERA5 / CESM ------------
+#---------------------------------------------------------
+# ERA5 pressure-level variables interpolated to the sonde levels
+SONDE_ERA5_VARS = {'T': 't', 'Q': 'q', 'U': 'u', 'V': 'v', 'R': 'r'}
+
+# Model variable -> (sonde column, offset added to the sonde value to match model units)
+SONDE_DIFFS = {'T': ('Temp', 273.15), 'U': ('Ucmp', 0.0), 'V': ('Vcmp', 0.0), 'R': ('RH', 0.0)}
+
+def sonde_track(sondes):
+    """
+    Turn the long sonde table from inform.read_sondes into a track the ERA5/CESM collocation can use:
+    absolute Time, GGLAT, GGLON and PSXC (hPa) columns, levels without position or pressure dropped.
+    """
+    track = sondes.copy()
+    track['Time'] = pd.to_datetime(track['release_time']) + pd.to_timedelta(track['Time'], unit='s')
+    track['GGLAT'], track['GGLON'], track['PSXC'] = track['Lat'], track['Lon'], track['Press']
+    track = track.dropna(subset=['GGLAT', 'GGLON', 'PSXC'])
+    return track.sort_values(['release_time', 'sonde_id', 'Time'], kind='stable').reset_index(drop=True)
+
+def sonde_differences(track, label):
+    """Add d<var>_<label> = sonde - model columns for every SONDE_DIFFS variable the model provides."""
+    for var, (col, offset) in SONDE_DIFFS.items():
+        if f"{label}_{var}" in track.columns and col in track.columns:
+            track[f"d{var}_{label}"] = track[col] + offset - track[f"{label}_{var}"]
+    return track
+
+def _sonde_surface_rows(track):
+    # Lowest (highest-pressure) level of every sonde
+    return track.groupby('sonde_id', sort=False)['PSXC'].idxmax().to_numpy()
+
+def collocate_sondes_ERA5(track, campaign, era5_root=ERA5_ROOT, plev=None, prims=None):
+    """
+    Collocate every sonde level with ERA5 in one vectorized pass.
+
+    All levels of all sondes are located on the ERA5 grid together (ERA5_grid_locator), their
+    pressure-level columns are gathered from the band loaded by load_ERA5_plev_band and
+    interpolated log-linearly to the sonde pressures with interp_log_pressure. The ERA5 surface
+    fields EIS needs (SSTK, VAR_2T) are gathered at each sonde's lowest level.
+
+    :param track: Output of sonde_track.
+    :param campaign: 'SOCRATES' or 'CSET' (sets the longitude convention).
+    :param era5_root: Root of the ERA5 tree.
+    :param plev: Pressure-level band (load_ERA5_plev_band), loaded for the sondes if not given.
+    :param prims: Surface/primitive fields (load_ERA5_primitives), opened lazily if not given.
+
+    :return: `track` with ERA5_<var> and d<var>_ERA5 columns per level and per-sonde ERA5_SSTK and
+             ERA5_VAR_2T columns.
+    """
+    if plev is None:
+        plev = load_ERA5_plev_band(track, campaign, SONDE_ERA5_VARS, era5_root)
+    locate = ERA5_grid_locator(plev)
+    ti, yi, xi = locate(track['GGLAT'].values, track['GGLON'].values, track['Time'].values)
+    p_levels = plev['level'].values.astype(float)
+    p_target = track['PSXC'].values.astype(float)
+    for var in plev.data_vars:
+        track[f"ERA5_{var}"] = interp_log_pressure(p_levels, plev[var].values[ti, :, yi, xi], p_target)
+    sonde_differences(track, 'ERA5')
+
+    if prims is None:
+        prims = load_ERA5_primitives(track, campaign, era5_root)
+    sfc = _sonde_surface_rows(track)
+    ti, yi, xi = ERA5_grid_locator(prims['SSTK'])(track['GGLAT'].values[sfc], track['GGLON'].values[sfc],
+                                                  track['Time'].values[sfc])
+    per_sonde = pd.DataFrame({name: gather_points(prims[name], ti, yi, xi) for name in ('SSTK', 'VAR_2T')},
+                             index=track['sonde_id'].values[sfc])
+    for name in per_sonde.columns:
+        track[f"ERA5_{name}"] = track['sonde_id'].map(per_sonde[name]).to_numpy()
+    return track
+
+def profile_at_pressure(track, col, p_target, group='sonde_id', pres_col='PSXC'):
+    """
+    Log-linear interpolation of `col` to one pressure in every profile at once.
+
+    :return: Series indexed by `group` (NaN for profiles that do not span p_target).
+    """
+    p = track[pres_col].to_numpy(dtype=float)
+    v = track[col].to_numpy(dtype=float)
+    ok = np.isfinite(p) & np.isfinite(v)
+    d = pd.DataFrame({group: track[group].to_numpy()[ok], 'p': p[ok], 'v': v[ok]}).sort_values('p', kind='stable')
+    above = d[d['p'] <= p_target].groupby(group).tail(1).set_index(group)
+    below = d[d['p'] >= p_target].groupby(group).head(1).set_index(group)
+    j = above.join(below, lsuffix='_a', rsuffix='_b', how='inner')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.log(p_target / j['p_a']) / np.log(j['p_b'] / j['p_a'])
+    out = j['v_a'] + w.fillna(0) * (j['v_b'] - j['v_a'])
+    return out.reindex(pd.unique(track[group]))
+
+def inversion_height(track, temp_col, group='sonde_id', alt_col='Alt', pres_col='PSXC', dz=50., max_alt=4000.):
+    """
+    Height of the strongest potential-temperature inversion below max_alt in every profile.
+
+    Potential temperature is averaged in dz layers per profile (one grouped reduction) and the
+    inversion is the midpoint of the layer pair with the largest d(theta)/dz.
+
+    :param temp_col: Temperature column in K.
+
+    :return: Series of inversion heights (same units as alt_col) indexed by `group`.
+    """
+    z = track[alt_col].to_numpy(dtype=float)
+    with np.errstate(invalid='ignore'):
+        theta = track[temp_col].to_numpy(dtype=float) * (1000. / track[pres_col].to_numpy(dtype=float))**kappa
+    ok = np.isfinite(z) & np.isfinite(theta) & (z >= 0) & (z <= max_alt)
+    d = pd.DataFrame({group: track[group].to_numpy()[ok], 'zbin': np.floor(z[ok] / dz), 'theta': theta[ok]})
+    prof = d.groupby([group, 'zbin'], sort=True)['theta'].mean().reset_index()
+    same = prof[group].eq(prof[group].shift()).to_numpy()
+    dzbin = prof['zbin'].diff().to_numpy()
+    prof['grad'] = np.where(same, prof['theta'].diff().to_numpy() / (dzbin * dz), np.nan)
+    prof['z_mid'] = (prof['zbin'] - dzbin / 2 + 0.5) * dz
+    prof = prof.dropna(subset=['grad'])
+    best = prof.loc[prof.groupby(group)['grad'].idxmax()]
+    return best.set_index(group)['z_mid'].reindex(pd.unique(track[group]))
+
+def sonde_profile_summary(track, sources=('ERA5', 'CESM'), alt_col='Alt'):
+    """
+    Per-sonde inversion height, LTS and EIS from the sonde and from each collocated model.
+
+    EIS uses the same ERA5_DERIVED graph as the flight factors: T700 is interpolated from each
+    profile, VAR_2T is the profile's lowest level (or <source>_VAR_2T if present) and SSTK comes from
+    <source>_SSTK (the sonde uses ERA5's, else CESM's).
+
+    :param track: Sonde track with collocated <source>_T columns (collocate_sondes_ERA5,
+                  inform_grid_utils.collocate_sondes_CESM).
+    :param sources: Model labels to summarize; missing ones are skipped.
+
+    :return: DataFrame indexed by sonde_id with release_time, lat, lon and zi_, LTS_, EIS_ columns
+             for the sonde and every source, plus dzi_/dEIS_<source> = sonde - model.
+    """
+    sources = [s for s in sources if f"{s}_T" in track.columns]
+    sfc = _sonde_surface_rows(track)
+    sonde_ids = track['sonde_id'].values[sfc]
+    out = pd.DataFrame({'release_time': track['release_time'].values[sfc], 'lat': track['GGLAT'].values[sfc],
+                        'lon': track['GGLON'].values[sfc]}, index=pd.Index(sonde_ids, name='sonde_id'))
+
+    track = track.assign(sonde_T=track['Temp'] + 273.15)
+    sst = next((f"{s}_SSTK" for s in sources if f"{s}_SSTK" in track.columns), None)
+    for label in ['sonde'] + sources:
+        t_col = f"{label}_T"
+        t2 = f"{label}_VAR_2T" if f"{label}_VAR_2T" in track.columns else t_col
+        inputs = {
+            'T700': profile_at_pressure(track, t_col, 700.).reindex(sonde_ids).to_numpy(),
+            'VAR_2T': track[t2].to_numpy(dtype=float)[sfc],
+            'SSTK': track[f"{label}_SSTK" if f"{label}_SSTK" in track.columns else sst].to_numpy(dtype=float)[sfc]
+            if sst else np.full(len(sfc), np.nan),
+        }
+        derived = eval_ERA5_derived(['LTS', 'EIS'], inputs)
+        out[f"zi_{label}"] = inversion_height(track, t_col, alt_col=alt_col).reindex(sonde_ids).to_numpy()
+        out[f"LTS_{label}"] = derived['LTS']
+        out[f"EIS_{label}"] = derived['EIS']
+    for label in sources:
+        out[f"dzi_{label}"] = out['zi_sonde'] - out[f"zi_{label}"]
+        out[f"dEIS_{label}"] = out['EIS_sonde'] - out[f"EIS_{label}"]
+    return out
+
+# Regime rules per campaign, see config/cloud_regimes.yml
+REGIME_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', 'cloud_regimes.yml')
+
+CONDITION_OPS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+}
+_CONDITION_RE = re.compile(r"^\s*([A-Za-z_]\w*)\s*(<=|>=|==|<|>)\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*$")
+
+def parse_condition(text):
+    """
+    Parse a condition such as "M <= -10" into (column, op, value).
+
+    :raises ValueError: If the text is not of the form "<column> <op> <number>".
+    """
+    m = _CONDITION_RE.match(str(text))
+    if not m:
+        raise ValueError(f"Cannot parse condition '{text}' (expected e.g. 'M <= -10')")
+    return m.group(1), m.group(2), float(m.group(3))
+
+def load_regime_rules(path=REGIME_RULES_PATH):
+    """Read the campaign -> regime rule definitions from a YAML file."""
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+def compile_regime_rules(spec):
+    """
+    Compile one campaign's rule definition into condition tuples and integer category codes.
+
+    :param spec: dict with 'default' (label) and 'regimes' (list of {'name', 'any': [[cond, ...], ...]}).
+
+    :return: dict with 'categories' (code -> label, default is code 0), 'columns' (columns the
+             rules read) and 'rules' (list of (code, clauses) in the order they are applied).
+    """
+    categories = [spec.get('default', 'Unknown')]
+    rules, columns = [], set()
+    for regime in spec['regimes']:
+        if regime['name'] not in categories:
+            categories.append(regime['name'])
+        clauses = [[parse_condition(c) for c in clause] for clause in regime['any']]
+        columns.update(col for clause in clauses for col, _, _ in clause)
+        rules.append((categories.index(regime['name']), clauses))
+    return {'categories': categories, 'columns': sorted(columns), 'rules': rules}
+
+def regime_codes(columns, compiled, n):
+    """
+    Evaluate compiled regime rules on column arrays.
+
+    :param columns: Mapping of column name -> 1-D array (missing columns never match).
+    :param compiled: Output of compile_regime_rules.
+    :param n: Number of samples.
+
+    :return: int8 array of category codes into compiled['categories'].
+    """
+    codes = np.zeros(n, dtype=np.int8)
+    arrays, masks = {}, {}
+    for code, clauses in compiled['rules']:
+        hit = np.zeros(n, dtype=bool)
+        for clause in clauses:
+            clause_hit = np.ones(n, dtype=bool)
+            for cond in clause:
+                if cond not in masks:
+                    col, op, value = cond
+                    if col not in arrays:
+                        arrays[col] = np.asarray(columns[col], dtype=float) if col in columns else None
+                    if arrays[col] is None:
+                        masks[cond] = np.zeros(n, dtype=bool)
+                    else:
+                        with np.errstate(invalid='ignore'):
+                            masks[cond] = CONDITION_OPS[op](arrays[col], value)   # NaN -> False
+                clause_hit &= masks[cond]
+            hit |= clause_hit
+        codes[hit] = code
+    return codes
+
+def _get_compiled_rules(campaign, rules):
+    if rules is None:
+        rules = load_regime_rules()
+    if campaign not in rules:
+        raise ValueError(f"No cloud regime rules for campaign '{campaign}' (have: {list(rules)})")
+    spec = rules[campaign]
+    return spec if 'rules' in spec else compile_regime_rules(spec)
+
+def assign_cloud_regime(df, campaign, rules=None):
+    """
+    Assign cloud regimes to every row of a DataFrame in one vectorized pass, e.g. the composited
+    dataset of all flights of a campaign.
+
+    :param df: DataFrame with the ERA5 columns the rules use (M, Wind_sp, RH700, ...).
+    :param campaign: Key into the rules, e.g. 'SOCRATES' or 'CSET'.
+    :param rules: dict of campaign -> rule spec (or compiled rules). Defaults to config/cloud_regimes.yml.
+
+    :return: pandas Categorical of regime labels (stored as small integer codes).
+    """
+    compiled = _get_compiled_rules(campaign, rules)
+    codes = regime_codes(df, compiled, len(df))
+    return pd.Categorical.from_codes(codes, categories=compiled['categories'])
+
+def cloud_regime_old(fblks):
+    return cloud_regime(fblks, 'SOCRATES_old')
+
+@prof.profiled()
+def cloud_regime(fblks, campaign, rules=None):
+    """
+    Assign cloud_regime per block using the rules for `campaign` in config/cloud_regimes.yml
+    (or `rules`, a dict with the same layout). The rules are evaluated once over the samples of
+    all blocks and each block gets a categorical 'cloud_regime' column.
       - For CSET:
           Stratocumulus if any of:
               1) M < -10 & RH700 > 30
               2) M < -10 & ERA5_SST < 295
-              3) M < -11 & Tadv < 0
+              3) M < -10 & Tadv < 0
           Open-cell Cumulus if any of:
               1) M >= -10 & RH700 <= 30
               2) M >= -10 & ERA5_SST >= 296
               3) M >= -10 & Tadv >= 0.0005   # assume same units as your Tadv column (ideally K/day)
-        - For SOCRATES: (keeps your existing rules)
+        - For SOCRATES:
+          Open-Cell if M > -7 and (Wind_shear < 6 or Wind_sp > 10);
+          Stratocumulus if M <= -10 or Wind_shear > 6 (overrides Open-Cell)
     """
-    import numpy as np
-    import pandas as pd
+    compiled = _get_compiled_rules(campaign, rules)
 
-    for val in fblks:
-        block_type = fblks[val]
-        for i in range(len(block_type)):
-            block = block_type[i].copy()
-
-            # default class
-            block['cloud_regime'] = pd.Series('Unknown', index=block.index, dtype='object')
-
-            if campaign == 'SOCRATES':
-                condition_cum = ((block['M'] > -7) & (block['Wind_shear'] < 6)) | \
-                                ((block['M'] > -7) & (block['Wind_sp'] > 10))
-                condition_strcu = ((block['M'] <= -10) & (block['Wind_sp'] < 10)) | \
-                                  ((block['M'] <= -10) | (block['Wind_shear'] > 6))
-
-                block.loc[condition_cum,  'cloud_regime'] = 'Open-Cell'
-                block.loc[condition_strcu,'cloud_regime'] = 'Stratocumulus'  # or 'Closed-Cell' if you prefer
-
-            elif campaign == 'CSET':
-                # Safely get needed variables (treat missing as NaN so conditions become False)
-                M    = block['M']
-                RH   = block.get('RH700',     pd.Series(np.nan, index=block.index))
-                SST  = block.get('ERA5_SST',  block.get('sst', pd.Series(np.nan, index=block.index)))
-                Tadv = block.get('Tadv',      pd.Series(np.nan, index=block.index))
-
-                # --- Stratocumulus (any of the three) ---
-                cond_strat = (
-                    ((M < -10) & (RH > 30)) |
-                    ((M < -10) & (SST < 295)) |
-                    ((M < -10) & (Tadv < 0))
-                )
+    entries = [(val, i, block) for val in fblks for i, block in enumerate(fblks[val])]
+    offsets = np.concatenate([[0], np.cumsum([len(block) for _, _, block in entries])]).astype(int)
+    columns = {}
+    for col in compiled['columns']:
+        if any(col in block for _, _, block in entries):
+            columns[col] = np.concatenate([block[col].to_numpy(dtype=float) if col in block
+                                           else np.full(len(block), np.nan) for _, _, block in entries])
+    codes = regime_codes(columns, compiled, int(offsets[-1]))
 
-                # --- Open-cell Cumulus (any of the three) ---
-                cond_opencu = (
-                    ((M >= -10) & (RH <= 30)) |
-                    ((M >= -10) & (SST >= 296)) |
-                    ((M >= -10) & (Tadv >= 0.0005))  # assumes Tadv units match your data (recommended: K/day)
-                )
+    for k, (val, i, block) in enumerate(entries):
+        block['cloud_regime'] = pd.Categorical.from_codes(codes[offsets[k]:offsets[k + 1]],
+                                                          categories=compiled['categories'])
 
-                # Apply labels
-                block.loc[cond_strat,  'cloud_regime'] = 'Stratocumulus'
-                block.loc[cond_opencu, 'cloud_regime'] = 'Open-Cell'
+    return fblks
 
-            # write back
-            block_type[i] = block
-        fblks[val] = block_type
+@prof.profiled()
+def write_RF_nc(fblks_cr, rf, campaign='CSET', layout='flat', store_root=None, sketches=True,
+                block_summary=True, **ragged_kw):
+    """
+    Write one flight's blocks to f"{campaign}_{rf}.nc".
+
+    :param layout: 'flat' (one row per sample with block_label/block_index columns) or 'ragged'
+                   (CF contiguous ragged array, see write_RF_nc_ragged; extra keyword arguments
+                   are passed through).
+    :param store_root: If given, also update this flight's partitions of the campaign datastore
+                       (see write_RF_store).
+    :param sketches: Also write per-group quantile sketches next to the output (see write_RF_sketches);
+                     when appending to a ragged file they are merged into the existing sketches.
+    :param block_summary: Also write the per-block summary table next to the output
+                          (see write_RF_block_summary); appended to when appending to a ragged file.
+    """
+    if layout not in ('flat', 'ragged'):
+        raise ValueError(f"Unknown layout '{layout}' (expected 'flat' or 'ragged')")
+    append = layout == 'ragged' and ragged_kw.get('append', False)
+    if store_root is not None:
+        write_RF_store(fblks_cr, rf, campaign, store_root)
+    out = os.path.splitext(ragged_kw.get('path') or f"{campaign}_{rf}.nc")[0]
+    if sketches:
+        write_RF_sketches(fblks_cr, rf, campaign, path=out + "_sketch.json", append=append)
+    if block_summary:
+        write_RF_block_summary(fblks_cr, rf, campaign, path=out + "_blocks.parquet", append=append)
+    if layout == 'ragged':
+        return write_RF_nc_ragged(fblks_cr, rf, campaign, **ragged_kw)
 
-    return fblks
-       
-def write_RF_nc(fblks_cr, rf, campaign='CSET'):
     combined = []
     if isinstance(fblks_cr, dict):
         for label, df_list in fblks_cr.items():
@@ -894,6 +1619,9 @@ def write_RF_nc(fblks_cr, rf, campaign='CSET'):
                 combined.append(df)
 
         df_all = pd.concat(combined, ignore_index=True)
+        # NetCDF has no categorical type; write regime labels as strings
+        cat_cols = df_all.select_dtypes('category').columns
+        df_all[cat_cols] = df_all[cat_cols].astype(object)
         df_all = df_all.set_index(["block_label", "block_index", "Time"])
         ds = df_all.reset_index().to_xarray()
 
@@ -901,19 +1629,451 @@ def write_RF_nc(fblks_cr, rf, campaign='CSET'):
         ds.to_netcdf(name)
         print(f"Wrote {name}")
 
-def plot_block_ts(dict,idx):
+# Units of per-sample times in the ragged layout
+RAGGED_TIME_UNITS = "seconds since 1970-01-01 00:00:00"
+
+# Variables on the 'block' dimension of the ragged layout. A per-sample column with one of these
+# names (e.g. the block_id column of assign_flight_type) is stored as <name>_obs, with the column
+# name in its 'column' attribute.
+RAGGED_BLOCK_VARS = ('flight', 'block_label', 'block_index', 'block_id', 'row_size', 'start_time', 'end_time')
+
+def ragged_obs_name(col):
+    """Variable name of per-sample column `col` in the ragged layout."""
+    return f"{col}_obs" if col in RAGGED_BLOCK_VARS else col
+
+def _seconds_since_epoch(times):
+    t = pd.to_datetime(pd.Series(times)).dt.tz_localize(None)
+    return (t - pd.Timestamp("1970-01-01")).dt.total_seconds().to_numpy()
+
+def write_RF_nc_ragged(fblks_cr, rf, campaign='CSET', path=None, append=False, float32=False,
+                       complevel=4, chunk_obs=8192):
+    """
+    Write (or append) one flight's blocks as a CF discrete-sampling-geometry file using the
+    contiguous ragged array representation (featureType = "trajectory", one feature per block).
+
+    Layout:
+      - 'block' dimension (one row per non-empty block): flight, block_label, block_index (the
+        block's position in its label's list, as in the flat layout), block_id, start_time,
+        end_time and row_size (number of samples, sample_dimension = "obs").
+      - 'obs' dimension (one row per sample, blocks stored contiguously in block order): Time and
+        every block column. Text/categorical columns (flight_type, cloud_regime, ...) are stored as
+        small integer codes with CF flag_values/flag_meanings and the exact labels in the
+        'categories' attribute (JSON).
+    Both dimensions are unlimited, chunked along 'obs' and zlib compressed, so blocks can be
+    streamed into the file as they finish with append=True.
+
+    :param fblks_cr: dict of block label -> list of block DataFrames.
+    :param rf: Flight id, e.g. "RF01".
+    :param campaign: Campaign name, used in the default file name.
+    :param path: Output path; defaults to f"{campaign}_{rf}.nc".
+    :param append: Append to an existing file instead of creating a new one. Block indices continue
+                   after the largest index of the same flight and label already in the file.
+    :param float32: Pack float64 columns (other than Time) as float32.
+    :param complevel: zlib compression level.
+    :param chunk_obs: Chunk length along 'obs'.
+
+    :return: Path of the file written.
+    """
+    name = path or f"{campaign}_{rf}.nc"
+    entries = [(label, i, df) for label, df_list in fblks_cr.items() for i, df in enumerate(df_list)]
+
+    if append and os.path.exists(name):
+        nc = netCDF4.Dataset(name, 'a')
+    else:
+        nc = netCDF4.Dataset(name, 'w')
+        nc.Conventions = "CF-1.8"
+        nc.featureType = "trajectory"
+        nc.campaign = campaign
+        nc.layout = "contiguous_ragged"
+        nc.createDimension('block', None)
+        nc.createDimension('obs', None)
+        for var, dtype in [('flight', str), ('block_label', str), ('block_id', str)]:
+            nc.createVariable(var, dtype, ('block',))
+        nc['block_id'].cf_role = "trajectory_id"
+        nc.createVariable('block_index', 'i4', ('block',))
+        rs = nc.createVariable('row_size', 'i4', ('block',))
+        rs.long_name = "number of samples in this block"
+        rs.sample_dimension = "obs"
+        for var in ('start_time', 'end_time'):
+            v = nc.createVariable(var, 'f8', ('block',))
+            v.units = RAGGED_TIME_UNITS
+        tv = nc.createVariable('Time', 'f8', ('obs',), zlib=True, complevel=complevel,
+                               chunksizes=(chunk_obs,))
+        tv.units = RAGGED_TIME_UNITS
+        tv.standard_name = "time"
+
+    try:
+        n_block = len(nc.dimensions['block'])
+        n_obs = len(nc.dimensions['obs'])
+        offset = {}
+        if n_block:
+            for f_, l_, i_ in zip(nc['flight'][:], nc['block_label'][:], nc['block_index'][:]):
+                offset[(f_, l_)] = max(offset.get((f_, l_), 0), int(i_) + 1)
+
+        for label, i, df in entries:
+            # Empty blocks are not stored but keep their position, as in the flat file and the store
+            if len(df) == 0:
+                continue
+            idx = offset.get((rf, label), 0) + i
+            t = _seconds_since_epoch(df['Time'])
+
+            nc['flight'][n_block] = rf
+            nc['block_label'][n_block] = label
+            nc['block_id'][n_block] = f"{rf}/{label}/{idx}"
+            nc['block_index'][n_block] = idx
+            nc['row_size'][n_block] = len(df)
+            nc['start_time'][n_block] = t[0]
+            nc['end_time'][n_block] = t[-1]
+
+            sl = slice(n_obs, n_obs + len(df))
+            nc['Time'][sl] = t
+            for col in df.columns:
+                if col == 'Time':
+                    continue
+                _write_ragged_column(nc, col, df[col], sl, float32, complevel, chunk_obs)
+            n_block += 1
+            n_obs += len(df)
+    finally:
+        nc.close()
+
+    print(f"Wrote {name}")
+    return name
+
+def _write_ragged_column(nc, col, series, sl, float32, complevel, chunk_obs):
+    """Write one per-sample column into the 'obs' slice `sl`, creating the variable if needed."""
+    name = ragged_obs_name(col)
+    if name not in nc.variables:
+        kw = dict(zlib=True, complevel=complevel, shuffle=True, chunksizes=(chunk_obs,))
+        if isinstance(series.dtype, pd.CategoricalDtype) or series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+            v = nc.createVariable(name, 'i2', ('obs',), fill_value=-1, **kw)
+            v.categories = json.dumps([])
+        elif pd.api.types.is_bool_dtype(series.dtype):
+            v = nc.createVariable(name, 'i1', ('obs',), fill_value=-1, **kw)
+            v.setncattr('dtype', 'bool')
+        elif pd.api.types.is_datetime64_any_dtype(series.dtype):
+            v = nc.createVariable(name, 'f8', ('obs',), fill_value=np.nan, **kw)
+            v.units = RAGGED_TIME_UNITS
+        elif pd.api.types.is_timedelta64_dtype(series.dtype):
+            v = nc.createVariable(name, 'f8', ('obs',), fill_value=np.nan, **kw)
+            v.units = "seconds"
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            # Explicit fill so rows written before the column first appeared read back as missing
+            dtype = 'i4' if series.dtype.itemsize <= 4 else 'i8'
+            v = nc.createVariable(name, dtype, ('obs',), fill_value=np.iinfo(dtype).min, **kw)
+        else:
+            v = nc.createVariable(name, 'f4' if float32 else 'f8', ('obs',), fill_value=np.nan, **kw)
+        if name != col:
+            v.column = col
+    v = nc[name]
+    if v.dimensions != ('obs',):
+        raise ValueError(f"Cannot write column '{col}': variable '{name}' has dimensions {v.dimensions}, not ('obs',)")
+
+    if 'categories' in v.ncattrs():
+        categories = json.loads(v.categories)
+        labels = series.astype(object)
+        present = pd.unique(labels[labels.notna()])
+        new = [str(c) for c in present if str(c) not in categories]
+        if new:
+            categories += new
+            v.categories = json.dumps(categories)
+            v.flag_values = np.arange(len(categories), dtype='i2')
+            v.flag_meanings = " ".join(c.replace(' ', '_') for c in categories)
+        values = np.full(len(labels), -1, dtype='i2')
+        mask = labels.notna().to_numpy()
+        values[mask] = pd.Categorical(labels[mask].astype(str), categories=categories).codes
+    elif pd.api.types.is_datetime64_any_dtype(series.dtype):
+        values = _seconds_since_epoch(series)
+    elif pd.api.types.is_timedelta64_dtype(series.dtype):
+        values = series.dt.total_seconds().to_numpy()
+    elif pd.api.types.is_bool_dtype(series.dtype):
+        values = series.to_numpy().astype('i1')
+    else:
+        values = series.to_numpy()
+    v[sl] = values
+
+# Campaign datastore: <store_root>/campaign=<c>/flight=<rf>/block_label=<label>/part.parquet
+# plus <store_root>/manifest.json describing every partition
+STORE_MANIFEST = "manifest.json"
+
+def load_store_manifest(store_root):
+    """Read the datastore manifest (an empty one if the store does not exist yet)."""
+    path = os.path.join(store_root, STORE_MANIFEST)
+    if not os.path.exists(path):
+        return {"version": 1, "partitions": []}
+    with open(path) as f:
+        return json.load(f)
+
+def _write_store_manifest(store_root, manifest):
+    # Write to a temporary file and rename so readers never see a half-written manifest
+    path = os.path.join(store_root, STORE_MANIFEST)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+
+def _partition_stats(df):
+    """Row count, time range, bbox and per-column min/max of one partition, for query pruning."""
+    stats = {}
+    for col in df.select_dtypes('number').columns:
+        lo, hi = df[col].min(), df[col].max()
+        if pd.notna(lo):
+            stats[col] = [float(lo), float(hi)]
+    entry = {
+        "rows": int(len(df)),
+        "n_blocks": int(df["block_index"].nunique()),
+        "time_min": str(df["Time"].min()),
+        "time_max": str(df["Time"].max()),
+        "bbox": None,
+        "stats": stats,
+    }
+    if "GGLAT" in stats and "GGLON" in stats:
+        entry["bbox"] = [stats["GGLON"][0], stats["GGLAT"][0], stats["GGLON"][1], stats["GGLAT"][1]]
+    return entry
+
+def write_RF_store(fblks_cr, rf, campaign, store_root):
+    """
+    Write (or rewrite) one flight's partitions of the columnar campaign datastore.
+
+    Each block label of the flight becomes one parquet file
+    <store_root>/campaign=<campaign>/flight=<rf>/block_label=<label>/part.parquet holding its blocks
+    (block_index identifies the block; campaign, flight and block_label are implied by the path).
+    manifest.json records each partition's row count, time range, GGLON/GGLAT bbox and column
+    min/max. Reprocessing a flight replaces only that flight's directory and manifest entries.
+
+    :param fblks_cr: dict of block label -> list of block DataFrames.
+    :param rf: Flight id, e.g. "RF01".
+    :param campaign: Campaign name.
+    :param store_root: Root directory of the datastore.
+
+    :return: List of the manifest entries written.
+    """
+    flight_rel = os.path.join(f"campaign={campaign}", f"flight={rf}")
+    flight_dir = os.path.join(store_root, flight_rel)
+    tmp_dir, old_dir = flight_dir + ".tmp", flight_dir + ".old"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    if os.path.exists(old_dir):
+        # Left over from an interrupted swap: restore it if the flight directory never came back
+        if os.path.exists(flight_dir):
+            shutil.rmtree(old_dir)
+        else:
+            os.replace(old_dir, flight_dir)
+
+    entries = []
+    for label, df_list in fblks_cr.items():
+        frames = [df.assign(block_index=i) for i, df in enumerate(df_list) if len(df)]
+        if not frames:
+            continue
+        df = pd.concat(frames, ignore_index=True)
+        part_rel = os.path.join(flight_rel, f"block_label={urllib.parse.quote(label, safe='')}")
+        os.makedirs(os.path.join(tmp_dir, os.path.basename(part_rel)))
+        df.to_parquet(os.path.join(tmp_dir, os.path.basename(part_rel), "part.parquet"), index=False)
+        entry = {"path": os.path.join(part_rel, "part.parquet"), "campaign": campaign, "flight": rf,
+                 "block_label": label}
+        entry.update(_partition_stats(df))
+        entries.append(entry)
+
+    # Swap the new flight directory in (the old one is moved aside, not deleted, until the new one
+    # and the manifest are in place), then update the manifest
+    if os.path.exists(flight_dir):
+        os.replace(flight_dir, old_dir)
+    if os.path.exists(tmp_dir):
+        os.replace(tmp_dir, flight_dir)
+    manifest = load_store_manifest(store_root)
+    manifest["partitions"] = [p for p in manifest["partitions"]
+                              if not (p["campaign"] == campaign and p["flight"] == rf)] + entries
+    _write_store_manifest(store_root, manifest)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    print(f"Wrote {len(entries)} partitions to {flight_dir}")
+    return entries
+
+# Columns summarized by quantile sketches (plus any CONCD*/PLWC* probe columns present)
+SKETCH_VARIABLES = ('ATX', 'WIC', 'GGALT', 'PSXC', 'ERA5_SST', 'M', 'w700', 'deltaT', 'Wind_sp', 'Wind_shear',
+                    'Tadv', 'RH700', 'EIS')
+
+def _merge_sketch_groups(old, new, delta):
+    """Merge two lists of sketch groups, combining the digests of groups with the same (block_label, cloud_regime)."""
+    merged = {(g['block_label'], g['cloud_regime']): g for g in old}
+    for g in new:
+        key = (g['block_label'], g['cloud_regime'])
+        if key not in merged:
+            merged[key] = g
+            continue
+        digests = dict(merged[key]['digests'])
+        for c, d in g['digests'].items():
+            if c in digests:
+                d = sk.digest_to_dict(sk.merge_digests([sk.digest_from_dict(digests[c]), sk.digest_from_dict(d)], delta))
+            digests[c] = d
+        merged[key] = dict(g, count=merged[key]['count'] + g['count'], digests=digests)
+    return list(merged.values())
+
+def write_RF_sketches(fblks_cr, rf, campaign='CSET', path=None, variables=None, delta=sk.DEFAULT_DELTA,
+                      append=False):
+    """
+    Build t-digest quantile sketches of one flight per (block_label, cloud_regime) and save them as
+    JSON (f"{campaign}_{rf}_sketch.json" by default).
+
+    Sketches from many flights merge into campaign or multi-campaign quantiles without rereading
+    the samples (see composite_utils.sketch_quantiles).
+
+    :param variables: Columns to sketch; defaults to SKETCH_VARIABLES plus CONCD*/PLWC* columns.
+    :param delta: t-digest compression.
+    :param append: Merge into the sketches already in the file (for blocks appended to a ragged
+                   file) instead of replacing them.
+
+    :return: Path of the file written.
+    """
+    name = path or f"{campaign}_{rf}_sketch.json"
+    groups = []
+    for label, df_list in fblks_cr.items():
+        frames = [df for df in df_list if len(df)]
+        if not frames:
+            continue
+        df = pd.concat(frames, ignore_index=True)
+        cols = list(variables) if variables is not None else \
+            list(SKETCH_VARIABLES) + [c for c in df.columns if c.startswith(('CONCD', 'PLWC'))]
+        cols = [c for c in cols if c in df.columns and pd.api.types.is_numeric_dtype(df[c])]
+        regimes = df['cloud_regime'].astype(object) if 'cloud_regime' in df.columns else pd.Series(None, index=df.index)
+        for regime, sub in df.groupby(regimes.fillna('None'), sort=False):
+            groups.append({
+                'block_label': label,
+                'cloud_regime': None if regime == 'None' else regime,
+                'count': int(len(sub)),
+                'digests': {c: sk.digest_to_dict(sk.build_digest(sub[c].to_numpy(), delta)) for c in cols},
+            })
+    if append and os.path.exists(name):
+        with open(name) as f:
+            groups = _merge_sketch_groups(json.load(f)['groups'], groups, delta)
+    with open(name, 'w') as f:
+        json.dump({'campaign': campaign, 'flight': rf, 'delta': delta, 'groups': groups}, f)
+    print(f"Wrote {name}")
+    return name
+
+# Per-block statistics: column -> aggregations (CONCD*/PLWC* probe columns get mean and std)
+BLOCK_SUMMARY_STATS = {
+    'ATX': ('mean', 'std'),
+    'WIC': ('mean', 'std'),
+    'GGLAT': ('mean',),
+    'GGLON': ('mean',),
+    'GGALT': ('mean', 'min', 'max'),
+    'PSXC': ('mean',),
+    'ERA5_SST': ('mean',),
+    'M': ('mean',),
+    'EIS': ('mean',),
+    'deltaT': ('mean',),
+    'Wind_sp': ('mean',),
+    'Wind_shear': ('mean',),
+    'Tadv': ('mean',),
+    'RH700': ('mean',),
+    'w700': ('mean',),
+}
+
+def summarize_blocks(fblks_cr, rf=None, stats=None):
+    """
+    One row of statistics per block, computed in a single grouped reduction over the flight.
+
+    :param fblks_cr: dict of block label -> list of block DataFrames.
+    :param rf: Flight id, added as a column if given.
+    :param stats: dict of column -> tuple of pandas aggregation names; defaults to
+                  BLOCK_SUMMARY_STATS plus mean/std of CONCD*/PLWC* columns. Missing columns are skipped.
+
+    :return: DataFrame with flight, block_label, block_index, start_time, end_time, duration_s,
+             n_samples, cloud_regime (most frequent in the block) and <column>_<stat> columns.
+    """
+    frames = [df.assign(block_label=label, block_index=i)
+              for label, df_list in fblks_cr.items() for i, df in enumerate(df_list) if len(df)]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    keys = ['block_label', 'block_index']
+    if stats is None:
+        stats = dict(BLOCK_SUMMARY_STATS)
+        stats.update({c: ('mean', 'std') for c in df.columns if c.startswith(('CONCD', 'PLWC'))})
+
+    aggs = {'start_time': ('Time', 'min'), 'end_time': ('Time', 'max'), 'n_samples': ('Time', 'size')}
+    aggs.update({f"{col}_{stat}": (col, stat) for col, col_stats in stats.items()
+                 if col in df.columns for stat in col_stats})
+    summary = df.groupby(keys, sort=False).agg(**aggs)
+    summary.insert(2, 'duration_s', (summary['end_time'] - summary['start_time']).dt.total_seconds())
+
+    if 'cloud_regime' in df.columns:
+        counts = df.groupby(keys + ['cloud_regime'], sort=False, observed=True).size()
+        counts = counts[counts > 0].sort_values(ascending=False, kind='stable')
+        top = counts.reset_index().drop_duplicates(keys).set_index(keys)['cloud_regime']
+        summary.insert(4, 'cloud_regime', top.reindex(summary.index).astype(object))
+
+    summary = summary.reset_index()
+    if rf is not None:
+        summary.insert(0, 'flight', rf)
+    return summary
+
+def write_RF_block_summary(fblks_cr, rf, campaign='CSET', path=None, stats=None, append=False):
+    """
+    Write the per-block summary table of one flight (summarize_blocks) to parquet,
+    f"{campaign}_{rf}_blocks.parquet" by default.
+
+    :param append: Add the rows to the table already in the file (for blocks appended to a ragged
+                   file); block indices continue after the largest index of the same flight and
+                   label, as in write_RF_nc_ragged.
 
+    :return: Path of the file written.
+    """
+    name = path or f"{campaign}_{rf}_blocks.parquet"
+    summary = summarize_blocks(fblks_cr, rf, stats)
+    summary.insert(0, 'campaign', campaign)
+    if append and os.path.exists(name):
+        old = pd.read_parquet(name)
+        if len(summary):
+            start = (old.groupby(['flight', 'block_label'])['block_index'].max() + 1).reindex(
+                pd.MultiIndex.from_arrays([summary['flight'], summary['block_label']]), fill_value=0)
+            summary['block_index'] = start.to_numpy() + summary['block_index'].to_numpy()
+        summary = pd.concat([old, summary], ignore_index=True)
+    summary.to_parquet(name, index=False)
+    print(f"Wrote {name}")
+    return name
+
+def _time_spans(ax, start, end, facecolors, alpha):
+    """
+    Shade [start, end] time intervals over the full height of ax as one collection
+    (instead of one axvspan per interval).
+    """
+    import matplotlib.dates as mdates
+
+    x0 = mdates.date2num(pd.to_datetime(pd.Series(start)))
+    x1 = mdates.date2num(pd.to_datetime(pd.Series(end)))
+    return ax.broken_barh(list(zip(x0, x1 - x0)), (0, 1), transform=ax.get_xaxis_transform(),
+                          facecolors=facecolors, alpha=alpha, linewidth=0)
+
+def _layer_spans(ax, lower, upper, facecolor, alpha):
+    """Shade [lower, upper] altitude layers over the full width of ax as one collection."""
+    from matplotlib.collections import PolyCollection
+
+    lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+    verts = [[(0, lo), (1, lo), (1, hi), (0, hi)] for lo, hi in zip(lower, upper)]
+    return ax.add_collection(PolyCollection(verts, transform=ax.get_yaxis_transform(),
+                                            facecolors=facecolor, alpha=alpha, linewidth=0))
+
+def plot_block_ts(dict, idx, campaign='CSET', out_dir='.', dpi=300):
+    """
+    Altitude time series of a flight with its level legs / profiles shaded, next to the CDP
+    concentration and LWC profiles with the cloud layers shaded. Saved to
+    f"{out_dir}/{campaign}_Altitude_Flight_Cloud_typeRF_{idx+1:02d}.png".
+
+    :param dict: Output of assign_flight_type ('DataFrame', 'flight_blocks', 'Cloud_blocks').
+    :param idx: Flight index (0-based).
+
+    :return: The figure.
+    """
     import matplotlib.pyplot as plt
     import matplotlib.gridspec as gridspec
     import matplotlib.dates as mdates
-    import numpy as np
-    import pandas as pd
+    from matplotlib.patches import Patch
 
     # Assuming the four DataFrames are already created
     # profile_in_cloud, level_in_cloud, level_out_cloud_bl, level_out_cloud_fr
     # Dict = assign_flight_type(df)
     df = dict['DataFrame']
-    # print(df)
     blocks = dict['flight_blocks']
     incloud = dict['Cloud_blocks']
     # Creating the four DataFrames based on flight_type, cloud status, and Location
@@ -946,20 +2106,23 @@ def plot_block_ts(dict,idx):
     ax1.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d %H:%M'))  # Adjust format as needed
     fig.autofmt_xdate()
 
-    # Shade blocks according to their type (level or profile)
-    for _, row in blocks.iterrows():
-        start_time, end_time, flight_type = row['start_time'], row['end_time'], row['flight_type']
-        if flight_type == 'level':
-            ax1.axvspan(start_time, end_time, color='blue', alpha=0.3, label="Level leg" if 'Level leg' not in ax1.get_legend_handles_labels()[1] else None)
-        elif flight_type == 'profile':
-            ax1.axvspan(start_time, end_time, color='goldenrod', alpha=0.5, label="Profiling" if 'Profiling' not in ax1.get_legend_handles_labels()[1] else None)
+    # Shade blocks according to their type (level or profile), one collection per type;
+    # the legend gets one proxy patch per type
+    handles, labels = ax1.get_legend_handles_labels()
+    for flight_type, color, alpha, label in [('level', 'blue', 0.3, 'Level leg'),
+                                             ('profile', 'goldenrod', 0.5, 'Profiling')]:
+        sel = blocks[blocks['flight_type'] == flight_type]
+        if len(sel):
+            _time_spans(ax1, sel['start_time'], sel['end_time'], color, alpha)
+            handles.append(Patch(facecolor=color, alpha=alpha))
+            labels.append(label)
 
     # Labels and title
     ax1.set_xlabel('Time UTC (MM-dd HH:mm)')
     ax1.set_ylabel('Altitude (m)')
     ax1.set_title('Altitude Time Series separating into "Level legs" and "Profiles"')
     ax1.set_ylim(-200, np.max(df['GGALT'] + 600))
-    ax1.legend(loc='upper right', ncol=6, markerscale=6,fontsize=8)
+    ax1.legend(handles, labels, loc='upper right', ncol=6, markerscale=6,fontsize=8)
     ax1.grid(True)
 
     # Second subplot (smaller)
@@ -971,7 +2134,7 @@ def plot_block_ts(dict,idx):
     concd_col = next((col for col in df.columns if 'CONCD' in col), None)
 
     # Scatter plot for concentration and altitude
-    ax2.scatter(df[concd_col], df.GGALT, color='b', label='CDP', alpha=0.5, marker='^', s=4)
+    cdp = ax2.scatter(df[concd_col], df.GGALT, color='b', label='CDP', alpha=0.5, marker='^', s=4)
 
     # Log scale for x-axis
     ax2.set_xscale('log')
@@ -982,36 +2145,19 @@ def plot_block_ts(dict,idx):
 
     # Add second x-axis on top
     ax2_top = ax2.twiny()
-    ax2_top.plot(df[plwc_col], df.GGALT, color='orange', alpha=.7, linestyle='--', label='CDP LWC')
+    lwc, = ax2_top.plot(df[plwc_col], df.GGALT, color='orange', alpha=.7, linestyle='--', label='CDP LWC')
     ax2_top.set_xlabel('g/m3')
     ax2_top.set_xscale('log')
     ax2_top.set_xlim(0.0001, 10)
     ax2.set_ylim(-200, np.max(df['GGALT'] + 600))
 
-    # Shade blocked altitude regions in ax2
-    for i, row in incloud.iterrows():
-        ax2.fill_betweenx(
-            y=[row['lower_bound'], row['upper_bound']],  # Altitude range for shading
-            x1=0.01,  # Left bound (min x-value)
-            x2=1000,  # Right bound (max x-value)
-            color='red', alpha=0.3, label="Cloud layer" if 'Cloud layer' not in ax2.get_legend_handles_labels()[1] else None
-        )
-
-    # Merge legends from both axes
-    lines, labels = ax2.get_legend_handles_labels()
-    lines2, labels2 = ax2_top.get_legend_handles_labels()
-    ax2.legend(lines + lines2, labels + labels2, loc='upper right')  # Merge legends from both axes
-
-    # Reorder the legends if needed
-    all_lines = lines + lines2
-    all_labels = labels + labels2
-    if len(all_labels) >= 3:
-        new_order = [0, 2, 1]  # Modify based on the desired order
-        all_lines = [all_lines[i] for i in new_order]
-        all_labels = [all_labels[i] for i in new_order]
-
-    # Apply reordered legend
-    ax2.legend(all_lines, all_labels, loc='upper right', markerscale=3)
+    # Shade cloud layers in ax2 (full width) and merge the legends of both axes
+    handles, labels = [cdp, lwc], ['CDP', 'CDP LWC']
+    if len(incloud):
+        _layer_spans(ax2, incloud['lower_bound'], incloud['upper_bound'], 'red', 0.3)
+        handles.append(Patch(facecolor='red', alpha=0.3))
+        labels.append('Cloud layer')
+    ax2.legend(handles, labels, loc='upper right', markerscale=3)
 
     # Adjust layout to prevent overlap
     plt.tight_layout()
@@ -1019,99 +2165,93 @@ def plot_block_ts(dict,idx):
 
     # Save the figure
     rf_id = f"RF_{idx+1:02d}"
-    filename = f"CSET_Altitude_Flight_Cloud_type{rf_id}.png"
-    plt.savefig(filename, dpi=300, bbox_inches='tight')  # Save as PNG with high resolution
+    filename = os.path.join(out_dir, f"{campaign}_Altitude_Flight_Cloud_type{rf_id}.png")
+    fig.savefig(filename, dpi=dpi, bbox_inches='tight')  # Save as PNG with high resolution
+    return fig
 
    
-def plot_hcr_cloud_type(df,Flight_blocks,idx):
-    
+# HCR echo type bins and labels of plot_hcr_cloud_type
+HCR_ECHO_TICKS = [14, 16, 18, 25, 30, 32, 34, 36, 38]
+HCR_ECHO_LABELS = ["stratiform low", "stratiform mid", "stratiform high", "mixed", "convective",
+                   "conv. elevated", "conv. shallow", "conv. mid", "conv. deep"]
+
+def plot_hcr_cloud_type(df, Flight_blocks, idx, campaign='SOCRATES', out_dir='.', dpi=300):
+    """
+    Altitude time series of a flight with every block shaded by its mean HCR echo type, above a strip
+    of the per-sample echo types. Saved to
+    f"{out_dir}/{campaign}_Altitude_Flight_HCR_Cloud_Echo_RF_{idx+1:02d}.png".
+
+    :param df: Flight DataFrame (Time, GGALT).
+    :param Flight_blocks: Blocks with an Echo_Type column (assign_cloud_type_HCR output).
+    :param idx: Flight index (0-based).
+
+    :return: The figure.
+    """
     import matplotlib.pyplot as plt
-    import matplotlib.cm as cm
     from matplotlib.colors import ListedColormap, BoundaryNorm
     import matplotlib.dates as mdates
-    
+
     # Initialize figure and gridspec for plotting
     fig = plt.figure(figsize=(14, 6))
     gs = fig.add_gridspec(2, 1, height_ratios=[10, 1])
-    
+
     ax1 = fig.add_subplot(gs[0, 0])  # Main altitude plot
     ax2 = fig.add_subplot(gs[1, 0])  # Echo Type plot
-    
-    tick_values = [14, 16, 18, 25, 30, 32, 34, 36, 38]
-    
+
+    tick_values = np.array(HCR_ECHO_TICKS)
+
     # Update to use the new colormap interface
     spectral_cmap = plt.colormaps['Set1']  # Access colormap directly
-    tick_to_color = {tick: spectral_cmap(i / len(tick_values)) for i, tick in enumerate(tick_values)}  # Map each tick to a color
-       
+    tick_colors = [spectral_cmap(i / len(tick_values)) for i in range(len(tick_values))]  # Map each tick to a color
+
     # Plot flight altitude for each DataFrame in different colors
     ax1.plot(df['Time'], df['GGALT'], color='k', linewidth=3)
-    
+
     start_limit = df['Time'].min()
     end_limit = df['Time'].max()
     ax1.set_xlim([start_limit, end_limit])
-    
-    for val in Flight_blocks:
-        block_type = Flight_blocks[val]
-        for i in range(len(block_type)):
-            block = block_type[i]
-            start_time = block['Time'].iloc[0]
-            end_time = block['Time'].iloc[-1]
-            mean_echo_type = np.nanmean(block['Echo_Type'])
-        
-            # Find the closest tick value and corresponding color
-            closest_tick = tick_values[np.argmin(np.ceil(np.abs(np.array(tick_values) - mean_echo_type)))]
-            color = tick_to_color[closest_tick]
-        
-            # Shade region on ax1
-            ax1.axvspan(start_time, end_time, color=color, alpha=0.8)
-    
-            # Plot scatter on ax2
-            ax2.scatter(
-                block.Time,
-                np.zeros(len(block.Time)),
-                c=block.Echo_Type,
-                cmap='Set1',
-                marker='s',
-                s=4,
-                vmin=min(tick_values),
-                vmax=max(tick_values)
-            )
-    
-    # start_time = pd.to_datetime("2018-01-16 01:30:00")
-    # end_time = pd.to_datetime("2018-01-16 03:00:00")
-    # ax1.set_xlim(start_time, end_time)
+
+    blocks = [block for block_type in Flight_blocks.values() for block in block_type if len(block)]
+    if blocks:
+        # Shade every block by the tick closest to its mean echo type (one collection), and draw
+        # all samples of the echo-type strip in one scatter
+        start_time = [block['Time'].iloc[0] for block in blocks]
+        end_time = [block['Time'].iloc[-1] for block in blocks]
+        with np.errstate(invalid='ignore'):
+            mean_echo_type = np.array([np.nanmean(block['Echo_Type']) if block['Echo_Type'].notna().any()
+                                       else np.nan for block in blocks])
+        closest = np.argmin(np.ceil(np.abs(tick_values[None, :] - mean_echo_type[:, None])), axis=1)
+        _time_spans(ax1, start_time, end_time, [tick_colors[i] for i in closest], 0.8)
+
+        samples = pd.concat([block[['Time', 'Echo_Type']] for block in blocks])
+        ax2.scatter(
+            samples.Time,
+            np.zeros(len(samples)),
+            c=samples.Echo_Type,
+            cmap='Set1',
+            marker='s',
+            s=4,
+            vmin=tick_values.min(),
+            vmax=tick_values.max()
+        )
+
     ax1.set_ylabel('Altitude (m)')
     # Clean up ax2 to make it look like a color strip
-    ax2.set_xlim(ax1.get_xlim())
     ax2.set_yticks([])
     ax2.set_xlabel('Time UTC (MM-dd HH:mm)')
     ax2.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d %H:%M'))
     fig.autofmt_xdate()
     # Set x-axis limits
-    
     ax2.set_xlim([start_limit, end_limit])
-    
-    # Define the tick values (bin labels)
-    tick_values = [14, 16, 18, 25, 30, 32, 34, 36, 38]
-    tick_labels = [
-        "stratiform low",
-        "stratiform mid",
-        "stratiform high",
-        "mixed",
-        "convective",
-        "conv. elevated",
-        "conv. shallow",
-        "conv. mid",
-        "conv. deep"
-    ]
+
     # We need to define edges for each bin; to get N blocks, we need N+1 boundaries
     bounds = list(range(len(tick_values) + 1))  # e.g., 0, 1, 2, ..., 9
-    
+
     # Create a colormap with N colors
     colors = plt.cm.Set1(np.linspace(0, 1, len(tick_values)))
     cmap = ListedColormap(colors)
     norm = BoundaryNorm(bounds, cmap.N)
-    
+
     # Add vertical colorbar on the right
     cbar = fig.colorbar(
         plt.cm.ScalarMappable(norm=norm, cmap=cmap),
@@ -1121,23 +2261,72 @@ def plot_hcr_cloud_type(df,Flight_blocks,idx):
         pad=0.012
     )
     # Set category labels instead of numbers
-    cbar.ax.set_yticklabels(tick_labels)
-    # Set colorbar labels and title
-    cbar.ax.set_yticklabels(tick_labels)
+    cbar.ax.set_yticklabels(HCR_ECHO_LABELS)
     cbar.set_label("HCR Echo Type")
     # Turn ticks inside for all three axes
     for ax in [ax1, ax2]:
         ax.tick_params(direction='in', which='both', top=True, right=True)
-    # # Show the plot
-    # plt.show()
 
     # Save the figure
     rf_id = f"RF_{idx+1:02d}"
-    filename = f"SOCRATES_Altitude_Flight_HCR_Cloud_Echo_{rf_id}.png"
-    plt.savefig(filename, dpi=300, bbox_inches='tight')  # Save as PNG with high resolution
-
-
-
-
-
+    filename = os.path.join(out_dir, f"{campaign}_Altitude_Flight_HCR_Cloud_Echo_{rf_id}.png")
+    fig.savefig(filename, dpi=dpi, bbox_inches='tight')  # Save as PNG with high resolution
+    return fig
+
+def _render_flight_qc(job):
+    """Worker of render_campaign_qc: draw one flight's QC figures with the Agg backend."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
+    idx, flight, hcr_blocks, campaign, out_dir, dpi = job
+    t0 = _time.perf_counter()
+    written = []
+    try:
+        fig = plot_block_ts(flight, idx, campaign=campaign, out_dir=out_dir, dpi=dpi)
+        written.append(os.path.join(out_dir, f"{campaign}_Altitude_Flight_Cloud_typeRF_{idx+1:02d}.png"))
+        plt.close(fig)
+        if hcr_blocks is not None:
+            fig = plot_hcr_cloud_type(flight['DataFrame'], hcr_blocks, idx, campaign=campaign,
+                                      out_dir=out_dir, dpi=dpi)
+            written.append(os.path.join(out_dir, f"{campaign}_Altitude_Flight_HCR_Cloud_Echo_RF_{idx+1:02d}.png"))
+            plt.close(fig)
+        error = None
+    except Exception as e:
+        plt.close('all')
+        error = f"{type(e).__name__}: {e}"
+    return {'flight': f"RF_{idx+1:02d}", 'files': written, 'seconds': _time.perf_counter() - t0, 'error': error}
+
+def render_campaign_qc(flights, campaign='CSET', out_dir='qc', hcr_blocks=None, max_workers=None, dpi=150):
+    """
+    Render the QC figures of every flight of a campaign headless (Agg) in parallel worker processes:
+    plot_block_ts for every flight and plot_hcr_cloud_type where HCR blocks are given.
+
+    :param flights: List of assign_flight_type outputs, one per flight (flight idx = list position;
+                    None entries are skipped).
+    :param campaign: Campaign name used in the file names.
+    :param out_dir: Output directory (created if needed).
+    :param hcr_blocks: Optional list aligned with flights of assign_cloud_type_HCR block dicts.
+    :param max_workers: Worker processes (default: os.cpu_count()).
+    :param dpi: Figure resolution.
+
+    :return: DataFrame with one row per flight: flight, files, seconds, error.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    os.makedirs(out_dir, exist_ok=True)
+    hcr_blocks = hcr_blocks if hcr_blocks is not None else [None] * len(flights)
+    jobs = [(idx, flight, hcr, campaign, out_dir, dpi)
+            for idx, (flight, hcr) in enumerate(zip(flights, hcr_blocks))
+            if flight is not None]
+
+    t0 = _time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        report = pd.DataFrame(list(pool.map(_render_flight_qc, jobs)),
+                              columns=['flight', 'files', 'seconds', 'error'])
+    failed = report['error'].notna().sum()
+    print(f"Rendered {report['files'].str.len().sum()} figure(s) for {len(report)} flight(s) "
+          f"in {_time.perf_counter() - t0:.1f} s, {failed} failed")
+    for _, row in report[report['error'].notna()].iterrows():
+        print(f"  {row['flight']}: {row['error']}")
+    return report
@@ -0,0 +1,231 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Opt-in per-stage instrumentation for the flight processing pipeline.
+#
+# Stages are recorded with the `stage` context manager or the `profiled` decorator (applied to
+# load_flight_data, assign_flight_type, block_flight, select_ERA5_4flight, collocate_ERA5_dat,
+# cloud_regime and write_RF_nc). Nothing is recorded, and the decorator is a single flag check,
+# unless profiling is turned on with enable() or INFORM_PROFILE=1 in the environment.
+#
+# Per stage: wall and CPU time, RSS change and process peak RSS, bytes read (Linux /proc rchar,
+# which includes page-cache hits) and output row counts. CPU time, RSS and bytes read are process
+# wide, so stages running concurrently in threads see each other's usage.
+
+_STATE = {'enabled': os.environ.get('INFORM_PROFILE', '') not in ('', '0'), 'records': []}
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+
+
+def enable(flag=True):
+    """Turn stage recording on (or off with flag=False)."""
+    _STATE['enabled'] = bool(flag)
+
+
+def disable():
+    _STATE['enabled'] = False
+
+
+def is_enabled():
+    return _STATE['enabled']
+
+
+def reset():
+    """Drop all recorded stages."""
+    with _LOCK:
+        _STATE['records'] = []
+
+
+def _rss_mb():
+    # Current resident set size
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # bytes on macOS, KiB elsewhere
+
+
+def _bytes_read():
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _stack():
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+@contextmanager
+def flight_context(flight):
+    """Attribute the stages run inside the block (in this thread) to `flight`."""
+    previous = getattr(_LOCAL, 'flight', None)
+    _LOCAL.flight = flight
+    try:
+        yield
+    finally:
+        _LOCAL.flight = previous
+
+
+@contextmanager
+def stage(name, flight=None, rows=None):
+    """
+    Record one pipeline stage.
+
+    :param name: Stage name.
+    :param flight: Flight id (defaults to the enclosing flight_context).
+    :param rows: Row count, if known up front; can also be set on the yielded record (rec['rows'] = n).
+
+    :return: Context manager yielding the stage record (a dict; not stored when profiling is off).
+    """
+    rec = {'stage': name, 'flight': flight if flight is not None else getattr(_LOCAL, 'flight', None),
+           'rows': rows}
+    if not _STATE['enabled']:
+        yield rec
+        return
+
+    stack = _stack()
+    rec['parent'] = stack[-1] if stack else None
+    stack.append(name)
+    rss0, read0 = _rss_mb(), _bytes_read()
+    cpu0, t0 = time.process_time(), time.perf_counter()
+    rec['start'] = time.time()
+    try:
+        yield rec
+        rec['error'] = None
+    except BaseException as e:
+        rec['error'] = type(e).__name__
+        raise
+    finally:
+        rec['wall_s'] = time.perf_counter() - t0
+        rec['cpu_s'] = time.process_time() - cpu0
+        rss1, read1 = _rss_mb(), _bytes_read()
+        rec['rss_delta_mb'] = None if rss0 is None or rss1 is None else rss1 - rss0
+        rec['peak_rss_mb'] = _peak_rss_mb()
+        rec['bytes_read'] = None if read0 is None or read1 is None else read1 - read0
+        stack.pop()
+        with _LOCK:
+            _STATE['records'].append(rec)
+
+
+def count_rows(result):
+    """Row count of a stage result: DataFrames, assign_flight_type dicts and (dicts of) lists of DataFrames."""
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, dict):
+        if isinstance(result.get('DataFrame'), pd.DataFrame):
+            return len(result['DataFrame'])
+        counts = [count_rows(v) for v in result.values()]
+    elif isinstance(result, (list, tuple)):
+        counts = [count_rows(v) for v in result]
+    else:
+        return None
+    counts = [c for c in counts if c is not None]
+    return sum(counts) if counts else None
+
+
+def profiled(name=None, rows=count_rows):
+    """
+    Decorator recording every call of a function as a stage (see stage).
+
+    :param name: Stage name (default: the function name).
+    :param rows: Callable giving the row count from the return value (None to skip).
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _STATE['enabled']:
+                return func(*args, **kwargs)
+            with stage(stage_name) as rec:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    rec['rows'] = rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+REPORT_COLUMNS = ['flight', 'stage', 'parent', 'wall_s', 'cpu_s', 'rss_delta_mb', 'peak_rss_mb',
+                  'bytes_read', 'rows', 'error', 'start']
+
+
+def report():
+    """All recorded stages as a DataFrame (one row per stage call)."""
+    with _LOCK:
+        records = list(_STATE['records'])
+    df = pd.DataFrame(records, columns=REPORT_COLUMNS)
+    df['start'] = pd.to_datetime(df['start'], unit='s')
+    return df
+
+
+def summary(df=None):
+    """
+    Per-stage totals: calls, wall (total / mean / max), CPU, max peak RSS, bytes read, rows and the
+    share of the top-level wall time.
+    """
+    df = report() if df is None else df
+    if df.empty:
+        return pd.DataFrame()
+    out = df.groupby('stage', sort=False).agg(calls=('wall_s', 'size'), wall_s=('wall_s', 'sum'),
+                                              wall_mean_s=('wall_s', 'mean'), wall_max_s=('wall_s', 'max'),
+                                              cpu_s=('cpu_s', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'),
+                                              bytes_read=('bytes_read', 'sum'), rows=('rows', 'sum'),
+                                              errors=('error', 'count'))
+    top = df.loc[df['parent'].isna(), 'wall_s'].sum()
+    out['wall_share'] = out['wall_s'] / top if top else float('nan')
+    return out.sort_values('wall_s', ascending=False)
+
+
+def print_summary(df=None):
+    table = summary(df)
+    if table.empty:
+        print("No stages recorded (enable profiling with profiling_utils.enable() or INFORM_PROFILE=1)")
+        return table
+    fmt = table.copy()
+    fmt['bytes_read'] = (fmt['bytes_read'] / 2 ** 20).round(1)
+    fmt = fmt.rename(columns={'bytes_read': 'read_mb'})
+    with pd.option_context('display.float_format', '{:.3f}'.format, 'display.width', 160):
+        print(fmt.to_string())
+    return table
+
+
+def write_report(path):
+    """
+    Write the stage records to `path` (.csv, or .json with the records and the per-stage summary).
+
+    :return: path
+    """
+    df = report()
+    if path.endswith('.csv'):
+        df.to_csv(path, index=False)
+    else:
+        payload = {'stages': json.loads(df.to_json(orient='records', date_format='iso')),
+                   'summary': json.loads(summary(df).reset_index().to_json(orient='records'))}
+        with open(path, 'w') as f:
+            json.dump(payload, f, indent=1)
+    print(f"Wrote {path}")
+    return path
@@ -1,7 +1,15 @@
 import yaml
 import json
+import glob
+import hashlib
 import os, sys
+import re
+import tempfile
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from parse_namelist import summarize_atm_in
+from run_similarity import write_similarity
 from pathlib import Path
 
 out = Path("docs/tooltips.json")
@@ -27,22 +35,41 @@ def push_github():
     print("Pushing run_matrix.json changes to GitHub...")
     #os.system("git config --global user.email 'github-actions[bot]@users.noreply.github.com'")
     #os.system("git config --global user.name 'github-actions[bot]'")
-    os.system("git add docs/run_matrix.json")
+    os.system(f"git add docs/run_matrix.json {SIMILARITY_PATH} {RUN_INDEX_PATH} {VAR_INDEX_PATH}")
+    os.system(f"git add --all {SHARD_DIR}")
     os.system("git commit -m 'Update run matrix [skip ci]' || echo 'No changes to commit'")
     os.system("git push origin HEAD:main")
     print("Pushed changes to GitHub usccessful.")
 
 
-args = sys.argv
-
-def delete_entry(matrix, run_name):
-    new_matrix = [r for r in matrix if r.get("run_name") != run_name]
-    if len(new_matrix) < len(matrix):
+def index_matrix(matrix):
+    """
+    Index the run matrix list by run_name (insertion order = display order) and by atm_in_sha256.
+    Non-dict / unnamed legacy entries are kept aside and written back unchanged.
+    """
+    store = {"runs": {}, "by_sha": {}, "legacy": [], "new": [], "changed": False}
+    for entry in matrix:
+        name = entry.get("run_name") if isinstance(entry, dict) else None
+        if name is None or name in store["runs"]:
+            print(" Keeping malformed/duplicate entry as is")
+            store["legacy"].append(entry)
+            continue
+        store["runs"][name] = entry
+        store["by_sha"].setdefault(entry.get("atm_in_sha256"), set()).add(name)
+    return store
+
+
+def delete_entry(store, run_name):
+    entry = store["runs"].pop(run_name, None)
+    if entry is not None:
+        store["by_sha"].get(entry.get("atm_in_sha256"), set()).discard(run_name)
+        if run_name in store["new"]:
+            store["new"].remove(run_name)
+        store["changed"] = True
         print(f" Deleted run: {run_name}")
     else:
         print(f" Delete requested, but run not found: {run_name}")
-    #return new_matrix
-    return new_matrix, "deleted"
+    return store, "deleted"
 
 
 def load_matrix(path="run_matrix.json"):
@@ -113,86 +140,329 @@ def add_entry(matrix, new_entry, interactive=False):
     return matrix, "added"
 """
 
-def add_entry(matrix, new_entry, interactive=False):
-    for existing in matrix:
-        # --- Guard against malformed / legacy entries ---
-        if not isinstance(existing, dict):
-            print(" Skipping non-dict entry in matrix")
+def add_entry(store, new_entry, interactive=False):
+    """
+    Add a summarized run to the store: O(1) lookup by run_name (and by atm_in_sha256).
+    Returns (store, status) with status "added", "duplicate" or "conflict".
+    """
+    name = new_entry.get("run_name")
+    existing = store["runs"].get(name)
+    if existing is not None:
+
+        # --- Preferred identity check: hash ---
+        if existing.get("atm_in_sha256") == new_entry.get("atm_in_sha256"):
+            print(f" Run '{name}' already exists (identical atm_in). Skipping.")
+            return store, "duplicate"
+
+        # --- Same name, different content ---
+        print(f" Same run_name but different atm_in")
+        print(f"  Existing snapshot: {existing.get('snapshot_date', 'unknown')}")
+        print(f"  New snapshot:      {new_entry.get('snapshot_date', 'unknown')}")
+
+        # Optional diff view
+        try:
+            diffs = diff_runs(existing, new_entry)
+            print(" Differences:", diffs)
+        except Exception as e:
+            print("⚠ Could not diff runs:", e)
+
+        return store, "conflict"
+
+    same_sha = store["by_sha"].get(new_entry.get("atm_in_sha256"), set())
+    if same_sha:
+        print(f" Note: atm_in identical to existing run(s): {sorted(same_sha)}")
+
+    # --- New run: shown first (newest first) when the matrix is written ---
+    store["runs"][name] = new_entry
+    store["new"].append(name)
+    store["by_sha"].setdefault(new_entry.get("atm_in_sha256"), set()).add(name)
+    store["changed"] = True
+    print(f" Added new run: {name}")
+    return store, "added"
+
+
+def matrix_list(store):
+    """Entries in display order: newly added runs (newest first), then the existing ones, then legacy entries."""
+    new = set(store["new"])
+    ordered = [store["runs"][n] for n in reversed(store["new"])]
+    ordered += [entry for n, entry in store["runs"].items() if n not in new]
+    return ordered + store["legacy"]
+
+
+def write_text_atomic(path, text):
+    # Write next to the target and rename, so a crash never leaves a truncated file
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.chmod(tmp, 0o644)  # mkstemp creates 0600; the docs are served as is
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_json_atomic(path, data, **kw):
+    write_text_atomic(path, json.dumps(data, **kw))
+
+
+def _write_if_changed(path, text):
+    try:
+        with open(path) as f:
+            if f.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    write_text_atomic(path, text)
+    return True
+
+
+# --- Sharded docs output: docs/index.html loads the small run index and the variable index,
+# --- and fetches a run's shard (full entry + closest runs) only when its row is expanded
+RUN_INDEX_PATH = "docs/run_index.json"
+VAR_INDEX_PATH = "docs/var_index.json"
+SHARD_DIR = "docs/runs"
+
+
+def shard_name(run_name):
+    """File name of a run's detail shard (run names that are not file-safe get a hash suffix)."""
+    safe = re.sub(r"[^A-Za-z0-9._-]", "_", run_name)
+    if safe != run_name:
+        safe += "-" + hashlib.sha1(run_name.encode()).hexdigest()[:8]
+    return f"{safe}.json"
+
+
+def _index_row(entry, shard):
+    fincl = entry.get("fincl") or {}
+    return {"run_name": entry["run_name"], "nudging": entry.get("nudging"), "cosp": entry.get("cosp"),
+            "fincl": list(fincl), "n_vars": sum(len(v) for v in fincl.values()),
+            "snapshot_date": entry.get("snapshot_date"), "shard": f"runs/{shard}"}
+
+
+def write_docs_shards(matrix, similarity=None, shard_dir=SHARD_DIR,
+                      run_index_path=RUN_INDEX_PATH, var_index_path=VAR_INDEX_PATH):
+    """
+    Write the compact run index (one row per run), one detail shard per run and a variable-name
+    search index mapping each fincl output field to the rows of the runs that write it.
+    Only shards whose content changed are rewritten; shards of removed runs are deleted.
+
+    :param matrix: Run matrix list (display order).
+    :param similarity: Run similarity index (see run_similarity.build_similarity), merged into the shards.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    sim_runs = (similarity or {}).get("runs", {})
+    clusters = (similarity or {}).get("clusters", [])
+
+    rows, variables, shards, n_written = [], {}, set(), 0
+    for entry in matrix:
+        if not isinstance(entry, dict) or not entry.get("run_name"):
             continue
+        shard = shard_name(entry["run_name"])
+        shards.add(shard)
+        detail = dict(entry)
+        sim = sim_runs.get(entry["run_name"])
+        if sim is not None:
+            cluster = sim["cluster"]
+            detail["similarity"] = {"cluster": cluster,
+                                    "cluster_size": None if cluster is None else len(clusters[cluster]),
+                                    "neighbors": sim["neighbors"]}
+        n_written += _write_if_changed(os.path.join(shard_dir, shard), json.dumps(detail, indent=1) + "\n")
+
+        for names in (entry.get("fincl") or {}).values():
+            for name in names:
+                rows_with = variables.setdefault(name.split(":")[0], [])
+                if not rows_with or rows_with[-1] != len(rows):
+                    rows_with.append(len(rows))
+        rows.append(_index_row(entry, shard))
+
+    stale = [f for f in os.listdir(shard_dir) if f.endswith(".json") and f not in shards]
+    for f in stale:
+        os.remove(os.path.join(shard_dir, f))
+
+    # One row per line keeps the index diffable
+    _write_if_changed(run_index_path, "[\n" + ",\n".join(json.dumps(r) for r in rows) + "\n]\n")
+    _write_if_changed(var_index_path, json.dumps(dict(sorted(variables.items())), separators=(",", ":")) + "\n")
+    print(f"Wrote {run_index_path} ({len(rows)} runs, {len(variables)} variables), "
+          f"{n_written} shard(s) updated, {len(stale)} removed")
+
+
+# --- atm_in stat cache: skip re-reading files whose size and mtime are unchanged,
+# --- and re-parsing files whose content hash is unchanged
+CACHE_PATH = "config/.atm_in_cache.json"
+SIMILARITY_PATH = "docs/run_similarity.json"
+
+
+def load_cache(path=CACHE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def cached_summary(cache, atm_in_path):
+    """
+    Summarize an atm_in file, reusing the cached summary when its size/mtime (or, failing that,
+    its sha256) match the cache. Safe to call from worker threads: the cache is only read here.
+
+    Returns (summary or None, new cache entry or None).
+    """
+    key = os.path.abspath(atm_in_path)
+    try:
+        st = os.stat(atm_in_path)
+    except FileNotFoundError:
+        return None, None
+    hit = cache.get(key)
+    if hit and hit["size"] == st.st_size and hit["mtime_ns"] == st.st_mtime_ns:
+        return dict(hit["summary"]), None
+
+    with open(atm_in_path, "rb") as f:
+        data = f.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+    if hit and hit["sha256"] == sha256:
+        summary = dict(hit["summary"])
+    else:
+        summary = summarize_atm_in(atm_in_path, data=data, sha256=sha256)
+    entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha256, "summary": summary}
+    return dict(summary), entry
 
-        if existing.get("run_name") == new_entry.get("run_name"):
-
-            # --- Preferred identity check: hash ---
-            if existing.get("atm_in_sha256") == new_entry.get("atm_in_sha256"):
-                print(f" Run '{new_entry['run_name']}' already exists (identical atm_in). Skipping.")
-                return matrix, "duplicate"
-
-            # --- Same name, different content ---
-            print(f" Same run_name but different atm_in")
-            print(f"  Existing snapshot: {existing.get('snapshot_date', 'unknown')}")
-            print(f"  New snapshot:      {new_entry.get('snapshot_date', 'unknown')}")
-
-            # Optional diff view
-            try:
-                diffs = diff_runs(existing, new_entry)
-                print(" Differences:", diffs)
-            except Exception as e:
-                print("⚠ Could not diff runs:", e)
-
-            return matrix, "conflict"
-
-    # --- New run: prepend so newest appears first ---
-    matrix.insert(0, new_entry)
-    print(f" Added new run: {new_entry.get('run_name')}")
-    return matrix, "added"
-
-
-
-matrix = load_matrix("docs/run_matrix.json")
-matrix0 = len(matrix)
-matrix0 = len(matrix)
-print("Runs in matrix before check:", matrix0)
-
-cfg_path = "config/runs.yml"
-if os.path.exists(cfg_path):
-    with open("config/runs.yml") as f:
-        cfg = yaml.safe_load(f)
-else:
-    print(f" {cfg_path} not found, skipping YAML load")
-    cfg = {"runs": []}  # empty default
-
-
-for run in cfg["runs"]:
-    if run.get("delete", False):
-        status = "deleted"
-        matrix, status = delete_entry(matrix, run["name"])
-        continue
-
-    summary = summarize_atm_in(run["atm_in"])
-    if summary is None:
-        continue
-    summary["run_name"] = run["name"]
-
-    status = "added"
-    matrix, status = add_entry(matrix, summary, interactive=False)
-
-print("Config keys:", cfg.keys())
-print("Runs in YAML:", len(cfg.get("runs", [])))
-
-print("Runs in matrix after check (before write):", len(matrix))
-diff = len(matrix) - matrix0
-if diff> 0:
-    print("New run(s) added:", diff)
-elif diff < 0:
-    print("Run(s) deleted:", abs(diff))
-else:
-    print("No changes to runs.")
 
-with open("docs/run_matrix.json", "w") as f:
-    json.dump(matrix, f, indent=2)
+def runs_from_yaml(cfg_path="config/runs.yml"):
+    if os.path.exists(cfg_path):
+        with open(cfg_path) as f:
+            cfg = yaml.safe_load(f) or {}
+    else:
+        print(f" {cfg_path} not found, skipping YAML load")
+        cfg = {}
+    return cfg.get("runs") or []
+
+
+def runs_from_glob(patterns):
+    """
+    Build a run list from case directory globs. Each match may be an atm_in file, a run
+    directory holding atm_in, or a case directory with run/atm_in; the run is named after
+    the case directory.
+    """
+    runs = []
+    for pattern in patterns:
+        for match in sorted(glob.glob(os.path.expanduser(pattern))):
+            path = Path(match)
+            if path.is_dir():
+                path = path / "atm_in" if (path / "atm_in").exists() else path / "run" / "atm_in"
+            case = path.parent.parent if path.parent.name == "run" else path.parent
+            runs.append({"name": case.name, "atm_in": str(path)})
+    return runs
+
+
+def _scan_one(cache, run):
+    t0 = time.perf_counter()
+    try:
+        summary, entry = cached_summary(cache, run["atm_in"])
+        status = "missing" if summary is None else ("parsed" if entry else "cached")
+    except Exception as e:
+        summary, entry, status = None, None, f"error: {e}"
+    return summary, entry, {"name": run["name"], "atm_in": run["atm_in"], "status": status,
+                            "seconds": time.perf_counter() - t0}
+
+
+def scan_runs(runs, cache, max_workers=8):
+    """
+    Summarize the atm_in of every run concurrently with a bounded thread pool (the work is
+    file-system latency bound, so threads overlap the metadata round trips and reads).
+
+    :param runs: List of {"name", "atm_in"} dicts (runs flagged delete are skipped).
+    :param cache: atm_in stat cache; new entries are merged into it after the pool finishes.
+    :param max_workers: Maximum number of concurrent reads.
+
+    :return: (summaries, report) in run order; summaries[i] is None for missing/failed runs and
+             report[i] holds name, atm_in, status ("parsed", "cached", "missing" or "error: ...")
+             and seconds.
+    """
+    todo = [run for run in runs if not run.get("delete", False)]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        results = list(pool.map(lambda run: _scan_one(cache, run), todo))
+    summaries, report = [], []
+    for run, (summary, entry, rec) in zip(todo, results):
+        if entry is not None:
+            cache[os.path.abspath(run["atm_in"])] = entry
+        summaries.append(summary)
+        report.append(rec)
+    return summaries, report
+
+
+def print_scan_report(report, wall):
+    if not report:
+        return
+    width = max(len(rec["name"]) for rec in report)
+    for rec in report:
+        print(f"  {rec['name']:<{width}}  {rec['seconds']:8.3f} s  {rec['status']}")
+    failed = [rec for rec in report if rec["status"] not in ("parsed", "cached")]
+    print(f" Scanned {len(report)} run(s) in {wall:.2f} s "
+          f"(sum of per-run times {sum(rec['seconds'] for rec in report):.2f} s), {len(failed)} failed")
+    for rec in failed:
+        print(f"  FAILED {rec['name']}: {rec['status']} ({rec['atm_in']})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Update docs/run_matrix.json from CESM atm_in files.")
+    parser.add_argument("command", nargs="?", choices=["push-github"],
+                        help="push the updated run matrix to GitHub")
+    parser.add_argument("--runs", default="config/runs.yml", help="YAML run list (default: %(default)s)")
+    parser.add_argument("--glob", action="append", default=[], metavar="PATTERN",
+                        help="case directory glob to scan instead of the YAML run list (repeatable)")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent atm_in reads (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    matrix = load_matrix("docs/run_matrix.json")
+    store = index_matrix(matrix)
+    matrix0 = len(matrix)
+    print("Runs in matrix before check:", matrix0)
+
+    runs = runs_from_glob(args.glob) if args.glob else runs_from_yaml(args.runs)
+
+    cache = load_cache()
+    t0 = time.perf_counter()
+    summaries, report = scan_runs(runs, cache, max_workers=args.workers)
+    print_scan_report(report, time.perf_counter() - t0)
+
+    # Apply adds/deletes in run-list order
+    summaries = iter(summaries)
+    for run in runs:
+        if run.get("delete", False):
+            store, status = delete_entry(store, run["name"])
+            continue
+        summary = next(summaries)
+        if summary is None:
+            continue
+        summary["run_name"] = run["name"]
+        store, status = add_entry(store, summary, interactive=False)
+
+    print("Runs scanned:", len(runs))
+
+    n_runs = len(store["runs"]) + len(store["legacy"])
+    print("Runs in matrix after check (before write):", n_runs)
+    diff = n_runs - matrix0
+    if diff> 0:
+        print("New run(s) added:", diff)
+    elif diff < 0:
+        print("Run(s) deleted:", abs(diff))
+    else:
+        print("No changes to runs.")
+
+    if store["changed"]:
+        write_json_atomic("docs/run_matrix.json", matrix_list(store), indent=2)
+        print("Wrote docs/run_matrix.json")
+    if store["changed"] or not os.path.exists(SIMILARITY_PATH) or not os.path.exists(RUN_INDEX_PATH):
+        similarity = write_similarity(matrix_list(store), SIMILARITY_PATH)
+        write_docs_shards(matrix_list(store), similarity)
+    if any(rec["status"] == "parsed" for rec in report):
+        write_json_atomic(CACHE_PATH, cache)
+
+    if args.command == "push-github":
+        push_github()
 
 
-if len(args) > 1:
-    print("Usage: python generate_exp_matrix.py push-github")
-    if args[1] == "push-github":
-        push_github()
+if __name__ == "__main__":
+    main()
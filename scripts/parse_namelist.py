@@ -1,169 +1,192 @@
 import re, os
-from datetime import datetime
+from datetime import datetime, timezone
 import hashlib
-"""
-def hash_file(path):
-    with open(path, "rb") as f:
-        return hashlib.sha256(f.read()).hexdigest()
-"""
 
-def load_cam_doc(docsies):
-    fincl_blocks = {}
-    cosp_vars = {}
-    nudged_vars = {}
-    other_vars = {}
-    empty_htapes = {}
-
-    current_key = None
-    current_type = None  # "fincl" or "nudge"
+# Fortran namelist tokens. Order matters: "&end" before "&group", comments and quoted strings
+# before bare words, so '/', '!' and ',' inside strings never end a value.
+_NML_TOKEN = re.compile(r"""
+    (?P<comment>![^\n]*)
+   |(?P<end>/|&end\b|\$end\b)
+   |(?P<group>[&$][A-Za-z]\w*)
+   |(?P<string>'(?:[^']|'')*'|"(?:[^"]|"")*")
+   |(?P<assign>=)
+   |(?P<comma>,)
+   |(?P<ws>\s+)
+   |(?P<word>[^\s,=/!'"]+)
+""", re.X | re.I)
+
+_NML_REPEAT = re.compile(r"(\d+)\*(.*)$")
+_NML_TRUE = {".true.", ".t.", "t"}
+_NML_FALSE = {".false.", ".f.", "f"}
+
+
+def lex_namelist(text):
+    """
+    Tokenize namelist text into (kind, value, start, end) tuples, skipping whitespace and comments.
+    kind is one of "group", "end", "string", "assign", "comma", "word".
+    """
+    for m in _NML_TOKEN.finditer(text):
+        kind = m.lastgroup
+        if kind in ("ws", "comment"):
+            continue
+        yield kind, m.group(), m.start(), m.end()
+
+
+def _nml_value(kind, token):
+    if kind == "string":
+        q = token[0]
+        return token[1:-1].replace(q + q, q)
+    low = token.lower()
+    if low in _NML_TRUE:
+        return True
+    if low in _NML_FALSE:
+        return False
     try:
-        with open(docsies, "r") as f:
-            for raw_line in f:
-                line = raw_line.rstrip()
-
-                # End of namelist
-                if line.strip() == "/":
-                    current_key = None
-                    current_type = None
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(low.replace("d", "e"))
+    except ValueError:
+        return token
+
+
+def parse_namelist(text):
+    """
+    Parse Fortran namelist text (all groups, continuation lines, quoted lists, r*value repeats).
+
+    :param text: Contents of a namelist file such as atm_in.
+
+    :return: dict {group: {key: {"value": ..., "raw": ...}}} in file order. Keys and group names are
+             lowercased; "value" is a scalar for single values and a list otherwise (strings unquoted,
+             logicals as bool, numbers as int/float); "raw" is the right-hand side as written with
+             whitespace collapsed.
+    """
+    groups = {}
+    group = key = None
+    span = None
+    repeat = 1
+
+    def close():
+        if key is not None:
+            entry = group[key]
+            if len(entry["value"]) == 1:
+                entry["value"] = entry["value"][0]
+            entry["raw"] = " ".join(text[span[0]:span[1]].split()) if span else ""
+
+    tokens = list(lex_namelist(text))
+    for i, (kind, token, start, end) in enumerate(tokens):
+        if kind == "group":
+            close()
+            group = groups.setdefault(token[1:].lower(), {})
+            key = span = None
+        elif kind == "end":
+            close()
+            group = key = span = None
+        elif group is None:
+            continue
+        elif kind == "word" and i + 1 < len(tokens) and tokens[i + 1][0] == "assign":
+            close()
+            key = token.lower()
+            group[key] = {"value": []}
+            span = None
+        elif kind in ("word", "string") and key is not None:
+            span = (span[0] if span else start, end)
+            m = _NML_REPEAT.match(token) if kind == "word" else None
+            if m:
+                # r*value; a bare "r*" applies to the quoted string that follows
+                repeat = int(m.group(1))
+                if not m.group(2):
                     continue
+                kind, token = "word", m.group(2)
+            group[key]["value"].extend([_nml_value(kind, token)] * repeat)
+            repeat = 1
+    close()
+    return groups
 
-                # New variable assignment
-                m = re.match(r"\s*([A-Za-z0-9_]+)\s*=", line)
-                if m:
-                    key = m.group(1)
-                    key_lower = key.lower()
-
-                    if key_lower.startswith("empty_htapes"):
-                        current_key = key
-                        current_type = "empty_htapes"
-                        empty_htapes[current_key] = [line.strip()]
-                        continue
-
-                    # ---- fincl* blocks ----
-                    if key_lower.startswith("cosp") or "cosp".lower() in key_lower:
-                        current_key = key
-                        current_type = "cosp"
-                        cosp_vars[current_key] = [line.strip()]
-                        continue
-
-                    # ---- fincl* blocks ----
-                    if key_lower.startswith("fincl"):
-                        current_key = key
-                        current_type = "fincl"
-                        fincl_blocks[current_key] = [line.strip()]
-                        continue
-
-                    # ---- nudged variables ----
-                    if key_lower.startswith("nudge_"):
-                        current_key = key
-                        current_type = "nudge"
-                        nudged_vars[current_key] = [line.strip()]
-                        continue
-
-                    # ---- single-line vars ----
-                    if key_lower in {"mfilt", "nhtfrq", "ncdata"}:
-                        other_vars[key] = line.strip()
-                        current_key = None
-                        current_type = None
-                        continue
-
-                    # Anything else → reset
-                    current_key = None
-                    current_type = None
-                    continue
 
-                # ---- Continuation lines ----
-                if current_key and line.startswith(" "):
-                    if current_type == "fincl":
-                        fincl_blocks[current_key].append(line.strip())
-                    elif current_type == "nudge":
-                        nudged_vars[current_key].append(line.strip())
-                    elif current_type == "cosp":
-                        cosp_vars[current_key].append(line.strip())
-                    elif current_type == "empty_htapes":
-                        empty_htapes[current_key].append(line.strip())
-    except FileNotFoundError as e:
-        print(e)
-        return None, None, None, None, None
+def _split_cam_doc(groups):
+    fincl_dict = {}
+    cosp_vars_atm_in = []
+    nudge_atm_in = []
+    other_vars_atm_in = []
+    empty_htapes_atm_in = []
+    for entries in groups.values():
+        for key, entry in entries.items():
+            line = f"{key} = {entry['raw']}"
+            if key.startswith("empty_htapes"):
+                empty_htapes_atm_in.append(line)
+            elif "cosp" in key:
+                cosp_vars_atm_in.append(line)
+            elif key.startswith("fincl"):
+                value = entry["value"]
+                fincl_dict[key] = [value] if isinstance(value, str) else [v for v in value if isinstance(v, str)]
+            elif key.startswith("nudge_"):
+                nudge_atm_in.append(line)
+            elif key in {"mfilt", "nhtfrq", "ncdata"}:
+                other_vars_atm_in.append(line)
 
+    return fincl_dict, cosp_vars_atm_in, nudge_atm_in, other_vars_atm_in, empty_htapes_atm_in
 
-    fincl_dict = {}
-    for key,val in fincl_blocks.items():
-        sure_single = re.sub(r"\s+",
-                                " ",
-                                " ".join(val)
-                            ).strip()
-        fincl_vars = re.findall(r"'([^']+)'", sure_single)
-        fincl_dict[key] = fincl_vars
 
-    nudge_atm_in = []
-    for key,val in nudged_vars.items():
-        for v in val:
-            nudge_atm_in.append(v.replace("\t\t"," "))
+def namelist_values(groups):
+    """Flatten parsed namelist groups to a single {key: value} map (CAM keys are unique across groups)."""
+    return {key: entry["value"] for entries in groups.values() for key, entry in entries.items()}
 
-    other_vars_atm_in = []
-    for key,val in other_vars.items():
-        other_vars_atm_in.append(val.replace("\t\t"," "))
 
-    cosp_vars_atm_in = []
-    for key,val in cosp_vars.items():
-        for v in val:
-            cosp_vars_atm_in.append(v.replace("\t\t"," "))
+def load_cam_doc(docsies):
+    """
+    Split an atm_in file into the fincl lists and the cosp / nudging / history-tape / other lines
+    shown in the run matrix.
 
-    empty_htapes_atm_in = []
-    for key,val in empty_htapes.items():
-        for v in val:
-            empty_htapes_atm_in.append(v.replace("\t\t"," "))
+    :return: (fincl_dict, cosp_vars, nudge_vars, other_vars, empty_htapes), all None if the file is missing.
+    """
+    try:
+        with open(docsies, "r") as f:
+            text = f.read()
+    except FileNotFoundError as e:
+        print(e)
+        return None, None, None, None, None
+    return _split_cam_doc(parse_namelist(text))
 
-    return fincl_dict, cosp_vars_atm_in, nudge_atm_in, other_vars_atm_in, empty_htapes_atm_in
 
 
+def summarize_atm_in(atm_in_path, data=None, sha256=None):
+    """
+    Summarize an atm_in file for the run matrix. The file is read once; the hash and the namelist
+    parse both use that buffer.
 
-def summarize_atm_in(atm_in_path):
-    fincl_dict, cosp_vars, nudge_vars, other_vars, empty_htapes = load_cam_doc(atm_in_path)
-    # normalize all nudged vars to lowercase
-    nudge_atm_in = []
-    for v in nudge_vars:
-        # split at the first '='
-        if '=' in v:
-            lhs, rhs = v.split('=', 1)
-            lhs = lhs.strip().lower()        # lowercase only the variable name
-            rhs = rhs.strip()                # keep the value exactly as-is
-            nudge_atm_in.append(f"{lhs} = {rhs}")
-        else:
-            # if no '=', just lowercase the whole string (rare case)
-            nudge_atm_in.append(v.lower())
-        with open(atm_in_path, "rb") as f:
-            data = f.read()
+    :param data: Contents of the file, if the caller has already read it.
+    :param sha256: Hex digest of `data`, if the caller has already computed it.
+
+    :return: dict of run matrix fields plus "namelist", the full {key: value} map, or None if the
+             file does not exist.
+    """
+    if data is None:
+        try:
+            with open(atm_in_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError as e:
+            print(e)
+            return None
+    if sha256 is None:
         sha256 = hashlib.sha256(data).hexdigest()
+    text = data.decode("utf-8", errors="replace")
+
+    groups = parse_namelist(text)
+    fincl_dict, cosp_vars, nudge_vars, other_vars, empty_htapes = _split_cam_doc(groups)
 
-    if fincl_dict is None and cosp_vars is None and nudge_vars is None and other_vars is None and empty_htapes is None:
-        return {
-            "run_name": None,  # or however you define it
-            "nudging": None,
-            "nudged_vars": None,
-            "cosp": None,
-            "cosp_vars": None,
-            "fincl": None,
-            "empty_htapes": None,
-            "other_vars": None,
-            "source_atm_in": os.path.basename(atm_in_path),
-            "atm_in_sha256": sha256,
-            "snapshot_date": datetime.now(datetime.astimezone.utc).isoformat()
-        }
-
-    
     return {
         "run_name": atm_in_path.split("/")[-2],  # or however you define it
-        "nudging": len(nudge_atm_in) > 0,
-        "nudged_vars": nudge_atm_in,
+        "nudging": len(nudge_vars) > 0,
+        "nudged_vars": nudge_vars,
         "cosp": len(cosp_vars) > 0,
         "cosp_vars": cosp_vars,
         "fincl": fincl_dict,
         "empty_htapes": empty_htapes,
         "other_vars": other_vars,
+        "namelist": namelist_values(groups),
         "source_atm_in": os.path.basename(atm_in_path),
         "atm_in_sha256": sha256,
-       # "snapshot_date": datetime.now(datetime.astimezone.utc).isoformat()
-        "snapshot_date": datetime.utcnow().isoformat()
+        "snapshot_date": datetime.now(timezone.utc).isoformat()
     }
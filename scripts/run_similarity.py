@@ -0,0 +1,312 @@
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+# Similarity index over the namelist key=value sets of all runs in the run matrix.
+#
+# Candidate pairs come from two kinds of buckets, so nothing is compared all-pairs:
+#  - MinHash/LSH bands (NUM_PERM permutations in BANDS bands) catch runs with a high Jaccard
+#    similarity of their key=value sets;
+#  - deletion-neighbourhood buckets catch, exactly, runs whose namelists differ in a single key
+#    (one changed, added or removed value): each run is put in one bucket per key, keyed by the
+#    XOR hash of all its other key=value pairs, plus one bucket for its full set.
+# Runs with identical key=value sets (e.g. copies of one case) are indexed once, as one set. All
+# candidates are scored exactly (Jaccard and number of differing keys, from packed bitsets) and
+# clustered; each set then keeps its CANDIDATES_PER_NEIGHBOR * neighbors closest candidates, for
+# which the key-level diffs are built.
+
+NUM_PERM = 128
+BANDS = 32
+NEIGHBORS = 5
+CLUSTER_JACCARD = 0.9
+MAX_BUCKET = 100  # larger buckets (many near-identical runs) are chained instead of fully paired
+CANDIDATES_PER_NEIGHBOR = 4
+
+_SUMMARY_LINES = ("nudged_vars", "cosp_vars", "other_vars", "empty_htapes")
+
+
+def run_features(entry):
+    """
+    key -> hashable value map of a run matrix entry (lists become tuples). Uses the full "namelist"
+    map when present and falls back to the summary lines (nudged/cosp/other/empty_htapes) and fincl
+    lists of older entries.
+    """
+    if entry.get("namelist"):
+        return {k: tuple(v) if isinstance(v, list) else v for k, v in entry["namelist"].items()}
+    features = {}
+    for field in _SUMMARY_LINES:
+        for line in entry.get(field) or []:
+            key, _, value = line.partition("=")
+            features[key.strip().lower()] = " ".join(value.split())
+    for key, names in (entry.get("fincl") or {}).items():
+        features[key.lower()] = tuple(names)
+    return features
+
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+
+
+def _bucket_pairs(bucket, run, n, order=None):
+    """
+    Pairs (i, j) of runs that share a bucket key, as int64 keys min * n + max. Members are sorted
+    by `order` (default: run) within a bucket and each is paired with the next MAX_BUCKET members
+    (one connected chain for larger buckets).
+    """
+    sort = np.lexsort((run, bucket) if order is None else (run, order, bucket))
+    bucket, run = bucket[sort], run[sort]
+    keep = np.r_[True, (bucket[1:] != bucket[:-1]) | (run[1:] != run[:-1])]
+    bucket, run = bucket[keep], run[keep]
+    keys = [np.empty(0, dtype=np.int64)]
+    for d in range(1, MAX_BUCKET + 1):
+        same = bucket[d:] == bucket[:-d]
+        if not same.any():
+            break
+        a, b = run[:-d][same], run[d:][same]
+        keys.append(np.minimum(a, b) * n + np.maximum(a, b))
+    return np.concatenate(keys)
+
+
+# Number of set bits of every byte value
+_POPCOUNT = np.array([bin(b).count("1") for b in range(256)], dtype=np.int64)
+
+
+def _bitsets(ids_per_set, n_ids):
+    """Packed membership bitsets, (n_sets, ceil(n_ids / 8)) uint8, of per-set arrays of ids."""
+    bits = np.zeros((len(ids_per_set), -(-n_ids // 8)), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(ids_per_set)), [len(ids) for ids in ids_per_set])
+    cols = np.concatenate(ids_per_set) if len(ids_per_set) else np.empty(0, dtype=np.int64)
+    np.bitwise_or.at(bits, (rows, cols >> 3), (128 >> (cols & 7)).astype(np.uint8))
+    return bits
+
+
+def _common(bits, i, j, chunk_bytes=1 << 22):
+    """Number of ids shared by the sets of each pair (i[k], j[k]), from packed bitsets."""
+    step = max(1, chunk_bytes // max(bits.shape[1], 1))
+    return np.concatenate([np.zeros(0, dtype=np.int64)] +
+                          [_POPCOUNT[bits[i[k:k + step]] & bits[j[k:k + step]]].sum(axis=1)
+                           for k in range(0, len(i), step)])
+
+
+def _cap_pairs(keys, n, cap):
+    """
+    Pairs from unique int64 pair keys in priority order, keeping a pair only if it is among the
+    first `cap` pairs of at least one of its two runs.
+
+    :return: (n_pairs, 2) array of (i, j).
+    """
+    pairs = np.stack([keys // n, keys % n], axis=1)
+    run = pairs.T.ravel()
+    pos = np.tile(np.arange(len(pairs)), 2)
+    order = np.lexsort((pos, run))
+    run_sorted = run[order]
+    rank = np.arange(len(run)) - np.searchsorted(run_sorted, run_sorted)
+    keep = np.zeros(len(pairs), dtype=bool)
+    keep[pos[order][rank < cap]] = True
+    return pairs[keep]
+
+
+def minhash_signatures(token_ids, token_hashes, num_perm=NUM_PERM, seed=0):
+    """
+    MinHash signatures (n_runs, num_perm) from per-run arrays of token ids. Every unique token is
+    permuted once with num_perm multiply-add hashes (mod 2**64); a run's signature is the
+    per-permutation minimum over its tokens.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+    permuted = token_hashes[None, :] * a[:, None] + b[:, None]
+    sig = np.full((len(token_ids), num_perm), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for i, ids in enumerate(token_ids):
+        if len(ids):
+            sig[i] = permuted[:, ids].min(axis=1)
+    return sig
+
+
+def diff_features(a, b):
+    """Key-level diff of two feature maps: {"changed": {k: [a, b]}, "added": {k: b}, "removed": {k: a}}."""
+    return _diff(dict(a.items() - b.items()), dict(b.items() - a.items()))
+
+
+def _diff(only_a, only_b):
+    return {"changed": {k: [v, only_b[k]] for k, v in only_a.items() if k in only_b},
+            "added": {k: v for k, v in only_b.items() if k not in only_a},
+            "removed": {k: v for k, v in only_a.items() if k not in only_b}}
+
+
+def _reverse_diff(diff):
+    return {"changed": {k: v[::-1] for k, v in diff["changed"].items()},
+            "added": diff["removed"], "removed": diff["added"]}
+
+
+def build_similarity(matrix, num_perm=NUM_PERM, bands=BANDS, neighbors=NEIGHBORS,
+                     cluster_jaccard=CLUSTER_JACCARD, seed=0):
+    """
+    Build the run similarity index for a run matrix.
+
+    :param matrix: List of run matrix entries (non-dict and unnamed entries are ignored).
+    :param num_perm: Number of MinHash permutations.
+    :param bands: Number of LSH bands (num_perm must divide evenly).
+    :param neighbors: Number of closest runs kept per run.
+    :param cluster_jaccard: Candidate pairs at or above this Jaccard, or differing in at most one key,
+                            are linked into the same cluster.
+
+    :return: dict {"runs": {name: {"cluster", "neighbors": [{"run", "jaccard", "n_diff", "diff"}]}},
+             "clusters": [[names]], plus the index parameters}.
+    """
+    entries = [e for e in matrix if isinstance(e, dict) and e.get("run_name")]
+    names = [e["run_name"] for e in entries]
+    features = [run_features(e) for e in entries]
+
+    # Token table: one 64-bit hash per unique key=value pair
+    n = len(entries)
+    token_index = {}
+    token_ids = [np.fromiter((token_index.setdefault(kv, len(token_index)) for kv in feat.items()),
+                             dtype=np.int64, count=len(feat)) for feat in features]
+    token_hashes = np.fromiter((_hash64(f"{k}\x1f{v}") for k, v in token_index), dtype=np.uint64,
+                               count=len(token_index))
+
+    # Distinct key=value sets; everything below works on sets and is expanded to runs at the end
+    set_index = {}
+    members = []
+    for i, ids in enumerate(token_ids):
+        u = set_index.setdefault(frozenset(ids.tolist()), len(set_index))
+        if u == len(members):
+            members.append([])
+        members[u].append(i)
+    m = len(members)
+    set_ids = [token_ids[g[0]] for g in members]
+    pair_run = np.repeat(np.arange(m), [len(ids) for ids in set_ids])
+    pair_tok = token_hashes[np.concatenate(set_ids)] if m else np.empty(0, dtype=np.uint64)
+
+    parent = list(range(m))
+
+    def find(u):
+        while parent[u] != u:
+            parent[u] = parent[parent[u]]
+            u = parent[u]
+        return u
+
+    pairs = np.empty((0, 2), dtype=np.int64)
+    if m > 1:
+        cap = CANDIDATES_PER_NEIGHBOR * neighbors
+        # Deletion neighbourhoods: the XOR hash of the set and of the set minus each key. Sets
+        # differing in one value share a "minus key" bucket; a set with one extra key lands in the
+        # other set's full-set bucket.
+        total = np.zeros(m, dtype=np.uint64)
+        np.bitwise_xor.at(total, pair_run, pair_tok)
+        drop = total[pair_run] ^ pair_tok
+        candidates = [_bucket_pairs(np.r_[total, drop], np.r_[np.arange(m), pair_run], m)]
+
+        # LSH bands over the MinHash signatures
+        sig = minhash_signatures(set_ids, token_hashes, num_perm=num_perm, seed=seed)
+        rows = num_perm // bands
+        mix = np.random.default_rng(seed + 1).integers(1, 2 ** 63, rows, dtype=np.uint64) | np.uint64(1)
+        band_keys = (sig[:, :bands * rows].reshape(m, bands, rows) * mix).sum(axis=2)
+        band_keys ^= np.arange(bands, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        # Within a band bucket, sets that also agree on the next band are chained next to each other
+        candidates.append(_bucket_pairs(band_keys.ravel(), np.repeat(np.arange(m), bands), m,
+                                        order=np.roll(band_keys, -1, axis=1).ravel()))
+
+        # Exact Jaccard and number of differing keys of every candidate from token and key bitsets
+        # (a key=value set has one token per key)
+        keys = np.unique(np.concatenate(candidates))
+        i, j = keys // m, keys % m
+        key_index = {}
+        token_key = np.fromiter((key_index.setdefault(k, len(key_index)) for k, _ in token_index),
+                                dtype=np.int64, count=len(token_index))
+        sizes = np.array([len(ids) for ids in set_ids], dtype=np.int64)
+        same = _common(_bitsets(set_ids, len(token_index)), i, j)
+        shared_keys = _common(_bitsets([token_key[ids] for ids in set_ids], len(key_index)), i, j)
+        union = sizes[i] + sizes[j] - same
+        jac = np.where(union > 0, same / np.maximum(union, 1), 1.0)
+        n_diff = sizes[i] + sizes[j] - shared_keys - same
+        link = (jac >= cluster_jaccard) | (n_diff <= 1)
+        for u, v in zip(i[link].tolist(), j[link].tolist()):
+            parent[find(u)] = find(v)
+        pairs = _cap_pairs(keys[np.lexsort((-jac, n_diff))], m, cap)
+
+    # Key-level diffs of the kept candidates
+    close = {u: [] for u in range(m)}
+    tokens = list(token_index)
+    token_sets = [set(ids.tolist()) for ids in set_ids]
+    for u, v in pairs.tolist():
+        only_u, only_v = token_sets[u] - token_sets[v], token_sets[v] - token_sets[u]
+        diff = _diff(dict(tokens[t] for t in only_u), dict(tokens[t] for t in only_v))
+        n_diff = sum(len(d) for d in diff.values())
+        same = len(token_sets[u]) - len(only_u)
+        union = len(token_sets[u]) + len(only_v)
+        jac = round(same / union if union else 1.0, 4)
+        close[u].append((n_diff, -jac, v, diff))
+        close[v].append((n_diff, -jac, u, _reverse_diff(diff)))
+
+    # Runs of a set are identical (n_diff 0), so they come first among each other's neighbours,
+    # followed by the closest runs of the candidate sets
+    sorted_names = [sorted(names[i] for i in g) for g in members]
+    set_neighbors = []
+    for u in range(m):
+        ranked = sorted(((n_diff, neg_jac, name, diff) for n_diff, neg_jac, v, diff in close[u]
+                         for name in sorted_names[v][:neighbors]), key=lambda r: r[:3])[:neighbors]
+        set_neighbors.append([{"run": name, "jaccard": -neg_jac, "n_diff": n_diff, "diff": diff}
+                              for n_diff, neg_jac, name, diff in ranked])
+
+    groups = {}
+    for u in range(m):
+        groups.setdefault(find(u), []).extend(members[u])
+    clusters = sorted((sorted(g) for g in groups.values() if len(g) > 1), key=lambda g: (-len(g), g[0]))
+    cluster_of = {i: c for c, g in enumerate(clusters) for i in g}
+
+    runs = {}
+    no_diff = {"changed": {}, "added": {}, "removed": {}}
+    for u, g in enumerate(members):
+        for i in g:
+            same = [{"run": name, "jaccard": 1.0, "n_diff": 0, "diff": no_diff}
+                    for name in sorted_names[u][:neighbors + 1] if name != names[i]][:neighbors]
+            runs[names[i]] = {"cluster": cluster_of.get(i), "n_keys": len(features[i]),
+                              "neighbors": same + set_neighbors[u][:neighbors - len(same)]}
+
+    return {"version": 1, "generated": datetime.now(timezone.utc).isoformat(),
+            "num_perm": num_perm, "bands": bands, "cluster_jaccard": cluster_jaccard,
+            "clusters": [[names[i] for i in g] for g in clusters], "runs": runs}
+
+
+def nearest(index, run_name, k=NEIGHBORS):
+    """Closest runs to run_name in a similarity index (as built by build_similarity or read from JSON)."""
+    return index["runs"].get(run_name, {}).get("neighbors", [])[:k]
+
+
+def write_similarity(matrix, path="docs/run_similarity.json", **kw):
+    index = build_similarity(matrix, **kw)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, path)
+    print(f"Wrote {path} ({len(index['runs'])} runs, {len(index['clusters'])} clusters)")
+    return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the run similarity index for the run matrix.")
+    parser.add_argument("--matrix", default="docs/run_matrix.json")
+    parser.add_argument("--out", default="docs/run_similarity.json")
+    parser.add_argument("--query", metavar="RUN_NAME", help="print the closest runs to RUN_NAME")
+    parser.add_argument("-k", type=int, default=NEIGHBORS, help="neighbours to print with --query")
+    args = parser.parse_args(argv)
+
+    with open(args.matrix) as f:
+        matrix = json.load(f)
+    index = write_similarity(matrix, args.out)
+    if args.query:
+        for r in nearest(index, args.query, args.k):
+            print(f"  {r['run']}  jaccard={r['jaccard']:.3f}  n_diff={r['n_diff']}")
+            for kind, d in r["diff"].items():
+                for key, value in d.items():
+                    print(f"      {kind:<8} {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import numpy as np
+
+# Mergeable t-digest quantile sketches, kept as plain dicts of numpy arrays so they can be
+# stored as JSON next to the flight output and merged across flights and campaigns.
+#
+# A digest holds centroids (mean, weight) sorted by mean plus the exact min/max. Compression
+# uses the k1 scale function k(q) = delta / (2 pi) * asin(2q - 1): every centroid spans at most
+# one unit of k, which keeps centroids small near the tails, so extreme quantiles stay accurate.
+
+DEFAULT_DELTA = 200
+
+
+def _k1(q, delta):
+    return delta / (2 * np.pi) * np.arcsin(2 * np.clip(q, 0, 1) - 1)
+
+
+def _compress(means, weights, delta):
+    """Merge sorted (mean, weight) pairs into centroids spanning at most one k unit each."""
+    total = weights.sum()
+    q_mid = (np.cumsum(weights) - 0.5 * weights) / total
+    bucket = np.floor(_k1(q_mid, delta) - _k1(0, delta)).astype(np.int64)
+    bucket = np.unique(bucket, return_inverse=True)[1]
+    w = np.bincount(bucket, weights=weights)
+    m = np.bincount(bucket, weights=means * weights) / w
+    return m, w
+
+
+def empty_digest(delta=DEFAULT_DELTA):
+    return {'mean': np.array([]), 'weight': np.array([]), 'min': np.nan, 'max': np.nan, 'delta': delta}
+
+
+def build_digest(values, delta=DEFAULT_DELTA):
+    """
+    Build a t-digest from a sample (NaNs are ignored).
+
+    :param values: Array-like of values.
+    :param delta: Compression; the digest holds at most delta / 2 centroids.
+
+    :return: dict with 'mean', 'weight' (centroids), 'min', 'max' and 'delta'.
+    """
+    x = np.asarray(values, dtype=float)
+    x = np.sort(x[np.isfinite(x)])
+    if not len(x):
+        return empty_digest(delta)
+    m, w = _compress(x, np.ones(len(x)), delta)
+    return {'mean': m, 'weight': w, 'min': x[0], 'max': x[-1], 'delta': delta}
+
+
+def merge_digests(digests, delta=None):
+    """Merge several digests into one (as if built from the union of their samples)."""
+    digests = [d for d in digests if len(d['mean'])]
+    if not digests:
+        return empty_digest(delta or DEFAULT_DELTA)
+    delta = delta or max(d['delta'] for d in digests)
+    means = np.concatenate([d['mean'] for d in digests])
+    weights = np.concatenate([d['weight'] for d in digests])
+    order = np.argsort(means, kind='stable')
+    m, w = _compress(means[order], weights[order], delta)
+    return {'mean': m, 'weight': w, 'min': min(d['min'] for d in digests),
+            'max': max(d['max'] for d in digests), 'delta': delta}
+
+
+def digest_count(digest):
+    return float(np.sum(digest['weight']))
+
+
+def digest_quantile(digest, q):
+    """
+    Estimate quantiles from a digest by interpolating between centroid centers.
+
+    :param q: Quantile or array of quantiles in [0, 1].
+
+    :return: Float or array (NaN for an empty digest).
+    """
+    q = np.asarray(q, dtype=float)
+    w = np.asarray(digest['weight'], dtype=float)
+    if not len(w):
+        return np.full(q.shape, np.nan) if q.ndim else np.nan
+    total = w.sum()
+    centers = np.cumsum(w) - 0.5 * w
+    x = np.concatenate([[0.0], centers, [total]])
+    y = np.concatenate([[digest['min']], digest['mean'], [digest['max']]])
+    return np.interp(q * total, x, y)
+
+
+def digest_to_dict(digest):
+    """JSON-serializable form of a digest."""
+    return {'mean': [float(v) for v in digest['mean']], 'weight': [float(v) for v in digest['weight']],
+            'min': None if np.isnan(digest['min']) else float(digest['min']),
+            'max': None if np.isnan(digest['max']) else float(digest['max']),
+            'delta': digest['delta']}
+
+
+def digest_from_dict(d):
+    return {'mean': np.asarray(d['mean'], dtype=float), 'weight': np.asarray(d['weight'], dtype=float),
+            'min': np.nan if d['min'] is None else d['min'], 'max': np.nan if d['max'] is None else d['max'],
+            'delta': d['delta']}
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+import inform_utils as inform
+import process_data_products_utils as pdp
+import synthetic as syn
+
+CAMPAIGN = 'SOCRATES'
+
+
+@pytest.fixture(scope='session')
+def pipeline_inputs(tmp_path_factory):
+    """Synthetic 4 h flight, its blocks and ERA5 tree (see benchmarks/synthetic.py)."""
+    work = tmp_path_factory.mktemp('pipeline')
+    flight_dir = os.path.dirname(syn.write_flight_dir(str(work / 'flights'), 1, 4 * 3600)[0])
+    era5_root = str(work / 'era5') + os.sep
+    syn.write_era5_tree(era5_root)
+    df = inform.load_flight_data(flight_dir)
+    blocks = pdp.block_flight(pdp.assign_flight_type(df)['DataFrame'])
+    return {'df': df, 'blocks': blocks, 'era5_root': era5_root}
+
+
+@pytest.fixture(scope='session')
+def pipeline_blocks(pipeline_inputs):
+    """cloud_regime output for the synthetic flight."""
+    df, era5_root = pipeline_inputs['df'], pipeline_inputs['era5_root']
+    ds = pdp.select_ERA5_4flight(df, CAMPAIGN, era5_root)
+    blocks = copy_blocks(pipeline_inputs['blocks'])
+    return pdp.cloud_regime(pdp.collocate_ERA5_dat(ds, blocks), CAMPAIGN)
+
+
+def copy_blocks(blocks):
+    return {label: [b.copy() for b in frames] for label, frames in blocks.items()}
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+import inform_utils as inform
+import composite_utils as cu
+import process_data_products_utils as pdp
+from conftest import CAMPAIGN, copy_blocks
+
+
+def test_read_composites_flat_matches_load_nc_cldrgme(pipeline_blocks, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pdp.write_RF_nc(copy_blocks(pipeline_blocks), 'RF01', CAMPAIGN)
+    path = str(tmp_path / f"{CAMPAIGN}_RF01.nc")
+
+    old = inform.load_nc_cldrgme([path])
+    new = cu.read_composites([path])
+    assert 'block_id' in new.columns
+    assert set(new.columns) == set(old.columns) - {'index'}
+    assert len(new) == len(old)
+
+
+def _samples(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'block_label': rng.choice(['Level BL', 'Level FT', 'Profile'], n),
+        'cloud_regime': pd.Categorical(rng.choice(['Open-Cell', 'Stratocumulus'], n),
+                                       categories=['Unknown', 'Open-Cell', 'Stratocumulus']),
+        'WIC': rng.normal(0, 2, n),
+        'CONCD': 10 ** rng.uniform(-2, 4, n),
+        'w': rng.uniform(0, 2, n),
+    })
+    df.loc[rng.random(n) < 0.05, 'WIC'] = np.nan
+    df.loc[:9, 'WIC'] = [-3, 3, -3.0001, 3.0001, 0, -1, 1, np.inf, -np.inf, 0.5]   # edges / outside
+    return df
+
+
+def test_grouped_histograms_match_np_histogram_per_group():
+    df = _samples()
+    bins = {'WIC': ('lin', -3, 3, 12), 'CONCD': ('log', 0.1, 1000, 8)}
+    got = cu.grouped_histograms(df, ['block_label', 'cloud_regime'], bins, weights='w')
+    for var, spec in bins.items():
+        edges = cu.bin_edges(spec)
+        for (label, regime), g in df.groupby(['block_label', 'cloud_regime'], observed=True):
+            rows = got[(got['variable'] == var) & (got['block_label'] == label) & (got['cloud_regime'] == regime)]
+            x = g[var].to_numpy(dtype=float)
+            ok = np.isfinite(x)
+            counts, _ = np.histogram(x[ok], bins=edges, weights=g['w'].to_numpy()[ok])
+            np.testing.assert_allclose(rows['count'].to_numpy(), counts)
+            np.testing.assert_allclose(rows['left'].to_numpy(), edges[:-1])
+            np.testing.assert_allclose(rows['fraction'].to_numpy(), counts / counts.sum())
+            np.testing.assert_allclose(rows['density'].to_numpy(), counts / counts.sum() / np.diff(edges))
+    # Groups without samples get no rows
+    assert 'Unknown' not in set(got['cloud_regime'].astype(str))
+
+
+def _profile_blocks(seed=0):
+    rng = np.random.default_rng(seed)
+    frames = []
+    # Six Open-Cell blocks and a single Stratocumulus block
+    for k, regime in enumerate(['Open-Cell'] * 6 + ['Stratocumulus']):
+        n = int(rng.integers(40, 80))
+        frames.append(pd.DataFrame({
+            'flight': f"RF{k % 2 + 1:02d}", 'block_label': 'In-Cloud Profiles', 'block_index': k,
+            'cloud_regime': regime, 'GGALT': np.sort(rng.uniform(200, 1500, n)),
+            'CONCD': 10 ** rng.normal(1.5 + 0.1 * k, 0.3, n), 'WIC': rng.normal(0.2 * k, 1, n),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_bootstrap_histograms_shape_determinism_and_single_block_group():
+    df = _profile_blocks()
+    bins = {'WIC': ('lin', -3, 3, 12)}
+    base = cu.grouped_histograms(df, ['cloud_regime'], bins)
+    got = cu.bootstrap_histograms(df, ['cloud_regime'], bins, n_boot=200, seed=1)
+    pd.testing.assert_frame_equal(got[base.columns], base, check_dtype=False)
+    assert dict(zip(got['cloud_regime'], got['n_blocks'])) == {'Open-Cell': 6, 'Stratocumulus': 1}
+    assert (got['density_lo'] <= got['density_hi']).all()
+
+    again = cu.bootstrap_histograms(df, ['cloud_regime'], bins, n_boot=200, seed=1)
+    pd.testing.assert_frame_equal(got, again)
+    other = cu.bootstrap_histograms(df, ['cloud_regime'], bins, n_boot=200, seed=2)
+    assert not np.allclose(got['density_lo'], other['density_lo'])
+
+    # Resampling a single block always gives the block itself back
+    one = got[got['cloud_regime'] == 'Stratocumulus']
+    np.testing.assert_allclose(one['density_lo'], one['density'])
+    np.testing.assert_allclose(one['density_hi'], one['density'])
+    np.testing.assert_allclose(one['density_se'], 0.0, atol=1e-12)
+
+
+def test_bootstrap_profiles_shape_and_determinism():
+    df = _profile_blocks()
+    base = cu.composite_profiles(df, ['CONCD'], quantiles=())
+    got = cu.bootstrap_profiles(df, ['CONCD'], n_boot=200, seed=1)
+    assert len(got) == len(base)
+    np.testing.assert_allclose(got['mean'], base['mean'])
+    np.testing.assert_array_equal(got['z_bin'], base['z_bin'])
+    assert (got['mean_lo'] <= got['mean_hi']).all()
+    pd.testing.assert_frame_equal(got, cu.bootstrap_profiles(df, ['CONCD'], n_boot=200, seed=1))
+
+
+def test_composite_profiles_match_a_per_block_loop():
+    df = _profile_blocks()
+    df.loc[df.index[::17], 'CONCD'] = 0.0            # dropped by the log
+    got = cu.composite_profiles(df, ['CONCD', 'WIC'], log=False, quantiles=(0.5,))
+    edges = cu.bin_edges(('lin', 0, 1, 10))
+
+    parts = []
+    for _, block in df.groupby(['flight', 'block_index']):
+        z = (block['GGALT'] - block['GGALT'].min()) / (block['GGALT'].max() - block['GGALT'].min())
+        parts.append(block.assign(z_bin=np.clip(np.digitize(z, edges) - 1, 0, len(edges) - 2)))
+    ref = pd.concat(parts).melt(id_vars=['cloud_regime', 'z_bin'], value_vars=['CONCD', 'WIC'],
+                                var_name='variable')
+    ref = ref.groupby(['cloud_regime', 'variable', 'z_bin'])['value'].agg(['mean', 'std', 'count', 'median'])
+    got = got.set_index(['cloud_regime', 'variable', 'z_bin']).sort_index()
+    ref = ref.reindex(got.index)
+    assert len(got) == len(ref.dropna(subset=['count']))
+    np.testing.assert_allclose(got['mean'], ref['mean'])
+    np.testing.assert_allclose(got['std'], ref['std'])
+    np.testing.assert_array_equal(got['count'], ref['count'])
+    np.testing.assert_allclose(got['q50'], ref['median'])
+    np.testing.assert_allclose(got['z_center'], 0.5 * (edges[:-1] + edges[1:])[got.index.get_level_values('z_bin')])
+
+    logged = cu.composite_profiles(df, ['CONCD'], quantiles=())
+    assert logged['count'].sum() == (df['CONCD'] > 0).sum()
+
+
+def test_map_density_matches_histogram2d_per_group():
+    df = _samples()
+    rng = np.random.default_rng(3)
+    df['GGLON'] = rng.uniform(140, 160, len(df))
+    df['GGLAT'] = rng.uniform(-60, -40, len(df))
+    df.loc[:4, 'GGLON'] = np.nan
+    extent = [142, 158, -58, -42]
+    got = cu.map_density(df, by=['block_label'], res=2.0, extent=extent, weights='w')
+    lon_edges, lat_edges = got['lon_edges'], got['lat_edges']
+    assert lon_edges[0] == 142 and lat_edges[0] == -58 and lon_edges[-1] >= 158
+
+    for g, label in enumerate(got['groups']['block_label']):
+        sel = df[df['block_label'] == label].dropna(subset=['GGLON'])
+        ref, _, _ = np.histogram2d(sel['GGLAT'], sel['GGLON'], bins=[lat_edges, lon_edges], weights=sel['w'])
+        np.testing.assert_allclose(got['counts'][g], ref)
+    np.testing.assert_allclose(got['total'], got['counts'].sum(axis=0))
+    filled = got['total'] > 0
+    np.testing.assert_allclose(got['fraction'].sum(axis=0)[filled], 1.0)
+    np.testing.assert_array_equal(got['dominant'][filled], got['counts'].argmax(axis=0)[filled])
+    assert (got['dominant'][~filled] == -1).all()
+
+    single = cu.map_density(df, by=(), res=2.0, extent=extent)
+    assert single['counts'].shape[0] == 1
+    assert single['total'].sum() == ((df['GGLON'] >= lon_edges[0]) & (df['GGLON'] <= lon_edges[-1])
+                                     & (df['GGLAT'] >= lat_edges[0]) & (df['GGLAT'] <= lat_edges[-1])).sum()
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+
+import process_data_products_utils as pdp
+from conftest import CAMPAIGN, copy_blocks
+
+
+def test_collocate_ERA5_pointwise_matches_full_grid(pipeline_inputs):
+    df, era5_root = pipeline_inputs['df'], pipeline_inputs['era5_root']
+    grid = pdp.collocate_ERA5_dat(pdp.select_ERA5_4flight(df, CAMPAIGN, era5_root),
+                                  copy_blocks(pipeline_inputs['blocks']))
+    point = pdp.collocate_ERA5_pointwise(pdp.load_ERA5_primitives(df, CAMPAIGN, era5_root),
+                                         copy_blocks(pipeline_inputs['blocks']))
+
+    n = 0
+    for label, frames in grid.items():
+        for expected, got in zip(frames, point[label]):
+            assert len(got) == len(expected)
+            np.testing.assert_array_equal(got['Time'].to_numpy(), expected['Time'].to_numpy())
+            for col in pdp.ERA5_COLLOCATED:
+                np.testing.assert_allclose(got[col].to_numpy(dtype=float), expected[col].to_numpy(dtype=float),
+                                           rtol=1e-6, atol=1e-9, err_msg=f"{label}: {col}")
+            n += len(got)
+    assert n > 0
+
+
+def test_interp_log_pressure_reproduces_levels_and_rejects_outside():
+    p_levels = np.array([500., 700., 850., 1000.])
+    values = np.tile(2.0 * np.log(p_levels) + 1.0, (6, 1))       # linear in log(p)
+    p_target = np.array([700., 850., 600., 1000., 400., np.nan])
+    got = pdp.interp_log_pressure(p_levels, values, p_target)
+    np.testing.assert_allclose(got[:4], 2.0 * np.log(p_target[:4]) + 1.0)
+    assert np.isnan(got[4:]).all()
+
+    # One column of levels per sample; pressures past either end of their own column are NaN
+    cols = np.array([[600., 800., 900.], [500., 700., 850.]])
+    got = pdp.interp_log_pressure(cols, np.array([[1., 2., 3.], [4., 5., 6.]]), np.array([800., 900.]))
+    assert got[0] == 2.0 and np.isnan(got[1])
+
+
+def test_collocate_ERA5_dat_plev_matches_level_at_aircraft_pressure(pipeline_inputs):
+    df, era5_root = pipeline_inputs['df'], pipeline_inputs['era5_root']
+    plev = pdp.load_ERA5_plev_band(df, CAMPAIGN, era5_root=era5_root)
+    blocks = copy_blocks(pipeline_inputs['blocks'])
+    for frames in blocks.values():
+        for b in frames:
+            b['PSXC'] = np.where(np.arange(len(b)) % 2, 850.0, 1.0)    # on a level / above the band
+    blocks = pdp.collocate_ERA5_dat(pdp.select_ERA5_4flight(df, CAMPAIGN, era5_root), blocks, plev=plev)
+
+    got = pdp.stack_blocks(blocks)[0]
+    stacked = pd.concat([b for _, _, b in got], ignore_index=True)
+    on_level = stacked['PSXC'].to_numpy() == 850.0
+    ti, yi, xi = pdp.ERA5_grid_locator(plev)(stacked['GGLAT'].values, stacked['GGLON'].values,
+                                             stacked['Time'].values)
+    k = int(np.flatnonzero(plev['level'].values == 850.0)[0])
+    for var in plev.data_vars:
+        col = stacked[f"ERA5_{var}_ac"].to_numpy()
+        np.testing.assert_allclose(col[on_level], plev[var].values[ti, k, yi, xi][on_level], rtol=1e-6)
+        assert np.isnan(col[~on_level]).all()
+
+
+def _brute_box(A, t, y, x, half):
+    win = A[t, max(y - half, 0):y + half + 1, max(x - half, 0):x + half + 1]
+    if not np.isfinite(win).any():
+        return np.nan, np.nan
+    return np.nanmean(win), np.nanvar(win)
+
+
+def test_box_stats_match_brute_force_window_with_nans_and_edges():
+    rng = np.random.default_rng(0)
+    A = 280.0 + rng.standard_normal((3, 9, 11))
+    A[rng.random(A.shape) < 0.2] = np.nan
+    A[1, :4, :4] = np.nan                                    # a box with no valid points at a corner
+    sats = pdp.summed_area_tables(A)
+
+    ti, yi, xi = np.meshgrid(np.arange(3), np.arange(9), np.arange(11), indexing='ij')
+    ti, yi, xi = ti.ravel(), yi.ravel(), xi.ravel()
+    for half in (0, 1, 2, 6):
+        mean, var = pdp.box_stats(sats, ti, yi, xi, half)
+        expected = np.array([_brute_box(A, t, y, x, half) for t, y, x in zip(ti, yi, xi)])
+        np.testing.assert_allclose(mean, expected[:, 0], rtol=1e-12, atol=1e-9)
+        np.testing.assert_allclose(var, expected[:, 1], rtol=1e-7, atol=1e-9)
+    assert np.isnan(pdp.box_stats(sats, np.array([1]), np.array([0]), np.array([0]), 1)[0]).all()
+
+
+def test_collocate_ERA5_dat_neighborhood_columns(pipeline_inputs):
+    df, era5_root = pipeline_inputs['df'], pipeline_inputs['era5_root']
+    ds = pdp.select_ERA5_4flight(df, CAMPAIGN, era5_root)
+    blocks = pdp.collocate_ERA5_dat(ds, copy_blocks(pipeline_inputs['blocks']), neighborhood=[0, 1])
+    stacked = pd.concat([b for frames in blocks.values() for b in frames if len(b)], ignore_index=True)
+
+    # A 1x1 box is the nearest gridpoint itself
+    np.testing.assert_allclose(stacked['M_mean1x1'], stacked['M'], rtol=1e-12)
+    np.testing.assert_allclose(stacked['M_var1x1'], 0.0, atol=1e-9)
+
+    M = ds['M'].transpose('time', 'latitude', 'longitude').values.astype(float)
+    ti, yi, xi = pdp.ERA5_grid_locator(ds['M'])(stacked['GGLAT'].values, stacked['GGLON'].values,
+                                               stacked['Time'].values)
+    expected = np.array([_brute_box(M, t, y, x, 1) for t, y, x in zip(ti, yi, xi)])
+    np.testing.assert_allclose(stacked['M_mean3x3'], expected[:, 0], rtol=1e-10)
+    np.testing.assert_allclose(stacked['M_var3x3'], expected[:, 1], rtol=1e-6, atol=1e-12)
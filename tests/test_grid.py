@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import inform_grid_utils as igu
+
+
+def _track(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, n)
+    df = pd.DataFrame({'Time': pd.date_range('2018-01-15', periods=n, freq='s'),
+                       'GGLON': 140 + 5 * t + 0.01 * rng.standard_normal(n),
+                       'GGLAT': -45 + 2 * np.sin(6 * t),
+                       'PSXC': 900 - 300 * np.abs(np.sin(9 * t))})
+    df.loc[[0, n // 4, n - 1], 'PSXC'] = np.nan
+    return df
+
+
+@pytest.mark.parametrize('budget', [2, 3, 50, 500])
+def test_decimate_track_keeps_endpoints_and_respects_budget(budget):
+    df = _track()
+    valid = df.dropna(subset=['GGLON', 'GGLAT', 'PSXC'])
+    got = igu.decimate_track(df, max_points=budget)
+    assert len(got) == budget
+    assert got.index.is_monotonic_increasing
+    assert got.index[0] == valid.index[0] and got.index[-1] == valid.index[-1]
+    assert got[['GGLON', 'GGLAT', 'PSXC']].notna().all().all()
+
+
+def test_decimate_track_keeps_the_corner_of_a_bent_track():
+    n = 101
+    df = pd.DataFrame({'GGLON': np.r_[np.linspace(0, 1, 51), np.ones(50)],
+                       'GGLAT': np.r_[np.zeros(51), np.linspace(0, 1, 51)[1:]], 'PSXC': 800.0})
+    assert list(igu.decimate_track(df, max_points=3).index) == [0, 50, n - 1]
+
+
+def test_decimate_track_under_budget_and_invalid_budget():
+    df = _track(n=100)
+    pd.testing.assert_frame_equal(igu.decimate_track(df, max_points=500), df.dropna())
+    with pytest.raises(ValueError):
+        igu.decimate_track(df, max_points=1)
@@ -0,0 +1,44 @@
+from parse_namelist import lex_namelist, parse_namelist
+
+ATM_IN = """\
+&cam_history_nl
+ fincl1 = 'T', 'Q:A', "U, V",   ! comment with 'quotes', a / slash and = sign
+          'CLOUD'
+ nhtfrq = 0, -24, 3*1
+ note = 'it''s / not ! a comment'
+ empty_htapes = .true.
+/
+$phys_ctl_nl
+ rel_fac = 1.5d0, 2*'x' , 2* "y"
+ cld_macmic_num_steps=3 $end
+ &ignored_after_end
+"""
+
+
+def test_lex_namelist_strings_comments_and_continuations():
+    tokens = [(kind, value) for kind, value, _, _ in lex_namelist(ATM_IN)]
+    assert tokens[:13] == [
+        ('group', '&cam_history_nl'),
+        ('word', 'fincl1'), ('assign', '='), ('string', "'T'"), ('comma', ','), ('string', "'Q:A'"),
+        ('comma', ','), ('string', '"U, V"'), ('comma', ','),
+        ('string', "'CLOUD'"),                               # continuation line, comment skipped
+        ('word', 'nhtfrq'), ('assign', '='), ('word', '0'),
+    ]
+    assert ('string', "'it''s / not ! a comment'") in tokens
+    assert [t for t in tokens if t[0] == 'end'] == [('end', '/'), ('end', '$end')]
+    for _, value, start, end in lex_namelist(ATM_IN):
+        assert ATM_IN[start:end] == value
+
+
+def test_parse_namelist_values_and_repeats():
+    groups = parse_namelist(ATM_IN)
+    assert list(groups) == ['cam_history_nl', 'phys_ctl_nl', 'ignored_after_end']
+    hist, phys = groups['cam_history_nl'], groups['phys_ctl_nl']
+    assert hist['fincl1']['value'] == ['T', 'Q:A', 'U, V', 'CLOUD']
+    assert hist['nhtfrq']['value'] == [0, -24, 1, 1, 1]
+    assert hist['nhtfrq']['raw'] == "0, -24, 3*1"
+    assert hist['note']['value'] == "it's / not ! a comment"
+    assert hist['empty_htapes']['value'] is True
+    assert phys['rel_fac']['value'] == [1.5, 'x', 'x', 'y', 'y']
+    assert phys['cld_macmic_num_steps']['value'] == 3
+    assert groups['ignored_after_end'] == {}
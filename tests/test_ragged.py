@@ -0,0 +1,135 @@
+import netCDF4
+import numpy as np
+import pandas as pd
+import pytest
+
+import composite_utils as cu
+import process_data_products_utils as pdp
+from conftest import CAMPAIGN, copy_blocks
+
+
+def _expected(blocks, rf):
+    frames = []
+    for label, df_list in blocks.items():
+        for i, df in enumerate(df_list):
+            df = df.reset_index(drop=True)
+            df.insert(0, 'block_index', i)
+            df.insert(0, 'block_label', label)
+            df.insert(0, 'flight', rf)
+            frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_ragged_round_trip_of_cloud_regime_output(pipeline_blocks, tmp_path):
+    blocks = copy_blocks(pipeline_blocks)
+    assert any('block_id' in b for frames in blocks.values() for b in frames)
+    path = str(tmp_path / f"{CAMPAIGN}_RF01.nc")
+    pdp.write_RF_nc(blocks, 'RF01', CAMPAIGN, layout='ragged', path=path)
+
+    got = cu.read_composites([path])
+    expected = _expected(pipeline_blocks, 'RF01')
+    assert list(got.columns) == list(expected.columns)
+    assert len(got) == len(expected)
+    pd.testing.assert_series_equal(got['block_id'], expected['block_id'], check_dtype=False)
+    assert (got['cloud_regime'].astype(str) == expected['cloud_regime'].astype(str)).all()
+    np.testing.assert_array_equal(got['Time'].to_numpy().astype('datetime64[ns]'),
+                                  expected['Time'].to_numpy().astype('datetime64[ns]'))
+    for col in ('GGALT', 'ATX', 'M', 'EIS'):
+        np.testing.assert_allclose(got[col].to_numpy(dtype=float), expected[col].to_numpy(dtype=float))
+
+
+def test_ragged_integer_column_added_later_reads_missing(tmp_path):
+    t = pd.date_range('2018-01-15', periods=3, freq='s')
+    first = {'Level BL': [pd.DataFrame({'Time': t, 'ATX': [1.0, 2.0, 3.0]})]}
+    second = {'Level BL': [pd.DataFrame({'Time': t + pd.Timedelta('1h'), 'ATX': [4.0, 5.0, 6.0],
+                                         'count': np.array([7, 8, 9], dtype='int64')})]}
+    path = str(tmp_path / "CSET_RF01.nc")
+    pdp.write_RF_nc_ragged(first, 'RF01', 'CSET', path=path)
+    pdp.write_RF_nc_ragged(second, 'RF01', 'CSET', path=path, append=True)
+
+    got = cu.read_composites([path])
+    assert got['count'].isna().tolist() == [True] * 3 + [False] * 3
+    assert got['count'].iloc[3:].tolist() == [7, 8, 9]
+
+
+def test_ragged_append_merges_sketches(pipeline_blocks, tmp_path):
+    blocks = copy_blocks(pipeline_blocks)
+    first = {label: frames[:len(frames) // 2] for label, frames in blocks.items()}
+    second = {label: frames[len(frames) // 2:] for label, frames in blocks.items()}
+    path = str(tmp_path / f"{CAMPAIGN}_RF01.nc")
+    pdp.write_RF_nc(first, 'RF01', CAMPAIGN, layout='ragged', path=path, block_summary=False)
+    pdp.write_RF_nc(second, 'RF01', CAMPAIGN, layout='ragged', path=path, append=True, block_summary=False)
+    whole = pdp.write_RF_sketches(blocks, 'RF01', CAMPAIGN, path=str(tmp_path / "whole_sketch.json"))
+
+    keys = ['block_label', 'cloud_regime', 'variable']
+    got = cu.sketch_quantiles([str(tmp_path / f"{CAMPAIGN}_RF01_sketch.json")], ['ATX', 'GGALT'])
+    expected = cu.sketch_quantiles([whole], ['ATX', 'GGALT'])
+    got = got.sort_values(keys, ignore_index=True)
+    expected = expected.sort_values(keys, ignore_index=True)
+    pd.testing.assert_frame_equal(got[keys + ['count']], expected[keys + ['count']])
+    np.testing.assert_allclose(got['q50'], expected['q50'], rtol=1e-2)
+
+
+def test_write_RF_nc_rejects_unknown_layout_before_writing(pipeline_blocks, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(ValueError):
+        pdp.write_RF_nc(copy_blocks(pipeline_blocks), 'RF01', CAMPAIGN, layout='columnar')
+    assert not list(tmp_path.iterdir())
+
+
+def test_ragged_append_extends_block_summary(pipeline_blocks, tmp_path):
+    blocks = copy_blocks(pipeline_blocks)
+    first = {label: frames[:len(frames) // 2] for label, frames in blocks.items()}
+    second = {label: frames[len(frames) // 2:] for label, frames in blocks.items()}
+    path = str(tmp_path / f"{CAMPAIGN}_RF01.nc")
+    pdp.write_RF_nc(first, 'RF01', CAMPAIGN, layout='ragged', path=path, sketches=False)
+    pdp.write_RF_nc(second, 'RF01', CAMPAIGN, layout='ragged', path=path, append=True, sketches=False)
+
+    got = pd.read_parquet(str(tmp_path / f"{CAMPAIGN}_RF01_blocks.parquet"))
+    index = cu.build_block_index([path])
+    assert sorted(zip(got['block_label'], got['block_index'], got['n_samples'])) == \
+        sorted(zip(index['block_label'], index['block_index'], index['count']))
+
+
+def _with_empty_blocks(blocks):
+    blocks = copy_blocks(blocks)
+    for frames in blocks.values():
+        frames.insert(1, frames[0].iloc[:0])
+    return blocks
+
+
+def _block_keys(df):
+    return sorted(zip(df['block_label'], df['block_index'], df['n_samples']))
+
+
+def test_ragged_block_index_matches_flat_file_and_summary_with_empty_blocks(pipeline_blocks, tmp_path,
+                                                                            monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    blocks = _with_empty_blocks(pipeline_blocks)
+    pdp.write_RF_nc(copy_blocks(blocks), 'RF01', CAMPAIGN, sketches=False, block_summary=False)
+    flat = cu.read_composites([str(tmp_path / f"{CAMPAIGN}_RF01.nc")])
+    path = str(tmp_path / f"{CAMPAIGN}_RF01_ragged.nc")
+    pdp.write_RF_nc(blocks, 'RF01', CAMPAIGN, layout='ragged', path=path, sketches=False)
+
+    index = cu.build_block_index([path]).rename(columns={'count': 'n_samples'})
+    summary = pd.read_parquet(str(tmp_path / f"{CAMPAIGN}_RF01_ragged_blocks.parquet"))
+    flat_blocks = flat.groupby(['block_label', 'block_index']).size().rename('n_samples').reset_index()
+    assert 1 not in set(index['block_index'])
+    assert _block_keys(index) == _block_keys(flat_blocks) == _block_keys(summary)
+
+
+def test_ragged_append_with_empty_blocks_matches_summary(pipeline_blocks, tmp_path):
+    blocks = copy_blocks(pipeline_blocks)
+    first = {label: frames[:1] for label, frames in blocks.items()}
+    second = _with_empty_blocks({label: frames[1:] for label, frames in blocks.items() if len(frames) > 1})
+    path = str(tmp_path / f"{CAMPAIGN}_RF01.nc")
+    pdp.write_RF_nc(first, 'RF01', CAMPAIGN, layout='ragged', path=path, sketches=False)
+    pdp.write_RF_nc(second, 'RF01', CAMPAIGN, layout='ragged', path=path, append=True, sketches=False)
+
+    index = cu.build_block_index([path]).rename(columns={'count': 'n_samples'})
+    summary = pd.read_parquet(str(tmp_path / f"{CAMPAIGN}_RF01_blocks.parquet"))
+    assert _block_keys(index) == _block_keys(summary)
+    assert not index.duplicated(['block_label', 'block_index']).any()
+    with netCDF4.Dataset(path) as nc:
+        block_ids = list(nc['block_id'][:])
+    assert block_ids == [f"RF01/{label}/{i}" for label, i in zip(index['block_label'], index['block_index'])]
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import process_data_products_utils as pdp
+
+
+def _old_cloud_regime(block, campaign):
+    """The per-block rules cloud_regime used before they moved to config/cloud_regimes.yml."""
+    labels = pd.Series('Undetermined' if campaign == 'SOCRATES_old' else 'Unknown', index=block.index,
+                       dtype='object')
+    nan = pd.Series(np.nan, index=block.index)
+    if campaign in ('SOCRATES', 'SOCRATES_old'):
+        cum = ((block['M'] > -7) & (block['Wind_shear'] < 6)) | ((block['M'] > -7) & (block['Wind_sp'] > 10))
+        strcu = ((block['M'] <= -10) & (block['Wind_sp'] < 10)) | ((block['M'] <= -10) | (block['Wind_shear'] > 6))
+        old = campaign == 'SOCRATES_old'
+        labels[cum] = 'Open-Cell Cu' if old else 'Open-Cell'
+        labels[strcu] = 'Stratiform' if old else 'Stratocumulus'
+    else:
+        M, RH = block['M'], block.get('RH700', nan)
+        SST, Tadv = block.get('ERA5_SST', nan), block.get('Tadv', nan)
+        strat = ((M < -10) & (RH > 30)) | ((M < -10) & (SST < 295)) | ((M < -10) & (Tadv < 0))
+        opencu = ((M >= -10) & (RH <= 30)) | ((M >= -10) & (SST >= 296)) | ((M >= -10) & (Tadv >= 0.0005))
+        labels[strat] = 'Stratocumulus'
+        labels[opencu] = 'Open-Cell'
+    return labels
+
+
+def _random_blocks(seed=0):
+    rng = np.random.default_rng(seed)
+    # Values on both sides of and exactly at every threshold, with NaNs mixed in
+    values = {'M': [-12, -11, -10, -9, -7, -6, 0], 'Wind_shear': [4, 6, 8], 'Wind_sp': [8, 10, 12],
+              'RH700': [20, 30, 40], 'ERA5_SST': [294, 295, 295.5, 296, 297], 'Tadv': [-1e-3, 0, 5e-4, 1e-3]}
+    blocks = {}
+    for label, sizes in (('Level BL', [50, 0, 80]), ('Profile', [60])):
+        frames = []
+        for n in sizes:
+            df = pd.DataFrame({col: rng.choice(v, n).astype(float) for col, v in values.items()})
+            df[df.columns] = df.where(rng.random(df.shape) > 0.1)
+            frames.append(df)
+        blocks[label] = frames
+    blocks['Profile'][0] = blocks['Profile'][0].drop(columns='RH700')   # column missing in one block
+    return blocks
+
+
+@pytest.mark.parametrize('campaign', ['SOCRATES', 'CSET', 'SOCRATES_old'])
+def test_compiled_rules_match_old_cloud_regime(campaign):
+    blocks = _random_blocks()
+    expected = {label: [_old_cloud_regime(b, campaign) for b in frames] for label, frames in blocks.items()}
+    got = pdp.cloud_regime({label: [b.copy() for b in frames] for label, frames in blocks.items()}, campaign)
+    for label, frames in got.items():
+        for block, labels in zip(frames, expected[label]):
+            assert isinstance(block['cloud_regime'].dtype, pd.CategoricalDtype)
+            assert block['cloud_regime'].astype(object).tolist() == labels.tolist()
+
+    df = pd.concat([b for frames in blocks.values() for b in frames], ignore_index=True)
+    regimes = pdp.assign_cloud_regime(df, campaign)
+    assert list(regimes.astype(object)) == _old_cloud_regime(df, campaign).tolist()
+
+
+def test_parse_condition_rejects_malformed_text():
+    assert pdp.parse_condition("Tadv >= 5e-4") == ('Tadv', '>=', 5e-4)
+    with pytest.raises(ValueError):
+        pdp.parse_condition("M =< -10")
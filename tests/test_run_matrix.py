@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+
+import generate_exp_matrix as gem
+import parse_namelist
+
+
+def test_cached_summary_hashes_once_and_reuses_summary_by_content(tmp_path, monkeypatch):
+    path = tmp_path / "run1" / "atm_in"
+    path.parent.mkdir()
+    path.write_text("&cam_history_nl\n nhtfrq = 0, -24\n/\n")
+    calls = []
+    sha256 = hashlib.sha256
+    monkeypatch.setattr(hashlib, 'sha256', lambda data: calls.append(len(data)) or sha256(data))
+
+    summary, entry = gem.cached_summary({}, str(path))
+    assert calls == [path.stat().st_size]
+    assert summary['run_name'] == 'run1' and summary['namelist'] == {'nhtfrq': [0, -24]}
+    assert entry['sha256'] == summary['atm_in_sha256'] == sha256(path.read_bytes()).hexdigest()
+
+    cache = {os.path.abspath(path): entry}
+    assert gem.cached_summary(cache, str(path)) == (summary, None)       # size and mtime match
+
+    # Touched but unchanged: matched by content hash without parsing again
+    monkeypatch.setattr(parse_namelist, 'parse_namelist', None)
+    os.utime(path, ns=(entry['mtime_ns'] + 10**9, entry['mtime_ns'] + 10**9))
+    again, new_entry = gem.cached_summary(cache, str(path))
+    assert again == summary and new_entry['mtime_ns'] != entry['mtime_ns']
+    assert gem.cached_summary(cache, str(tmp_path / "missing" / "atm_in")) == (None, None)
+
+
+def _write_runs(root, n):
+    runs = []
+    for k in range(n):
+        path = root / f"run{k:02d}" / "atm_in"
+        path.parent.mkdir()
+        path.write_text(f"&cam_history_nl\n fincl1 = 'T:A', 'V{k}'\n nhtfrq = 0, -{k}\n/\n")
+        runs.append({"name": f"run{k:02d}", "atm_in": str(path)})
+    return runs
+
+
+def _without_dates(summaries):
+    return [s and {k: v for k, v in s.items() if k != 'snapshot_date'} for s in summaries]
+
+
+def test_scan_runs_keeps_run_order_and_merges_the_cache(tmp_path):
+    runs = _write_runs(tmp_path, 12)
+    runs.insert(3, {"name": "gone", "atm_in": str(tmp_path / "gone" / "atm_in")})
+    runs.append({"name": "dropped", "atm_in": runs[0]["atm_in"], "delete": True})
+
+    cache = {}
+    summaries, report = gem.scan_runs(runs, cache, max_workers=4)
+    serial, _ = gem.scan_runs(runs, {}, max_workers=1)
+    assert _without_dates(summaries) == _without_dates(serial)
+    assert [r["name"] for r in report] == [r["name"] for r in runs[:-1]]
+    assert [s and s["run_name"] for s in summaries] == [r["name"] if r["name"] != "gone" else None
+                                                        for r in runs[:-1]]
+    assert [r["status"] for r in report].count("missing") == 1
+    assert {r["status"] for r in report} == {"parsed", "missing"}
+    assert sorted(cache) == sorted(os.path.abspath(r["atm_in"]) for r in runs[:-1] if r["name"] != "gone")
+
+    again, report = gem.scan_runs(runs, cache, max_workers=4)
+    assert again == summaries
+    assert {r["status"] for r in report} == {"cached", "missing"}
+
+
+def test_write_docs_shards_index_variables_and_stale_shards(tmp_path):
+    matrix = [
+        {"run_name": "a", "nudging": True, "cosp": False, "fincl": {"fincl1": ["T:A", "Q"], "fincl2": ["T:I"]}},
+        {"run_name": "b/odd name", "nudging": False, "cosp": True, "fincl": {"fincl1": ["Q"]}},
+        {"run_name": "c", "fincl": {}},
+        "legacy row",
+    ]
+    similarity = {"runs": {"a": {"cluster": 0, "neighbors": [{"run_name": "c", "n_diff": 1}]},
+                           "c": {"cluster": 0, "neighbors": []}},
+                  "clusters": [["a", "c"]]}
+    paths = dict(shard_dir=str(tmp_path / "runs"), run_index_path=str(tmp_path / "run_index.json"),
+                 var_index_path=str(tmp_path / "var_index.json"))
+    (tmp_path / "runs").mkdir()
+    (tmp_path / "runs" / "removed.json").write_text("{}")
+
+    gem.write_docs_shards(matrix, similarity, **paths)
+    rows = json.loads((tmp_path / "run_index.json").read_text())
+    assert [r["run_name"] for r in rows] == ["a", "b/odd name", "c"]
+    assert rows[0]["fincl"] == ["fincl1", "fincl2"] and rows[0]["n_vars"] == 3
+    odd = gem.shard_name("b/odd name")
+    assert "/" not in odd and odd != gem.shard_name("b_odd name")
+    assert rows[1]["shard"] == f"runs/{odd}"
+    assert json.loads((tmp_path / "var_index.json").read_text()) == {"Q": [0, 1], "T": [0]}
+    assert sorted(os.listdir(tmp_path / "runs")) == sorted(["a.json", odd, "c.json"])
+
+    shard = json.loads((tmp_path / "runs" / "a.json").read_text())
+    assert shard["fincl"] == matrix[0]["fincl"]
+    assert shard["similarity"] == {"cluster": 0, "cluster_size": 2, "neighbors": similarity["runs"]["a"]["neighbors"]}
+    assert "similarity" not in json.loads((tmp_path / "runs" / odd).read_text())
+
+    # Unchanged shards are not rewritten (a rewrite replaces the file)
+    inodes = {f: os.stat(tmp_path / "runs" / f).st_ino for f in os.listdir(tmp_path / "runs")}
+    matrix[2]["cosp"] = True
+    gem.write_docs_shards(matrix, similarity, **paths)
+    changed = {f for f in inodes if os.stat(tmp_path / "runs" / f).st_ino != inodes[f]}
+    assert changed == {"c.json"}
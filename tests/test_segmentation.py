@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+import process_data_products_utils as pdp
+
+GRID = {'window': [5, 10], 'std_thresh': [1, 3], 'lwc_thresh': [0.001, 0.01]}
+
+
+def _block_rows(df, params):
+    blocks = pdp.block_flight(pdp.assign_flight_type(df, **params)['DataFrame'])
+    return {label: (len(frames), sum(len(b) for b in frames)) for label, frames in blocks.items()}
+
+
+def test_sweep_with_shared_cache_matches_fresh_runs(pipeline_inputs):
+    df = pipeline_inputs['df']
+    got = pdp.VAP_sweep_flight_data(df, GRID)
+    assert 'error' not in got.columns
+    settings = got.groupby(list(GRID), sort=False)
+    assert settings.ngroups == 8
+    for values, rows in settings:
+        params = {**pdp.VAP_SEGMENTATION_DEFAULTS, **dict(zip(GRID, values))}
+        assert (rows[list(params)] == pd.Series(params)).all().all()
+        assert dict(zip(rows['block_label'], zip(rows['n_blocks'], rows['n_samples']))) == _block_rows(df, params)
+
+
+def test_sweep_records_failed_settings_and_rejects_unknown_parameters(pipeline_inputs, monkeypatch):
+    df = pipeline_inputs['df']
+    block_flight, calls = pdp.block_flight, []
+
+    def fail_first(df_mod):
+        calls.append(1)
+        if len(calls) == 1:                          # the window=5 setting
+            raise ValueError("no stable samples")
+        return block_flight(df_mod)
+
+    monkeypatch.setattr(pdp, 'block_flight', fail_first)
+    got = pdp.VAP_sweep_flight_data(df, {'window': [5, 10]})
+    failed = got[got['error'].notna()]
+    assert list(failed['window']) == [5] and 'no stable samples' in failed['error'].iloc[0]
+    assert failed['block_label'].isna().all()
+    assert (got.loc[got['error'].isna(), 'n_blocks'] > 0).all()
+
+    with pytest.raises(ValueError, match='threshold'):
+        pdp.VAP_sweep_flight_data(df, {'threshold': [1]})
@@ -0,0 +1,51 @@
+import itertools
+
+import synthetic as syn
+from run_similarity import build_similarity, nearest, run_features
+
+
+def _n_diff(a, b):
+    return len(set(a) ^ set(b)) + sum(a[k] != b[k] for k in set(a) & set(b))
+
+
+def test_build_similarity_finds_one_key_neighbours():
+    base = {f"key_{k:02d}": f"value_{k}" for k in range(40)}
+    far = {f"other_{k:02d}": k for k in range(40)}
+    matrix = [
+        {'run_name': 'base', 'namelist': base},
+        {'run_name': 'base_copy', 'namelist': dict(base)},
+        {'run_name': 'changed', 'namelist': {**base, 'key_07': 'new'}},
+        {'run_name': 'added', 'namelist': {**base, 'extra': [1, 2]}},
+        {'run_name': 'two_changes', 'namelist': {**base, 'key_01': 'a', 'key_02': 'b'}},
+        {'run_name': 'unrelated', 'namelist': far},
+        {'namelist': base}, 'not a run',
+    ]
+    index = build_similarity(matrix)
+    assert set(index['runs']) == {'base', 'base_copy', 'changed', 'added', 'two_changes', 'unrelated'}
+
+    got = nearest(index, 'base')
+    assert [(r['run'], r['n_diff']) for r in got[:3]] == [('base_copy', 0), ('added', 1), ('changed', 1)]
+    assert got[1]['diff'] == {'changed': {}, 'added': {'extra': (1, 2)}, 'removed': {}}
+    assert got[2]['diff'] == {'changed': {'key_07': ['value_7', 'new']}, 'added': {}, 'removed': {}}
+    assert nearest(index, 'added')[0]['diff']['removed'] == {'extra': (1, 2)}
+    assert {'base', 'base_copy', 'changed', 'added'} <= set(index['clusters'][0])
+    assert index['runs']['unrelated']['cluster'] is None
+    assert all(r['run'] != 'unrelated' for r in got)
+
+
+def test_build_similarity_never_misses_a_one_key_neighbour():
+    matrix = syn.make_run_matrix(n_runs=300, n_keys=40, dup_frac=0.3, seed=3)
+    index = build_similarity(matrix)
+    features = {e['run_name']: run_features(e) for e in matrix}
+    closest = {name: min(_n_diff(features[name], features[other]) for other in features if other != name)
+               for name in features}
+    for name in features:
+        neighbors = index['runs'][name]['neighbors']
+        assert [r['n_diff'] for r in neighbors] == sorted(r['n_diff'] for r in neighbors)
+        for r in neighbors:
+            assert r['n_diff'] == _n_diff(features[name], features[r['run']])
+        if closest[name] <= 1:
+            assert neighbors[0]['n_diff'] == closest[name], name
+    pairs = [(a, b) for a, b in itertools.combinations(features, 2) if _n_diff(features[a], features[b]) <= 1]
+    cluster = {name: run['cluster'] for name, run in index['runs'].items()}
+    assert all(cluster[a] is not None and cluster[a] == cluster[b] for a, b in pairs)
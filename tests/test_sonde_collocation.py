@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+import process_data_products_utils as pdp
+from conftest import CAMPAIGN
+
+LEVELS = np.arange(1000., 399., -25.)
+
+
+def _sondes(df, rows=(600, 5000, 11000)):
+    frames = []
+    for k, row in enumerate(rows):
+        r = df.iloc[row]
+        n = len(LEVELS)
+        frames.append(pd.DataFrame({
+            'sonde_id': f"D{k}", 'release_time': r['Time'], 'Time': np.arange(n) * 10.0,
+            'Lat': r['GGLAT'] + np.linspace(0, 0.2, n), 'Lon': r['GGLON'] + np.linspace(0, 0.3, n),
+            'Press': LEVELS, 'Alt': -8000. * np.log(LEVELS / 1013.), 'Temp': np.linspace(12, -30, n),
+            'Ucmp': 5.0, 'Vcmp': -2.0, 'RH': 80.0,
+        }))
+    sondes = pd.concat(frames, ignore_index=True)
+    sondes.loc[3, 'Lat'] = np.nan                         # levels without a position are dropped
+    return sondes
+
+
+def test_collocate_sondes_ERA5_on_levels_and_surface(pipeline_inputs):
+    df, era5_root = pipeline_inputs['df'], pipeline_inputs['era5_root']
+    track = pdp.sonde_track(_sondes(df))
+    assert len(track) == 3 * len(LEVELS) - 1 and track['Time'].is_monotonic_increasing
+    got = pdp.collocate_sondes_ERA5(track.copy(), CAMPAIGN, era5_root)
+
+    plev = pdp.load_ERA5_plev_band(track, CAMPAIGN, pdp.SONDE_ERA5_VARS, era5_root)
+    ti, yi, xi = pdp.ERA5_grid_locator(plev)(got['GGLAT'].values, got['GGLON'].values, got['Time'].values)
+    levels = list(plev['level'].values)
+    on_level = got['PSXC'].isin(levels).to_numpy()
+    assert on_level.sum() > len(got) / 3
+    k = np.array([levels.index(p) for p in got['PSXC'][on_level]])
+    for var in pdp.SONDE_ERA5_VARS:
+        np.testing.assert_allclose(got[f"ERA5_{var}"].to_numpy()[on_level],
+                                   plev[var].values[ti[on_level], k, yi[on_level], xi[on_level]], rtol=1e-6)
+    assert got[[f"ERA5_{v}" for v in pdp.SONDE_ERA5_VARS]].notna().all().all()
+    np.testing.assert_allclose(got['dT_ERA5'], got['Temp'] + 273.15 - got['ERA5_T'])
+    np.testing.assert_allclose(got['dU_ERA5'], got['Ucmp'] - got['ERA5_U'])
+
+    prims = pdp.load_ERA5_primitives(track, CAMPAIGN, era5_root)
+    sfc = got.loc[got.groupby('sonde_id')['PSXC'].idxmax()]
+    ti, yi, xi = pdp.ERA5_grid_locator(prims['SSTK'])(sfc['GGLAT'].values, sfc['GGLON'].values, sfc['Time'].values)
+    expected = dict(zip(sfc['sonde_id'], pdp.gather_points(prims['SSTK'], ti, yi, xi)))
+    np.testing.assert_allclose(got['ERA5_SSTK'], got['sonde_id'].map(expected))
+
+
+def test_profile_at_pressure_and_inversion_height():
+    z = np.arange(0., 3000., 10.)
+    p = 1000. * np.exp(-z / 8000.)
+    theta = np.where(z < 1000., 290., 300.)
+    track = pd.concat([
+        pd.DataFrame({'sonde_id': 'A', 'Alt': z, 'PSXC': p, 'T': theta * (p / 1000.)**pdp.kappa}),
+        pd.DataFrame({'sonde_id': 'B', 'Alt': z[:50], 'PSXC': p[:50], 'T': 280.}),   # never reaches 900 hPa
+    ], ignore_index=True)
+    track['v'] = 3.0 * np.log(track['PSXC']) - 2.0
+
+    at = pdp.profile_at_pressure(track, 'v', 900.)
+    assert list(at.index) == ['A', 'B']
+    np.testing.assert_allclose(at['A'], 3.0 * np.log(900.) - 2.0)
+    assert np.isnan(at['B'])
+
+    zi = pdp.inversion_height(track, 'T')
+    assert zi['A'] == 1000.
+    assert list(zi.index) == ['A', 'B']
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+import inform_utils as inform
+import synthetic as syn
+
+
+def _old_read_sonde2df(file_path):
+    """The line-by-line .cls parser parse_cls replaced (sections end at the next Nominal Release Time)."""
+    with open(file_path, "r", encoding="utf-8") as file:
+        lines = file.readlines()
+    start_indices = [i for i, line in enumerate(lines) if "Nominal Release Time" in line]
+    datasets = []
+    for idx, start in enumerate(start_indices):
+        data_start = next(i + 3 for i in range(start, len(lines) - 2)
+                          if lines[i].strip().startswith("Time") and "Press" in lines[i])
+        columns = lines[data_start - 3].strip().split()
+        end = start_indices[idx + 1] if idx + 1 < len(start_indices) else len(lines)
+        data = [row for row in (line.strip().split() for line in lines[data_start:end]) if len(row) == len(columns)]
+        df = pd.DataFrame(data, columns=columns)
+        df = df[(df != "9999.0").all(axis=1)]
+        datasets.append(df.apply(pd.to_numeric, errors='coerce'))
+    return datasets
+
+
+def _edit_rows(lines, first, edits):
+    for offset, edit in edits.items():
+        fields = lines[first + offset].split()
+        lines[first + offset] = edit(fields)
+
+
+def test_parse_cls_matches_line_by_line_parser(tmp_path):
+    path = syn.write_sonde_cls(str(tmp_path / "D20180115_sondes.cls"), n_sondes=3, levels=300)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    firsts = [i + 4 for i, line in enumerate(lines) if "Nominal Release Time" in line]
+
+    def put(col, value):
+        return lambda fields: " ".join(fields[:col] + [value] + fields[col + 1:])
+
+    # First sonde: the fast path's edge cases (missing values, look-alikes, short and long rows)
+    _edit_rows(lines, firsts[0], {
+        0: lambda fields: " ".join(fields + ["1.0"]),       # long first row
+        5: put(4, "9999.0"), 6: put(4, "9999.00"), 7: put(4, "19999.0"), 8: put(20, "9999.0"),
+        9: lambda fields: " ".join(fields[:-1]),             # short row
+        10: lambda fields: " ".join(fields + ["2.0"]),       # long row
+    })
+    # Second sonde: a blank and a garbled line mid-profile, non-numeric fields
+    _edit_rows(lines, firsts[1], {
+        50: lambda fields: "", 51: lambda fields: "garbled line ###", 52: put(3, "nan"),
+        53: put(20, "abc"), 54: put(2, "--"),
+    })
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    got = inform.read_sonde2df(path)
+    expected = _old_read_sonde2df(path)
+    assert len(got) == len(expected) == 3
+    for df, ref in zip(got, expected):
+        pd.testing.assert_frame_equal(df.reset_index(drop=True), ref.reset_index(drop=True), check_dtype=False)
+    # Rows after the garbled line are kept
+    assert len(got[1]) > 250
+
+    sections = inform.parse_cls(path)
+    assert [meta['sonde_id'] for meta, _ in sections] == ["180000000", "180000001", "180000002"]
+    assert np.isnan(sections[1][1]['Dewpt']).sum() == 1